@@ -1,33 +1,98 @@
 import os
 import sys
 import logging
-
-from firmware import MacFirmwareUpdater, LinuxFirmwareUpdater, WindowsFirmwareUpdater
+import importlib
 
 logger = logging.getLogger('peachy')
 
+# Imported on first use so importing the package, or getting a dfu-util updater, does not load libusb, fleet or metrics code
+_LAZY = {
+    'MacFirmwareUpdater': 'firmware',
+    'LinuxFirmwareUpdater': 'firmware',
+    'WindowsFirmwareUpdater': 'firmware',
+    'LibUsbFirmwareUpdater': 'firmware',
+    'FleetUpdater': 'fleet',
+    'SysfsUsbEnumerator': 'devices',
+    'DeviceRecord': 'devices',
+    'DeviceInventory': 'inventory',
+    'ImageCache': 'image',
+    'RetryPolicy': 'resumable',
+    'FlashMetrics': 'metrics',
+    'FlashPlan': 'plan',
+    'ProfileStore': 'tuning',
+}
+
+
+def __getattr__(name):
+    if name not in _LAZY:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    value = getattr(importlib.import_module('.' + _LAZY[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+# Module __getattr__ needs Python 3.7
+if sys.version_info < (3, 7):
+    for _name in _LAZY:
+        __getattr__(_name)
 
-def get_firmware_updater(bootloader_idvendor=0x0483, bootloader_idproduct=0xdf11, peachy_idvendor=0x16d0, peachy_idproduct=0x0af3):
-    print("Firmware Flash Is Frozen: {}".format(str(getattr(sys, 'frozen', False))))
+
+def _sysfs_inventory(updater, usb_enumerator=None):
+    '''A DeviceInventory of the updater's devices when sysfs is there to index, None otherwise'''
+    from .devices import SysfsUsbEnumerator
+    from .inventory import DeviceInventory
+    if usb_enumerator is None:
+        if not SysfsUsbEnumerator.available():
+            return None
+        usb_enumerator = SysfsUsbEnumerator()
+    return DeviceInventory(usb_enumerator, updater.device_modes)
+
+
+def get_firmware_updater(bootloader_idvendor=0x0483, bootloader_idproduct=0xdf11, peachy_idvendor=0x16d0, peachy_idproduct=0x0af3, use_libusb=False):
+    '''The updater for this platform, its tools checked by a preflight that runs once per process'''
+    from .image import ImageCache
+    from .preflight import preflight
+    if use_libusb:
+        from .firmware import LibUsbFirmwareUpdater
+        from .resumable import RetryPolicy
+        from .tuning import ProfileStore
+        updater = LibUsbFirmwareUpdater(None, bootloader_idvendor, bootloader_idproduct, peachy_idvendor, peachy_idproduct)
+        updater.image_cache = ImageCache()
+        updater.retry_policy = RetryPolicy()
+        updater.profiles = ProfileStore(os.path.join(os.path.expanduser('~'), '.peachy-flash', 'profiles.json'))
+        if 'linux' in sys.platform:
+            updater.inventory = _sysfs_inventory(updater)
+        return updater
     if 'darwin' in sys.platform:
-        if getattr(sys, 'frozen', False):
-            dependancies_path = sys._MEIPASS
-        else:
-            dependancies_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dependancies', 'mac')
-        print("Firmware Flash Dependancies Path: {}".format(dependancies_path))
-        return MacFirmwareUpdater(dependancies_path, bootloader_idvendor, bootloader_idproduct, peachy_idvendor, peachy_idproduct)
+        from .firmware import MacFirmwareUpdater
+        dependancies = preflight('mac')
+        dependancies_path = os.path.dirname(dependancies['dfu-util'].path)
+        logger.info("Firmware flash dependancies path: {}".format(dependancies_path))
+        updater = MacFirmwareUpdater(dependancies_path, bootloader_idvendor, bootloader_idproduct, peachy_idvendor, peachy_idproduct)
+        updater.image_cache = ImageCache()
+        updater.port_paths = dependancies['dfu-util'].paths
     elif 'win' in sys.platform:
-        if getattr(sys, 'frozen', False):
-            dependancies_path = sys._MEIPASS
-        else:
-            dependancies_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dependancies', 'windows')
-        return WindowsFirmwareUpdater(dependancies_path, bootloader_idvendor, bootloader_idproduct, peachy_idvendor, peachy_idproduct)
+        from .firmware import WindowsFirmwareUpdater
+        dependancies = preflight('windows')
+        dependancies_path = os.path.dirname(dependancies['DfuSeCommand.exe'].path)
+        updater = WindowsFirmwareUpdater(dependancies_path, bootloader_idvendor, bootloader_idproduct, peachy_idvendor, peachy_idproduct)
     elif 'linux' in sys.platform:
-        if getattr(sys, 'frozen', False):
-            dependancies_path = sys._MEIPASS
-        else:
-            dependancies_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dependancies', 'linux')
-        return LinuxFirmwareUpdater(dependancies_path, bootloader_idvendor, bootloader_idproduct, peachy_idvendor, peachy_idproduct)
+        from .firmware import LinuxFirmwareUpdater
+        from .devices import SysfsUsbEnumerator
+        dependancies = preflight('linux')
+        dependancies_path = os.path.dirname(dependancies['dfu-util'].path)
+        usb_enumerator = SysfsUsbEnumerator() if SysfsUsbEnumerator.available() else None
+        updater = LinuxFirmwareUpdater(dependancies_path, bootloader_idvendor, bootloader_idproduct, peachy_idvendor, peachy_idproduct, usb_enumerator=usb_enumerator)
+        updater.image_cache = ImageCache()
+        updater.port_paths = dependancies['dfu-util'].paths
+        updater.inventory = _sysfs_inventory(updater, usb_enumerator)
     else:
         logger.error("Platform {} is unsupported for firmware updates".format(sys.platform))
         raise Exception("Unsupported Platform")
+    updater.dependancies = dependancies
+    return updater
+
+
+def get_fleet_updater(max_workers=4, lock_dir=None, **kwargs):
+    from .fleet import FleetUpdater
+    return FleetUpdater(get_firmware_updater(**kwargs), max_workers=max_workers, lock_dir=lock_dir)
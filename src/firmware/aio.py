@@ -0,0 +1,237 @@
+'''Coroutine versions of the FirmwareUpdater operations, for driving many devices from one asyncio event loop.
+
+Requires Python 3.5 or later and is not imported by the firmware package itself.'''
+import asyncio
+import logging
+import threading
+
+from .devices import parse_dfu_util_list
+from .metrics import UpdateRecorder
+from .progress import ProgressTracker, UpdateResult
+
+logger = logging.getLogger('peachy')
+
+READ_SIZE = 256
+
+
+class UpdateCancelled(Exception):
+    pass
+
+
+class UpdateProgress(object):
+    '''An update running on the event loop.
+
+    Iterate it with async for to receive ProgressEvents, await it for the UpdateResult.'''
+
+    def __init__(self, loop):
+        self._loop = loop
+        self._events = asyncio.Queue()
+        self.task = None
+
+    def _publish(self, event):
+        self._events.put_nowait(event)
+
+    def _publish_threadsafe(self, event):
+        self._loop.call_soon_threadsafe(self._events.put_nowait, event)
+
+    def _finished(self, task):
+        self._events.put_nowait(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        event = await self._events.get()
+        if event is None:
+            raise StopAsyncIteration
+        return event
+
+    def __await__(self):
+        return self.task.__await__()
+
+    def cancel(self):
+        return self.task.cancel()
+
+
+class AsyncFirmwareUpdater(object):
+    '''Wraps a FirmwareUpdater so its operations can be awaited.
+
+    dfu-util, DfuSeCommand and lsusb run as asyncio subprocesses which are terminated when the coroutine is
+    cancelled or times out, libusb transfers run in an executor and are stopped at the next block. dfu-util updates
+    follow the updater's own steps, so they verify, leave, stop stalled transfers and record metrics as its update does.'''
+
+    def __init__(self, updater, loop=None, executor=None, terminate_timeout=2.0):
+        self.updater = updater
+        self._loop = loop
+        self.executor = executor
+        self.terminate_timeout = terminate_timeout
+
+    @property
+    def loop(self):
+        return self._loop or asyncio.get_event_loop()
+
+    def _in_executor(self, function, *args):
+        return self.loop.run_in_executor(self.executor, function, *args)
+
+    async def _start(self, command):
+        if isinstance(command, list):
+            return await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        return await asyncio.create_subprocess_shell(command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+
+    async def _terminate(self, process):
+        if process.returncode is not None:
+            return
+        try:
+            process.terminate()
+            await asyncio.wait_for(process.wait(), self.terminate_timeout)
+        except ProcessLookupError:
+            pass
+        except asyncio.TimeoutError:
+            logger.error("Process {} did not terminate, killing it".format(process.pid))
+            process.kill()
+            await process.wait()
+
+    async def _run(self, command):
+        process = await self._start(command)
+        try:
+            out, err = await process.communicate()
+        except BaseException:
+            await self._terminate(process)
+            raise
+        out, err = out.decode('utf-8', 'replace'), err.decode('utf-8', 'replace')
+        if process.returncode != 0:
+            logger.error("Output: {}".format(out))
+            logger.error("Error: {}".format(err))
+            logger.error("Exit Code: {}".format(process.returncode))
+            raise Exception("Command failed")
+        return out
+
+    def _usb_command(self):
+        if getattr(self.updater, 'usb_enumerator', None) is not None:
+            return None
+        try:
+            return self.updater.check_usb_command
+        except NotImplementedError:
+            return None
+
+    async def list_usb_devices(self, timeout=None):
+        '''Returns (bootloaders, peachys) like FirmwareUpdater.list_usb_devices'''
+        command = self._usb_command()
+        if command is None:
+            return await asyncio.wait_for(self._in_executor(self.updater.list_usb_devices), timeout)
+        out = await asyncio.wait_for(self._run(command), timeout)
+        return self.updater._count_usb_devices(out)
+
+    async def check_ready(self, timeout=None):
+        return self.updater._is_ready(*(await self.list_usb_devices(timeout)))
+
+    async def list_bootloaders(self, timeout=None):
+        if not hasattr(self.updater, '_list_bootloaders_command') or getattr(self.updater, 'usb_enumerator', None) is not None:
+            return await asyncio.wait_for(self._in_executor(self.updater.list_bootloaders), timeout)
+        out = await asyncio.wait_for(self._run(self.updater._list_bootloaders_command()), timeout)
+        return parse_dfu_util_list(out, self.updater._bootloader_idvendor, self.updater._bootloader_idproduct)
+
+    async def wait_for_bootloader(self, timeout):
+        return await self._in_executor(self.updater.wait_for_bootloader, timeout)
+
+    async def wait_for_peachy(self, timeout):
+        return await self._in_executor(self.updater.wait_for_peachy, timeout)
+
+    def start_update(self, firmware_path, device=None, timeout=None, leave=False):
+        '''Starts flashing firmware_path returning an UpdateProgress.
+
+        leave: start the firmware afterwards, as update_and_leave does
+        Cancelling it, or timeout seconds passing, stops the transfer and raises CancelledError or TimeoutError from it.'''
+        progress = UpdateProgress(self.loop)
+        if hasattr(self.updater, '_update_steps'):
+            coroutine = self._update_process(firmware_path, device, progress._publish, leave)
+        else:
+            coroutine = self._update_in_process(firmware_path, device, progress._publish_threadsafe, leave)
+        progress.task = self.loop.create_task(asyncio.wait_for(coroutine, timeout))
+        progress.task.add_done_callback(progress._finished)
+        return progress
+
+    async def update(self, firmware_path, device=None, progress_callback=None, timeout=None, leave=False):
+        '''Flashes firmware_path returning an UpdateResult, progress_callback receives ProgressEvents as it runs'''
+        progress = self.start_update(firmware_path, device, timeout, leave)
+        try:
+            async for event in progress:
+                if progress_callback:
+                    progress_callback(event)
+            return await progress
+        except asyncio.CancelledError:
+            progress.cancel()
+            raise
+
+    async def _read_lines(self, stream, on_line, lines, stall_timeout=None):
+        '''Reads stream into lines, raising TimeoutError if it is silent for stall_timeout seconds'''
+        line = bytearray()
+        while True:
+            chunk = await asyncio.wait_for(stream.read(READ_SIZE), stall_timeout)
+            if not chunk:
+                break
+            for char in chunk:
+                if char in (0x0d, 0x0a):
+                    if line:
+                        lines.append(line.decode('utf-8', 'replace'))
+                        on_line(lines[-1])
+                        line = bytearray()
+                else:
+                    line.append(char)
+        if line:
+            lines.append(line.decode('utf-8', 'replace'))
+            on_line(lines[-1])
+
+    async def _run_step(self, command, on_line):
+        '''Runs one dfu-util command of an update, returning (exit_code, out, err, stalled) as the update's steps take it'''
+        process = await self._start(command)
+        out, err = [], []
+        stalled = False
+        try:
+            try:
+                await asyncio.gather(
+                    self._read_lines(process.stdout, on_line or (lambda line: None), out, self.updater.stall_timeout),
+                    self._read_lines(process.stderr, lambda line: None, err))
+            except asyncio.TimeoutError:
+                logger.error("No output for {} seconds, stopping".format(self.updater.stall_timeout))
+                stalled = True
+                await self._terminate(process)
+            exit_code = await process.wait()
+        except BaseException:
+            await self._terminate(process)
+            raise
+        return exit_code, '\n'.join(out), '\n'.join(err), stalled
+
+    async def _update_process(self, firmware_path, device, publish, leave):
+        recorder = UpdateRecorder(self.updater, firmware_path, device, publish)
+        steps = self.updater._update_steps(firmware_path, device, ProgressTracker(recorder.progress_callback), leave)
+        try:
+            # Preparing the image and checking what was read back run in the executor, dfu-util on the loop
+            step = await self._in_executor(next, steps)
+            while not isinstance(step, UpdateResult):
+                command, on_line = step
+                step = await self._in_executor(steps.send, await self._run_step(command, on_line))
+        except Exception as e:
+            recorder.fail(e)
+            raise
+        return recorder.finish(step)
+
+    async def _update_in_process(self, firmware_path, device, publish, leave):
+        cancelled = threading.Event()
+
+        def progress_callback(event):
+            if cancelled.is_set():
+                raise UpdateCancelled()
+            publish(event)
+
+        update = self.updater.update_and_leave if leave else self.updater.update
+        future = self._in_executor(update, firmware_path, device, progress_callback)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            cancelled.set()
+            try:
+                await future
+            except UpdateCancelled:
+                logger.info("Update of {} cancelled".format(firmware_path))
+            raise
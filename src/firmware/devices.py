@@ -0,0 +1,265 @@
+import os
+import re
+import time
+import struct
+from collections import namedtuple
+
+MODE_BOOTLOADER = 'bootloader'
+MODE_PEACHY = 'peachy'
+
+USB_INTERFACE_DESCRIPTOR = 0x04
+DFU_FUNCTIONAL_DESCRIPTOR = 0x21
+# bInterfaceClass and bInterfaceSubClass of a DFU interface
+DFU_INTERFACE_CLASS = (0xfe, 0x01)
+
+DfuDescriptor = namedtuple('DfuDescriptor', 'attributes detach_timeout transfer_size dfu_version')
+
+
+class UsbDevice(object):
+    '''A single attached usb device, identified by bus/port path or serial number'''
+
+    def __init__(self, idvendor, idproduct, bus=None, port_path=None, serial=None, devnum=None):
+        self.idvendor = idvendor
+        self.idproduct = idproduct
+        self.bus = bus
+        self.port_path = port_path
+        self.serial = serial
+        self.devnum = devnum
+
+    @property
+    def usb_address(self):
+        return "{0:04x}:{1:04x}".format(self.idvendor, self.idproduct)
+
+    @property
+    def key(self):
+        if self.port_path:
+            return self.port_path
+        if self.serial:
+            return "{}-{}".format(self.usb_address, self.serial)
+        return "{}-{}-{}".format(self.usb_address, self.bus, self.devnum)
+
+    def _identity(self):
+        return (self.idvendor, self.idproduct, self.bus, self.port_path, self.serial, self.devnum)
+
+    def __eq__(self, other):
+        return isinstance(other, UsbDevice) and self._identity() == other._identity()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._identity())
+
+    def __repr__(self):
+        return "UsbDevice({}, path={}, serial={})".format(self.usb_address, self.port_path, self.serial)
+
+
+class DeviceRecord(object):
+    '''What is known of an attached device: its UsbDevice identity, its mode and, for a bootloader, its DFU details.
+
+    mode: MODE_BOOTLOADER, MODE_PEACHY or None for other devices
+    dfu: the bootloader's DfuDescriptor, None when unknown
+    layouts: the DfuSe memory layout strings of the alt settings that could be read, such as
+             "@Internal Flash  /0x08000000/04*016Kg,01*064Kg,07*128Kg"
+    bcd_device: the device's release number'''
+
+    def __init__(self, device, mode=None, dfu=None, layouts=(), bcd_device=None):
+        self.device = device
+        self.mode = mode
+        self.dfu = dfu
+        self.layouts = tuple(layouts)
+        self.bcd_device = bcd_device
+
+    @property
+    def key(self):
+        return self.device.key
+
+    @property
+    def idvendor(self):
+        return self.device.idvendor
+
+    @property
+    def idproduct(self):
+        return self.device.idproduct
+
+    @property
+    def bus(self):
+        return self.device.bus
+
+    @property
+    def port_path(self):
+        return self.device.port_path
+
+    @property
+    def serial(self):
+        return self.device.serial
+
+    @property
+    def layout(self):
+        '''The layout of the first alt setting, the main flash on STM32 bootloaders'''
+        return self.layouts[0] if self.layouts else None
+
+    def to_dict(self):
+        return {
+            'key': self.key,
+            'usb_address': self.device.usb_address,
+            'mode': self.mode,
+            'bus': self.bus,
+            'port_path': self.port_path,
+            'serial': self.serial,
+            'devnum': self.device.devnum,
+            'bcd_device': self.bcd_device,
+            'dfu': dict(self.dfu._asdict()) if self.dfu is not None else None,
+            'layouts': list(self.layouts),
+        }
+
+    def _identity(self):
+        return (self.device, self.mode, self.dfu, self.layouts, self.bcd_device)
+
+    def __eq__(self, other):
+        return isinstance(other, DeviceRecord) and self._identity() == other._identity()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._identity())
+
+    def __repr__(self):
+        return "DeviceRecord({}, mode={}, layout={})".format(self.device, self.mode, self.layout)
+
+
+def parse_dfu_descriptor(data):
+    '''Finds the DFU functional descriptor in raw configuration descriptors, such as sysfs's descriptors file;
+    None without one'''
+    data = bytearray(data or b'')
+    offset = 0
+    in_dfu_interface = False
+    while offset + 2 <= len(data):
+        length, kind = data[offset], data[offset + 1]
+        if length < 2:
+            break
+        if kind == USB_INTERFACE_DESCRIPTOR and length >= 9:
+            in_dfu_interface = (data[offset + 5], data[offset + 6]) == DFU_INTERFACE_CLASS
+        elif kind == DFU_FUNCTIONAL_DESCRIPTOR and in_dfu_interface and length >= 7 and offset + length <= len(data):
+            attributes, detach_timeout, transfer_size = struct.unpack('<BHH', bytes(data[offset + 2:offset + 7]))
+            dfu_version = struct.unpack('<H', bytes(data[offset + 7:offset + 9]))[0] if length >= 9 else None
+            return DfuDescriptor(attributes, detach_timeout, transfer_size, dfu_version)
+        offset += length
+    return None
+
+
+class SysfsUsbEnumerator(object):
+    '''Lists usb devices by reading /sys/bus/usb/devices directly rather than running lsusb.
+
+    cache_ttl: seconds a listing is reused for, 0 rescans on every call'''
+    SYSFS_USB_DEVICES = '/sys/bus/usb/devices'
+
+    def __init__(self, root=SYSFS_USB_DEVICES, cache_ttl=0, clock=time.time):
+        self.root = root
+        self.cache_ttl = cache_ttl
+        self._clock = clock
+        self._cache = None
+        self._cached_at = None
+
+    @classmethod
+    def available(cls, root=SYSFS_USB_DEVICES):
+        return os.path.isdir(root)
+
+    def _read(self, device_path, attribute):
+        try:
+            with open(os.path.join(device_path, attribute)) as attribute_file:
+                return attribute_file.read().strip()
+        except (IOError, OSError):
+            return None
+
+    def read_descriptors(self, name):
+        '''The raw device and configuration descriptors of a device, None if unreadable'''
+        try:
+            with open(os.path.join(self.root, name, 'descriptors'), 'rb') as descriptors_file:
+                return descriptors_file.read()
+        except (IOError, OSError):
+            return None
+
+    def read_bcd_device(self, name):
+        bcd_device = self._read(os.path.join(self.root, name), 'bcdDevice')
+        return int(bcd_device, 16) if bcd_device else None
+
+    def read_interface_names(self, name):
+        '''The strings of a device's interfaces in their current alt settings, in interface order'''
+        try:
+            interfaces = sorted(entry for entry in os.listdir(os.path.join(self.root, name)) if entry.startswith(name + ':'))
+        except OSError:
+            return []
+        names = [self._read(os.path.join(self.root, name, interface), 'interface') for interface in interfaces]
+        return [interface_name for interface_name in names if interface_name]
+
+    def read_device(self, name):
+        device_path = os.path.join(self.root, name)
+        idvendor = self._read(device_path, 'idVendor')
+        idproduct = self._read(device_path, 'idProduct')
+        if idvendor is None or idproduct is None:
+            return None
+        busnum = self._read(device_path, 'busnum')
+        devnum = self._read(device_path, 'devnum')
+        return UsbDevice(
+            int(idvendor, 16), int(idproduct, 16),
+            bus=int(busnum) if busnum else None,
+            port_path=None if name.startswith('usb') else name,
+            serial=self._read(device_path, 'serial'),
+            devnum=int(devnum) if devnum else None)
+
+    def names(self):
+        '''The directory names of attached devices, such as 1-1.2 and usb1 for a root hub'''
+        try:
+            # interfaces (1-1.2:1.0) are listed alongside devices
+            return sorted(name for name in os.listdir(self.root) if ':' not in name)
+        except OSError:
+            return []
+
+    def scan(self):
+        devices = []
+        for name in self.names():
+            device = self.read_device(name)
+            if device is not None:
+                devices.append(device)
+        return devices
+
+    def devices(self):
+        now = self._clock()
+        if self._cache is None or self.cache_ttl <= 0 or now - self._cached_at >= self.cache_ttl:
+            self._cache = self.scan()
+            self._cached_at = now
+        return list(self._cache)
+
+    def invalidate(self):
+        self._cache = None
+
+    def find(self, idvendor, idproduct):
+        return [device for device in self.devices() if (device.idvendor, device.idproduct) == (idvendor, idproduct)]
+
+
+_DFU_UTIL_FOUND = re.compile(r'^Found DFU: \[([0-9a-fA-F]{4}):([0-9a-fA-F]{4})\] (.*)$')
+_DFU_UTIL_FIELD = re.compile(r'(\w+)=("[^"]*"|[^,\s]*)')
+
+
+def parse_dfu_util_list(output, idvendor, idproduct):
+    '''Parses the output of "dfu-util -l" into one UsbDevice per attached device'''
+    devices = []
+    for line in output.splitlines():
+        match = _DFU_UTIL_FOUND.match(line.strip())
+        if not match:
+            continue
+        if (int(match.group(1), 16), int(match.group(2), 16)) != (idvendor, idproduct):
+            continue
+        fields = dict((key, value.strip('"')) for key, value in _DFU_UTIL_FIELD.findall(match.group(3)))
+        serial = fields.get('serial')
+        if serial in ('', 'UNKNOWN'):
+            serial = None
+        path = fields.get('path') or None
+        bus = int(path.split('-')[0]) if path else None
+        devnum = int(fields['devnum']) if fields.get('devnum', '').isdigit() else None
+        device = UsbDevice(idvendor, idproduct, bus=bus, port_path=path, serial=serial, devnum=devnum)
+        if device not in devices:
+            devices.append(device)
+    return devices
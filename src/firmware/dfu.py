@@ -0,0 +1,412 @@
+import re
+import time
+import struct
+import logging
+from collections import namedtuple
+
+from .progress import PHASE_ERASE, PHASE_DOWNLOAD
+
+logger = logging.getLogger('peachy')
+
+# DFU 1.1 class requests
+DFU_DETACH = 0
+DFU_DNLOAD = 1
+DFU_UPLOAD = 2
+DFU_GETSTATUS = 3
+DFU_CLRSTATUS = 4
+DFU_GETSTATE = 5
+DFU_ABORT = 6
+
+# DFU 1.1 device states
+STATE_APP_IDLE = 0
+STATE_APP_DETACH = 1
+STATE_DFU_IDLE = 2
+STATE_DFU_DNLOAD_SYNC = 3
+STATE_DFU_DNBUSY = 4
+STATE_DFU_DNLOAD_IDLE = 5
+STATE_DFU_MANIFEST_SYNC = 6
+STATE_DFU_MANIFEST = 7
+STATE_DFU_MANIFEST_WAIT_RESET = 8
+STATE_DFU_UPLOAD_IDLE = 9
+STATE_DFU_ERROR = 10
+
+# DFU 1.1 status codes
+STATUS_OK = 0x00
+STATUS_ERR_TARGET = 0x01
+STATUS_ERR_FILE = 0x02
+STATUS_ERR_WRITE = 0x03
+STATUS_ERR_ERASE = 0x04
+STATUS_ERR_CHECK_ERASED = 0x05
+STATUS_ERR_PROG = 0x06
+STATUS_ERR_VERIFY = 0x07
+STATUS_ERR_ADDRESS = 0x08
+STATUS_ERR_NOTDONE = 0x09
+STATUS_ERR_FIRMWARE = 0x0A
+STATUS_ERR_VENDOR = 0x0B
+STATUS_ERR_USBR = 0x0C
+STATUS_ERR_POR = 0x0D
+STATUS_ERR_UNKNOWN = 0x0E
+STATUS_ERR_STALLEDPKT = 0x0F
+
+# DfuSe (ST extension) commands, sent as DNLOAD block 0
+DFUSE_GET_COMMANDS = 0x00
+DFUSE_SET_ADDRESS = 0x21
+DFUSE_ERASE = 0x41
+DFUSE_READ_UNPROTECT = 0x92
+
+DFUSE_DATA_BLOCK = 2
+
+DEFAULT_TRANSFER_SIZE = 2048
+DEFAULT_ADDRESS = 0x08000000
+
+DfuStatus = namedtuple('DfuStatus', 'status poll_timeout state string_index')
+
+
+class DfuError(Exception):
+    def __init__(self, message, status=None, state=None):
+        super(DfuError, self).__init__(message)
+        self.status = status
+        self.state = state
+
+
+class MemorySector(object):
+    READABLE = 0x1
+    ERASABLE = 0x2
+    WRITABLE = 0x4
+
+    def __init__(self, address, size, attributes):
+        self.address = address
+        self.size = size
+        self.attributes = attributes
+
+    @property
+    def end(self):
+        return self.address + self.size
+
+    @property
+    def readable(self):
+        return bool(self.attributes & self.READABLE)
+
+    @property
+    def erasable(self):
+        return bool(self.attributes & self.ERASABLE)
+
+    @property
+    def writable(self):
+        return bool(self.attributes & self.WRITABLE)
+
+    def __eq__(self, other):
+        return isinstance(other, MemorySector) and (self.address, self.size, self.attributes) == (other.address, other.size, other.attributes)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.address, self.size, self.attributes))
+
+    def __repr__(self):
+        return "MemorySector(0x{0:08x}, {1}, {2})".format(self.address, self.size, self.attributes)
+
+
+class MemoryLayout(object):
+    _SEGMENT = re.compile(r'^\s*(\d+)\*(\d+)\s*([ BKM])\s*([a-g])\s*$')
+    _MULTIPLIERS = {' ': 1, 'B': 1, 'K': 1024, 'M': 1024 * 1024}
+
+    def __init__(self, name, sectors):
+        self.name = name
+        self.sectors = sectors
+
+    @classmethod
+    def parse(cls, description):
+        '''Parses a DfuSe interface string such as "@Internal Flash  /0x08000000/04*016Kg,01*064Kg,07*128Kg"'''
+        if not description or not description.startswith('@'):
+            raise DfuError("Invalid DfuSe memory layout: {}".format(description))
+        parts = description[1:].split('/')
+        if len(parts) < 3 or len(parts) % 2 == 0:
+            raise DfuError("Invalid DfuSe memory layout: {}".format(description))
+        name = parts[0].strip()
+        sectors = []
+        for index in range(1, len(parts), 2):
+            address = int(parts[index], 16)
+            for segment in parts[index + 1].split(','):
+                match = cls._SEGMENT.match(segment)
+                if not match:
+                    raise DfuError("Invalid DfuSe memory segment: {}".format(segment))
+                count, size, unit, attributes = match.groups()
+                size = int(size, 10) * cls._MULTIPLIERS[unit]
+                attributes = ord(attributes) - ord('a') + 1
+                for _ in range(int(count, 10)):
+                    sectors.append(MemorySector(address, size, attributes))
+                    address += size
+        return cls(name, sectors)
+
+    @property
+    def start(self):
+        return self.sectors[0].address
+
+    @property
+    def end(self):
+        return self.sectors[-1].end
+
+    def sector_at(self, address):
+        for sector in self.sectors:
+            if sector.address <= address < sector.end:
+                return sector
+        return None
+
+    def sectors_for(self, address, length):
+        end = address + length
+        return [sector for sector in self.sectors if sector.address < end and address < sector.end]
+
+
+class PyUsbTransport(object):
+    '''Control transfer transport to a DFU interface using libusb through pyusb.
+
+    Any object providing control_out, control_in, set_alternate, close and
+    interface_name can be used in place of this, e.g. a simulated device.'''
+    REQUEST_TYPE_OUT = 0x21
+    REQUEST_TYPE_IN = 0xA1
+
+    def __init__(self, device, interface=0, alt=0, timeout=5000):
+        self.device = device
+        self.interface = interface
+        self.alt = alt
+        self.timeout = timeout
+
+    @staticmethod
+    def _port_path(usb_device):
+        ports = getattr(usb_device, 'port_numbers', None)
+        if not ports:
+            return None
+        return "{}-{}".format(usb_device.bus, '.'.join(str(port) for port in ports))
+
+    @staticmethod
+    def _serial(usb_device):
+        import usb.util
+        try:
+            return usb.util.get_string(usb_device, usb_device.iSerialNumber) if usb_device.iSerialNumber else None
+        except (usb.core.USBError, ValueError):
+            return None
+
+    @classmethod
+    def _matches(cls, usb_device, device):
+        if device.port_path:
+            return cls._port_path(usb_device) == device.port_path
+        return cls._serial(usb_device) == device.serial
+
+    @classmethod
+    def open(cls, idvendor, idproduct, device=None, **kwargs):
+        '''Opens the only matching device, or the one identified by device (a UsbDevice)'''
+        import usb.core
+        if device is None:
+            usb_device = usb.core.find(idVendor=idvendor, idProduct=idproduct)
+        else:
+            usb_device = usb.core.find(idVendor=idvendor, idProduct=idproduct, custom_match=lambda d: cls._matches(d, device))
+        if usb_device is None:
+            raise DfuError("No device found for {0:04x}:{1:04x}".format(idvendor, idproduct))
+        transport = cls(usb_device, **kwargs)
+        transport.set_alternate(transport.alt)
+        return transport
+
+    @classmethod
+    def count(cls, idvendor, idproduct):
+        import usb.core
+        return len(list(usb.core.find(find_all=True, idVendor=idvendor, idProduct=idproduct)))
+
+    @classmethod
+    def list(cls, idvendor, idproduct):
+        import usb.core
+        from .devices import UsbDevice
+        return [
+            UsbDevice(idvendor, idproduct, bus=usb_device.bus, port_path=cls._port_path(usb_device), serial=cls._serial(usb_device), devnum=usb_device.address)
+            for usb_device in usb.core.find(find_all=True, idVendor=idvendor, idProduct=idproduct)
+        ]
+
+    @property
+    def interface_name(self):
+        import usb.util
+        configuration = self.device.get_active_configuration()
+        interface = configuration[(self.interface, self.alt)]
+        if not interface.iInterface:
+            return None
+        return usb.util.get_string(self.device, interface.iInterface)
+
+    @property
+    def bcd_device(self):
+        return self.device.bcdDevice
+
+    @property
+    def serial(self):
+        return self._serial(self.device)
+
+    def set_alternate(self, alt):
+        self.device.set_interface_altsetting(interface=self.interface, alternate_setting=alt)
+        self.alt = alt
+
+    def control_out(self, request, value, data):
+        return self.device.ctrl_transfer(self.REQUEST_TYPE_OUT, request, value, self.interface, data, self.timeout)
+
+    def control_in(self, request, value, length):
+        return bytearray(self.device.ctrl_transfer(self.REQUEST_TYPE_IN, request, value, self.interface, length, self.timeout))
+
+    def close(self):
+        import usb.util
+        usb.util.dispose_resources(self.device)
+
+
+class DfuSeEngine(object):
+    '''Drives the DfuSe (STM32 bootloader) protocol over a transport.
+
+    transfer_size: bytes per DNLOAD/UPLOAD block
+    poll_interval: seconds between GETSTATUS polls while busy, None honours the device's bwPollTimeout
+    sequential_blocks: set the address once per write and increment wBlockNum, rather than
+                       setting the address before every block as dfu-util does'''
+
+    def __init__(self, transport, transfer_size=DEFAULT_TRANSFER_SIZE, poll_interval=None, sequential_blocks=True, sleep=time.sleep):
+        self.transport = transport
+        self.transfer_size = transfer_size
+        self.poll_interval = poll_interval
+        self.sequential_blocks = sequential_blocks
+        self._sleep = sleep
+
+    def get_status(self):
+        data = self.transport.control_in(DFU_GETSTATUS, 0, 6)
+        if len(data) != 6:
+            raise DfuError("Invalid status response of {} bytes".format(len(data)))
+        poll_timeout = data[1] | (data[2] << 8) | (data[3] << 16)
+        return DfuStatus(data[0], poll_timeout, data[4], data[5])
+
+    def get_state(self):
+        return self.transport.control_in(DFU_GETSTATE, 0, 1)[0]
+
+    def clear_status(self):
+        self.transport.control_out(DFU_CLRSTATUS, 0, None)
+
+    def abort(self):
+        self.transport.control_out(DFU_ABORT, 0, None)
+
+    def ensure_idle(self):
+        status = self.get_status()
+        while status.state in (STATE_DFU_DNBUSY, STATE_DFU_DNLOAD_SYNC):
+            self._poll(status)
+            status = self.get_status()
+        if status.state == STATE_DFU_ERROR:
+            self.clear_status()
+            status = self.get_status()
+        if status.state in (STATE_DFU_DNLOAD_IDLE, STATE_DFU_UPLOAD_IDLE):
+            self.abort()
+            status = self.get_status()
+        if status.state != STATE_DFU_IDLE:
+            raise DfuError("Device not idle", status.status, status.state)
+
+    def _poll(self, status):
+        if self.poll_interval is None:
+            delay = status.poll_timeout / 1000.0
+        else:
+            delay = self.poll_interval
+        if delay > 0:
+            self._sleep(delay)
+
+    def _wait_status(self):
+        status = self.get_status()
+        while status.state in (STATE_DFU_DNBUSY, STATE_DFU_DNLOAD_SYNC):
+            self._poll(status)
+            status = self.get_status()
+        if status.status != STATUS_OK or status.state == STATE_DFU_ERROR:
+            raise DfuError("Device reported status 0x{0:02x} in state {1}".format(status.status, status.state), status.status, status.state)
+        return status
+
+    def download_block(self, block, data):
+        self.transport.control_out(DFU_DNLOAD, block, data)
+        return self._wait_status()
+
+    def _command(self, command, address=None):
+        data = bytearray([command])
+        if address is not None:
+            data += struct.pack('<I', address)
+        self.download_block(0, data)
+
+    def set_address(self, address):
+        self._command(DFUSE_SET_ADDRESS, address)
+
+    def erase_page(self, address):
+        self._command(DFUSE_ERASE, address)
+
+    def mass_erase(self):
+        self._command(DFUSE_ERASE)
+
+    def erase(self, address, length, layout=None, progress=None):
+        '''Erases the sectors covering a range, or the whole device without a layout.
+
+        progress: called with (phase, percent, bytes) after each sector'''
+        if layout is None:
+            self.mass_erase()
+            if progress:
+                progress(PHASE_ERASE, 100, length)
+            return []
+        sectors = layout.sectors_for(address, length)
+        if address + length > layout.end or address < layout.start:
+            raise DfuError("Range 0x{0:08x}-0x{1:08x} outside of {2}".format(address, address + length, layout.name))
+        erased = 0
+        for index, sector in enumerate(sectors):
+            if sector.erasable:
+                self.erase_page(sector.address)
+            erased += sector.size
+            if progress:
+                progress(PHASE_ERASE, 100 * (index + 1) // len(sectors), erased)
+        return sectors
+
+    def write(self, address, data, progress=None):
+        '''Writes erased flash; progress is called with (phase, percent, bytes) after each block'''
+        data = memoryview(data)
+        size = self.transfer_size
+        if self.sequential_blocks:
+            self.set_address(address)
+        for offset in range(0, len(data), size):
+            chunk = data[offset:offset + size].tobytes()
+            # DfuSe derives the block address from wLength, so a short final block is addressed explicitly
+            if self.sequential_blocks and len(chunk) == size:
+                self.download_block(DFUSE_DATA_BLOCK + offset // size, chunk)
+            else:
+                self.set_address(address + offset)
+                self.download_block(DFUSE_DATA_BLOCK, chunk)
+            if progress:
+                written = offset + len(chunk)
+                progress(PHASE_DOWNLOAD, 100 * written // len(data), written)
+
+    def read_chunks(self, address, length):
+        '''Yields the contents of a range a block at a time as each UPLOAD arrives'''
+        self.set_address(address)
+        self.abort()
+        remaining = length
+        block = DFUSE_DATA_BLOCK
+        while remaining > 0:
+            chunk = self.transport.control_in(DFU_UPLOAD, block, self.transfer_size)
+            if not chunk:
+                break
+            chunk = chunk[:remaining]
+            remaining -= len(chunk)
+            block += 1
+            yield chunk
+        self.abort()
+
+    def read(self, address, length):
+        result = bytearray()
+        for chunk in self.read_chunks(address, length):
+            result += chunk
+        return result
+
+    def download(self, address, data, layout=None, progress=None):
+        self.ensure_idle()
+        self.erase(address, len(data), layout, progress)
+        self.write(address, data, progress)
+
+    def leave(self, address=None):
+        '''Exits DFU mode, starting the firmware; the device will usually disconnect'''
+        if address is not None:
+            self.set_address(address)
+        self.transport.control_out(DFU_DNLOAD, 0, None)
+        try:
+            self.get_status()
+        except (IOError, OSError):
+            logger.info("Device disconnected during manifest")
@@ -0,0 +1,107 @@
+import os
+import json
+import hashlib
+import logging
+from collections import namedtuple
+
+from .progress import PHASE_COMPARE, PHASE_ERASE, PHASE_DOWNLOAD
+
+logger = logging.getLogger('peachy')
+
+DifferentialResult = namedtuple('DifferentialResult', 'written skipped')
+
+
+class ImageHashStore(object):
+    '''Remembers the sha256 of the image last flashed to each device in a json file, keyed by bootloader serial number'''
+
+    def __init__(self, path):
+        self.path = path
+
+    def _load(self):
+        if not os.path.isfile(self.path):
+            return {}
+        with open(self.path) as store_file:
+            return json.load(store_file)
+
+    def get(self, device_key):
+        return self._load().get(device_key)
+
+    def _save(self, hashes):
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as store_file:
+            json.dump(hashes, store_file)
+        if os.name == 'nt' and os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(temp_path, self.path)
+
+    def set(self, device_key, digest):
+        hashes = self._load()
+        hashes[device_key] = digest
+        self._save(hashes)
+
+    def forget(self, device_key):
+        hashes = self._load()
+        if hashes.pop(device_key, None) is not None:
+            self._save(hashes)
+
+
+class DifferentialFlasher(object):
+    '''Compares an image against the device's flash sector by sector, erasing and writing only those that differ'''
+
+    def __init__(self, engine, layout, hash_store=None):
+        self.engine = engine
+        self.layout = layout
+        self.hash_store = hash_store
+
+    def _ranges(self, address, image):
+        for sector in self.layout.sectors_for(address, len(image)):
+            start = max(sector.address, address)
+            end = min(sector.end, address + len(image))
+            yield sector, start, image[start - address:end - address]
+
+    def changed_sectors(self, address, image, progress=None):
+        image = memoryview(image)
+        changed = []
+        compared = 0
+        for sector, start, expected in self._ranges(address, image):
+            if self.engine.read(start, len(expected)) != expected.tobytes():
+                changed.append(sector)
+            compared += len(expected)
+            if progress:
+                progress(PHASE_COMPARE, 100 * compared // len(image), compared)
+        return changed
+
+    def _first_sector_matches(self, address, image):
+        sector, start, expected = next(self._ranges(address, memoryview(image)))
+        return self.engine.read(start, len(expected)) == expected.tobytes()
+
+    def flash(self, address, image, device_key=None, progress=None):
+        '''Returns a DifferentialResult listing the sectors written and those left alone.
+
+        device_key: the bootloader's serial number. A stored hash matching the image is only taken as a hint, the first
+        sector is still read back before skipping the device in case another unit was flashed under the same key'''
+        digest = hashlib.sha256(image).hexdigest()
+        sectors = self.layout.sectors_for(address, len(image))
+        if self.hash_store and device_key and self.hash_store.get(device_key) == digest:
+            self.engine.ensure_idle()
+            if self._first_sector_matches(address, image):
+                logger.info("Device {} already has image {}".format(device_key, digest))
+                return DifferentialResult([], sectors)
+            logger.info("Device {} was flashed with image {} but no longer holds it".format(device_key, digest))
+        self.engine.ensure_idle()
+        changed = self.changed_sectors(address, image, progress)
+        for index, sector in enumerate(changed):
+            self.engine.erase_page(sector.address)
+            if progress:
+                progress(PHASE_ERASE, 100 * (index + 1) // len(changed), sum(s.size for s in changed[:index + 1]))
+        writes = [(start, data) for sector, start, data in self._ranges(address, memoryview(image)) if sector in changed]
+        total = sum(len(data) for start, data in writes)
+        written = 0
+        for start, data in writes:
+            self.engine.write(start, data)
+            written += len(data)
+            if progress:
+                progress(PHASE_DOWNLOAD, 100 * written // total, written)
+        if self.hash_store and device_key:
+            self.hash_store.set(device_key, digest)
+        return DifferentialResult(changed, [sector for sector in sectors if sector not in changed])
@@ -1,8 +1,23 @@
 import sys
 import os
-import stat
+import time
+import shutil
+import tempfile
 from subprocess import Popen, PIPE
 import logging
+from collections import OrderedDict
+
+from .devices import UsbDevice, DeviceRecord, MODE_BOOTLOADER, MODE_PEACHY, parse_dfu_util_list
+from .hotplug import open_event_source
+from .progress import (
+    UpdateResult, CycleResult, ProgressTracker, DfuUtilOutputParser, stream_process, PHASE_MANIFEST, PHASE_VERIFY,
+    STAGE_ENTER_BOOTLOADER, STAGE_BOOTLOADER_ENUMERATION, STAGE_FLASH, STAGE_PEACHY_ENUMERATION,
+)
+from .verify import ImageDigest, FlashVerifier, CHUNK_SIZE
+from .image import ImageError, FirmwareImage, load_image
+from .metrics import instrumented, ENUMERATION
+from .dfu import DfuSeEngine, DfuError, MemoryLayout, PyUsbTransport, DEFAULT_TRANSFER_SIZE, DEFAULT_ADDRESS
+from .preflight import executable
 
 logger = logging.getLogger('peachy')
 
@@ -15,6 +30,15 @@ class FirmwareUpdater(object):
         self._peachy_idproduct = peachy_idproduct
 
         self.dependancy_path = dependancy_path
+        # {name: Dependancy} of the tools found by the preflight
+        self.dependancies = None
+        self.event_source_factory = None
+        self.image_cache = None
+        self.metrics = None
+        # A DeviceInventory answering device lookups from its hotplug index rather than a scan each time
+        self.inventory = None
+        # Seconds a flashing tool may write nothing before it is stopped, None waits for ever
+        self.stall_timeout = None
 
     @property
     def bootloader_usb_address(self):
@@ -24,11 +48,30 @@ class FirmwareUpdater(object):
     def peachy_usb_address(self):
         return "{0:04x}:{1:04x}".format(self._peachy_idvendor, self._peachy_idproduct)
 
+    @property
+    def device_modes(self):
+        '''{(idvendor, idproduct): mode} of the bootloader and printer, as a DeviceInventory takes them'''
+        return {
+            (self._bootloader_idvendor, self._bootloader_idproduct): MODE_BOOTLOADER,
+            (self._peachy_idvendor, self._peachy_idproduct): MODE_PEACHY,
+        }
+
     @property
     def check_usb_command(self):
         raise NotImplementedError()
 
+    def list_devices(self):
+        '''A DeviceRecord for every attached bootloader and printer. Without an inventory only their ids and modes are known'''
+        if self.inventory is not None:
+            return self.inventory.devices(MODE_BOOTLOADER, MODE_PEACHY)
+        modes = self.device_modes
+        return [DeviceRecord(device, modes[device.idvendor, device.idproduct]) for device in self._scan_devices() if (device.idvendor, device.idproduct) in modes]
+
     def list_usb_devices(self):
+        '''(bootloaders, peachys) attached'''
+        if self.inventory is not None:
+            modes = [record.mode for record in self.list_devices()]
+            return (modes.count(MODE_BOOTLOADER), modes.count(MODE_PEACHY))
         process = Popen(self.check_usb_command, stdout=PIPE, stderr=PIPE)
         (out, err) = process.communicate()
         exit_code = process.wait()
@@ -38,12 +81,26 @@ class FirmwareUpdater(object):
             logger.error("Exit Code: {}".format(exit_code))
             raise Exception("Command failed")
         else:
-            peachys = out.count(self.peachy_usb_address)
-            bootloaders = out.count(self.bootloader_usb_address)
-            return (bootloaders, peachys)
+            return self._count_usb_devices(out)
+
+    def _count_usb_devices(self, out):
+        peachys = out.count(self.peachy_usb_address)
+        bootloaders = out.count(self.bootloader_usb_address)
+        return (bootloaders, peachys)
+
+    def _timed(self, operation, function, *args):
+        if self.metrics is None:
+            return function(*args)
+        started = time.time()
+        try:
+            return function(*args)
+        finally:
+            self.metrics.observe(operation, self, time.time() - started)
 
     def check_ready(self):
-        bootloaders, peachy_printers = self.list_usb_devices()
+        return self._is_ready(*self._timed(ENUMERATION, self.list_usb_devices))
+
+    def _is_ready(self, bootloaders, peachy_printers):
         if (bootloaders == 1) and (peachy_printers == 0):
             return True
         elif (bootloaders == 0) and (peachy_printers <= 1):
@@ -52,46 +109,513 @@ class FirmwareUpdater(object):
             logger.error("{0} peachy printers and {1} bootloaders found".format(peachy_printers, bootloaders))
             raise Exception("{0} peachy printers and {1} bootloaders found".format(peachy_printers, bootloaders))
 
-    def update(self, firmware_path):
+    def list_bootloaders(self):
+        '''Returns a UsbDevice for every attached bootloader'''
+        if self.inventory is None:
+            raise NotImplementedError()
+        return [record.device for record in self.inventory.devices(MODE_BOOTLOADER)]
+
+    def _scan_devices(self):
+        if self.inventory is not None:
+            return [record.device for record in self.list_devices()]
+        bootloaders, peachys = self.list_usb_devices()
+        return ([UsbDevice(self._bootloader_idvendor, self._bootloader_idproduct, devnum=index) for index in range(bootloaders)] +
+                [UsbDevice(self._peachy_idvendor, self._peachy_idproduct, devnum=index) for index in range(peachys)])
+
+    def _open_event_source(self):
+        if self.event_source_factory is not None:
+            return self.event_source_factory()
+        return open_event_source(scan=self._scan_devices)
+
+    def _find(self, idvendor, idproduct):
+        for device in self._scan_devices():
+            if (device.idvendor, device.idproduct) == (idvendor, idproduct):
+                return device
+        return None
+
+    def _attached(self, event):
+        '''The UsbDevice an add event announced as a scan reads it, with the serial the event does not carry'''
+        for device in self._scan_devices():
+            if (device.idvendor, device.idproduct, device.port_path) == (event.idvendor, event.idproduct, event.port_path):
+                return device
+        return UsbDevice(event.idvendor, event.idproduct, port_path=event.port_path)
+
+    def _wait_on(self, source, idvendor, idproduct, timeout):
+        deadline = time.time() + timeout
+        device = self._find(idvendor, idproduct)
+        if device is not None:
+            return device
+        remaining = timeout
+        while remaining > 0:
+            for event in source.events(remaining):
+                if event.action == 'add' and (event.idvendor, event.idproduct) == (idvendor, idproduct):
+                    return self._attached(event)
+            remaining = deadline - time.time()
+        return None
+
+    def _wait_for(self, idvendor, idproduct, timeout):
+        # The event source is opened before looking so a device arriving in between is not missed
+        source = self._open_event_source()
+        try:
+            return self._wait_on(source, idvendor, idproduct, timeout)
+        finally:
+            source.close()
+
+    def wait_for_bootloader(self, timeout):
+        '''Blocks until a bootloader is attached, returning its UsbDevice or None after timeout seconds'''
+        return self._wait_for(self._bootloader_idvendor, self._bootloader_idproduct, timeout)
+
+    def wait_for_peachy(self, timeout):
+        '''Blocks until a peachy printer is attached, returning its UsbDevice or None after timeout seconds'''
+        return self._wait_for(self._peachy_idvendor, self._peachy_idproduct, timeout)
+
+    def _prepare_image(self, firmware_path, address=DEFAULT_ADDRESS):
+        '''Returns (path, start address) of a validated raw binary for firmware_path when there is an image_cache'''
+        if self.image_cache is None:
+            return firmware_path, address
+        return self.image_cache.prepare(firmware_path, address)
+
+    def update(self, firmware_path, device=None, progress_callback=None):
+        '''Flashes firmware_path returning an UpdateResult, progress_callback receives ProgressEvents as it runs'''
         raise NotImplementedError()
 
+    def _run_steps(self, steps):
+        '''Runs the commands of an updater's _update_steps as they are yielded, returning the UpdateResult it ends with'''
+        step = next(steps)
+        while not isinstance(step, UpdateResult):
+            command, on_line = step
+            process = Popen(command, stdout=PIPE, stderr=PIPE)
+            (out, err, stalled) = stream_process(process, on_line or (lambda line: None), self.stall_timeout)
+            step = steps.send((process.wait(), out, err, stalled))
+        return step
+
+    def update_plan(self, plan, device=None, progress_callback=None, leave=True):
+        '''Writes every segment of a FlashPlan in one bootloader session, returning an UpdateResult.
+
+        leave: have the bootloader start the firmware once, after everything is written, rather than stay in DFU mode'''
+        raise NotImplementedError()
+
+    def update_and_leave(self, firmware_path, device=None, progress_callback=None):
+        '''Flashes firmware_path like update and then has the bootloader start the firmware, for updaters that would
+        otherwise stay in DFU mode'''
+        return self.update(firmware_path, device=device, progress_callback=progress_callback)
+
+    def flash_cycle(self, firmware_path, enter_bootloader=None, timeout=60, progress_callback=None):
+        '''Switches the printer to its bootloader, flashes firmware_path and waits for the printer to return.
+
+        enter_bootloader: called to switch the attached printer into its bootloader, without it the printer must be switched by hand
+        Returns a CycleResult timing each stage, failing at the first stage not finished within timeout seconds of starting'''
+        result = self._flash_cycle(firmware_path, enter_bootloader, timeout, progress_callback)
+        if self.metrics is not None:
+            self.metrics.record_cycle(self, firmware_path, result)
+        return result
+
+    def _flash_cycle(self, firmware_path, enter_bootloader, timeout, progress_callback):
+        stages = OrderedDict()
+        deadline = time.time() + timeout
+        # One event source watches the whole cycle so neither re-enumeration can be missed
+        source = self._open_event_source()
+        try:
+            stage_started = [time.time()]
+
+            def finish(stage):
+                now = time.time()
+                stages[stage] = now - stage_started[0]
+                stage_started[0] = now
+
+            bootloader = self._timed(ENUMERATION, self._find, self._bootloader_idvendor, self._bootloader_idproduct)
+            if bootloader is None and enter_bootloader is not None:
+                enter_bootloader()
+            finish(STAGE_ENTER_BOOTLOADER)
+            if bootloader is None:
+                bootloader = self._wait_on(source, self._bootloader_idvendor, self._bootloader_idproduct, deadline - time.time())
+            finish(STAGE_BOOTLOADER_ENUMERATION)
+            if bootloader is None:
+                logger.error("Bootloader did not appear within {} seconds".format(timeout))
+                return CycleResult(False, stages, error="Bootloader did not appear")
+
+            update = self.update_and_leave(firmware_path, progress_callback=progress_callback)
+            finish(STAGE_FLASH)
+            if not update:
+                return CycleResult(False, stages, update, error=update.error or "Update failed")
+
+            peachy = self._wait_on(source, self._peachy_idvendor, self._peachy_idproduct, deadline - time.time())
+            finish(STAGE_PEACHY_ENUMERATION)
+            if peachy is None:
+                logger.error("Peachy did not return within {} seconds".format(timeout))
+                return CycleResult(False, stages, update, error="Peachy did not return after flashing")
+            return CycleResult(True, stages, update, peachy)
+        finally:
+            source.close()
+
 
 class LinuxFirmwareUpdater(FirmwareUpdater):
+    def __init__(self, dependancy_path, bootloader_idvendor, bootloader_idproduct, peachy_idvendor, peachy_idproduct, usb_enumerator=None):
+        super(LinuxFirmwareUpdater, self).__init__(dependancy_path, bootloader_idvendor, bootloader_idproduct, peachy_idvendor, peachy_idproduct)
+        self.usb_enumerator = usb_enumerator
+        self._dfu_bin = None
+        # Bytes per DFU block passed to dfu-util, None leaves it to the device's descriptor
+        self.transfer_size = None
+        # Read the image back after writing it; when leaving, the read back is what leaves so the device leaves either way
+        self.verify = False
+        # dfu-util can select devices by port path, which the preflight finds the bundled linux build cannot
+        self.port_paths = False
 
     @property
     def check_usb_command(self):
         return ['lsusb']
 
+    def list_usb_devices(self):
+        if self.usb_enumerator is None or self.inventory is not None:
+            return super(LinuxFirmwareUpdater, self).list_usb_devices()
+        bootloaders = len(self.usb_enumerator.find(self._bootloader_idvendor, self._bootloader_idproduct))
+        peachys = len(self.usb_enumerator.find(self._peachy_idvendor, self._peachy_idproduct))
+        return (bootloaders, peachys)
+
+    def _scan_devices(self):
+        if self.usb_enumerator is None or self.inventory is not None:
+            return super(LinuxFirmwareUpdater, self)._scan_devices()
+        return self.usb_enumerator.scan()
+
+    def _open_event_source(self):
+        if self.event_source_factory is None and self.usb_enumerator is not None:
+            return open_event_source(enumerator=self.usb_enumerator)
+        return super(LinuxFirmwareUpdater, self)._open_event_source()
 
     @property
     def dfu_bin(self):
-        bin_file = os.path.join(self.dependancy_path, 'dfu-util')
-        if os.path.isfile(bin_file):
-            st = os.stat(bin_file)
-            os.chmod(bin_file, st.st_mode | stat.S_IEXEC)
-            return os.path.join(self.dependancy_path, 'dfu-util')
-        else:
-            if self._logger:
-                self._logger.error("Binary at {} missing.".format(bin_file))
-            raise Exception("Binary at {} missing.".format(bin_file))
-
-    def update(self, firmware_path):
-            process = Popen([
-                self.dfu_bin,
-                '-a', '0',
-                '--dfuse-address', '0x08000000',
-                '-D', firmware_path,
-                '-d', self.bootloader_usb_address
-            ], stdout=PIPE, stderr=PIPE)
-            (out, err) = process.communicate()
-            exit_code = process.wait()
-            if exit_code != 0:
-                logger.error("Output: {}".format(out))
-                logger.error("Error: {}".format(err))
-                logger.error("Exit Code: {}".format(exit_code))
+        if self._dfu_bin is None:
+            self._dfu_bin = executable(os.path.join(self.dependancy_path, 'dfu-util'))
+        return self._dfu_bin
+
+    def list_bootloaders(self):
+        if self.inventory is not None:
+            return super(LinuxFirmwareUpdater, self).list_bootloaders()
+        if self.usb_enumerator is not None:
+            return self.usb_enumerator.find(self._bootloader_idvendor, self._bootloader_idproduct)
+        process = Popen(self._list_bootloaders_command(), stdout=PIPE, stderr=PIPE)
+        (out, err) = process.communicate()
+        exit_code = process.wait()
+        if exit_code != 0:
+            logger.error("Output: {}".format(out))
+            logger.error("Error: {}".format(err))
+            logger.error("Exit Code: {}".format(exit_code))
+            raise Exception("Command failed")
+        if isinstance(out, bytes):
+            out = out.decode('utf-8', 'replace')
+        return parse_dfu_util_list(out, self._bootloader_idvendor, self._bootloader_idproduct)
+
+    def _list_bootloaders_command(self):
+        return [self.dfu_bin, '-l', '-d', self.bootloader_usb_address]
+
+    def _selection_error(self, device):
+        '''Why dfu-util cannot be pointed at device, None when it can'''
+        if device is None or device.serial or (device.port_path and self.port_paths):
+            return None
+        return "Device {} has no serial, and this dfu-util cannot select it by path".format(device)
+
+    def _device_selector(self, device):
+        '''Selects by serial, which every dfu-util supports, before port path, which builds without path support exit on'''
+        error = self._selection_error(device)
+        if error:
+            raise Exception(error)
+        if device is None:
+            return []
+        if device.serial:
+            return ['-S', device.serial]
+        return ['-p', device.port_path]
+
+    def _update_command(self, firmware_path, address, device=None, leave=False):
+        return [
+            self.dfu_bin,
+            '-a', '0',
+            '--dfuse-address', '0x{0:08x}{1}'.format(address, ':leave' if leave else ''),
+            '-D', firmware_path,
+            '-d', self.bootloader_usb_address
+        ] + (['-t', str(self.transfer_size)] if self.transfer_size else []) + self._device_selector(device)
+
+    def _upload_command(self, upload_path, address, length, device=None, leave=False):
+        return [
+            self.dfu_bin,
+            '-a', '0',
+            '--dfuse-address', '0x{0:08x}:{1}{2}'.format(address, length, ':leave' if leave else ''),
+            '-U', upload_path,
+            '-d', self.bootloader_usb_address
+        ] + (['-t', str(self.transfer_size)] if self.transfer_size else []) + self._device_selector(device)
+
+    def _matches(self, upload_path, digest):
+        with open(upload_path, 'rb') as upload:
+            if not digest.matches(iter(lambda: upload.read(CHUNK_SIZE), b'')):
+                logger.error("Flash does not match {}".format(digest))
                 return False
+        return True
+
+    def _update_steps(self, firmware_path, device, tracker, leave=False):
+        '''An update as a generator, so update() and AsyncFirmwareUpdater flash, verify and leave alike while each starts
+        dfu-util its own way. Yields (command, on_line) for each dfu-util run, on_line taking its output lines or None,
+        and is sent (exit_code, out, err, stalled) back; the UpdateResult is yielded last.
+
+        When verifying, the image's range is read back and checked against the image; when also leaving, the read back
+        is what leaves so the device leaves either way'''
+        parser = DfuUtilOutputParser(tracker)
+        selection_error = self._selection_error(device)
+        if selection_error:
+            logger.error(selection_error)
+            yield UpdateResult(False, phases=tracker.finish(), error=selection_error)
+            return
+        try:
+            firmware_path, address = self._prepare_image(firmware_path)
+        except (ImageError, IOError, OSError) as e:
+            logger.error("Invalid firmware image {}: {}".format(firmware_path, e))
+            yield UpdateResult(False, phases=tracker.finish(), error=str(e))
+            return
+        (exit_code, out, err, stalled) = yield (self._update_command(firmware_path, address, device, leave and not self.verify), parser.feed)
+        if exit_code != 0 or stalled:
+            logger.error("Output: {}".format(out))
+            logger.error("Error: {}".format(err))
+            logger.error("Exit Code: {}".format(exit_code))
+            yield UpdateResult(False, exit_code, tracker.finish(), out, err)
+            return
+        error = None
+        if self.verify:
+            tracker.update(PHASE_VERIFY)
+            with load_image(firmware_path, address) as image:
+                digest = ImageDigest.compute(image.start, image.to_bin())
+            upload_dir = tempfile.mkdtemp()
+            try:
+                upload_path = os.path.join(upload_dir, 'upload.bin')
+                (upload_exit_code, upload_out, upload_err, stalled) = yield (self._upload_command(upload_path, digest.address, digest.length, device, leave), None)
+                if upload_exit_code != 0 or stalled:
+                    logger.error("Output: {}".format(upload_out))
+                    logger.error("Error: {}".format(upload_err))
+                    logger.error("Exit Code: {}".format(upload_exit_code))
+                    error = "Reading back the flash failed"
+                elif not self._matches(upload_path, digest):
+                    error = "Flash does not match the image"
+            finally:
+                shutil.rmtree(upload_dir)
+        if error:
+            yield UpdateResult(False, exit_code, tracker.finish(), out, error)
+        else:
+            yield UpdateResult(True, exit_code, tracker.finish(), out, err)
+
+    def update_and_leave(self, firmware_path, device=None, progress_callback=None):
+        return self.update(firmware_path, device=device, progress_callback=progress_callback, leave=True)
+
+    def _plan_command(self, plan_path, alt, device=None):
+        return [
+            self.dfu_bin,
+            '-a', str(alt),
+            '-D', plan_path,
+            '-d', self.bootloader_usb_address
+        ] + (['-t', str(self.transfer_size)] if self.transfer_size else []) + self._device_selector(device)
+
+    @instrumented
+    def update_plan(self, plan, device=None, progress_callback=None, leave=True):
+        '''dfu-util downloads only the DfuSe target matching the alt setting it is given, so the plan is written as a
+        DfuSe file per alt setting, one dfu-util run each, without the bootloader re-enumerating in between.
+        Leaving is a final read of the firmware's first word with :leave, so the device starts at the firmware'''
+        tracker = ProgressTracker(progress_callback)
+        parser = DfuUtilOutputParser(tracker)
+        try:
+            plan.validate()
+        except ImageError as e:
+            logger.error("Invalid flash plan: {}".format(e))
+            return UpdateResult(False, phases=tracker.finish(), error=str(e))
+        selection_error = self._selection_error(device)
+        if selection_error:
+            logger.error(selection_error)
+            return UpdateResult(False, phases=tracker.finish(), error=selection_error)
+        plan_dir = tempfile.mkdtemp()
+        try:
+            commands = []
+            for alt, segments in plan.by_alt().items():
+                plan_path = os.path.join(plan_dir, 'plan-{}.dfu'.format(alt))
+                with open(plan_path, 'wb') as plan_file:
+                    plan_file.write(FirmwareImage(segments).to_dfuse(self._bootloader_idvendor, self._bootloader_idproduct))
+                commands.append(self._plan_command(plan_path, alt, device))
+            if leave:
+                start = plan.start if plan.start is not None else DEFAULT_ADDRESS
+                commands.append(self._upload_command(os.path.join(plan_dir, 'leave.bin'), start, 4, device, leave=True))
+            for command in commands:
+                process = Popen(command, stdout=PIPE, stderr=PIPE)
+                (out, err, stalled) = stream_process(process, parser.feed, self.stall_timeout)
+                exit_code = process.wait()
+                if exit_code != 0 or stalled:
+                    logger.error("Output: {}".format(out))
+                    logger.error("Error: {}".format(err))
+                    logger.error("Exit Code: {}".format(exit_code))
+                    return UpdateResult(False, exit_code, tracker.finish(), out, err)
+            return UpdateResult(True, exit_code, tracker.finish(), out, err)
+        finally:
+            shutil.rmtree(plan_dir)
+
+    @instrumented
+    def update(self, firmware_path, device=None, progress_callback=None, leave=False):
+        return self._run_steps(self._update_steps(firmware_path, device, ProgressTracker(progress_callback), leave))
+
+
+class LibUsbFirmwareUpdater(FirmwareUpdater):
+    '''Flashes in process over libusb using the DfuSe protocol rather than starting dfu-util.
+
+    differential: read back the flash and only erase and write sectors that differ
+    hash_store: an ImageHashStore letting differential updates skip devices already holding the image, by serial number
+    retry_policy: a RetryPolicy to resume transfers after transient errors and verify them, None to fail at the first error
+    profiles: a ProfileStore whose tuned transfer size and poll interval for the bootloader replace transfer_size and poll_interval
+    autotune: tune a bootloader that has no profile yet before flashing it, needs profiles
+    verify: read the image back before leaving DFU mode, checking its CRC32 and SHA-256
+    verify_sample: with verify, check only this many sectors picked at random'''
+
+    def __init__(self, dependancy_path, bootloader_idvendor, bootloader_idproduct, peachy_idvendor, peachy_idproduct,
+                 transfer_size=DEFAULT_TRANSFER_SIZE, poll_interval=None, transport_factory=None):
+        # Modules only the libusb updater uses are imported here, keeping them out of dfu-util startup
+        from .tuning import Autotuner
+        super(LibUsbFirmwareUpdater, self).__init__(dependancy_path, bootloader_idvendor, bootloader_idproduct, peachy_idvendor, peachy_idproduct)
+        self.transfer_size = transfer_size
+        self.poll_interval = poll_interval
+        self.differential = False
+        self.hash_store = None
+        self.retry_policy = None
+        self.profiles = None
+        self.autotune = False
+        self.autotuner = Autotuner()
+        self.verify = False
+        self.verify_sample = None
+        if transport_factory is None:
+            transport_factory = lambda device: PyUsbTransport.open(self._bootloader_idvendor, self._bootloader_idproduct, device=device)
+        self._transport_factory = transport_factory
+
+    def list_usb_devices(self):
+        if self.inventory is not None:
+            return super(LibUsbFirmwareUpdater, self).list_usb_devices()
+        bootloaders = PyUsbTransport.count(self._bootloader_idvendor, self._bootloader_idproduct)
+        peachys = PyUsbTransport.count(self._peachy_idvendor, self._peachy_idproduct)
+        return (bootloaders, peachys)
+
+    def list_bootloaders(self):
+        if self.inventory is not None:
+            return super(LibUsbFirmwareUpdater, self).list_bootloaders()
+        return PyUsbTransport.list(self._bootloader_idvendor, self._bootloader_idproduct)
+
+    def _layout(self, transport):
+        try:
+            return MemoryLayout.parse(transport.interface_name)
+        except DfuError as e:
+            logger.warning("Memory layout unavailable, using mass erase: {}".format(e))
+            return None
+
+    def _profile_key(self, transport):
+        from .tuning import profile_key
+        return profile_key(self._bootloader_idvendor, self._bootloader_idproduct, getattr(transport, 'bcd_device', None))
+
+    def _engine(self, transport, layout, address):
+        '''A DfuSeEngine using the bootloader's profile, tuning it first if there is none and autotune is on'''
+        profile = None
+        if self.profiles is not None:
+            key = self._profile_key(transport)
+            profile = self.profiles.get(key)
+            if profile is None and self.autotune and layout is not None:
+                profile = self.autotuner.tune(transport, layout, address)
+                self.profiles.set(key, profile)
+        if profile is None:
+            return DfuSeEngine(transport, transfer_size=self.transfer_size, poll_interval=self.poll_interval)
+        return DfuSeEngine(transport, transfer_size=profile.transfer_size, poll_interval=profile.poll_interval)
+
+    def tune(self, device=None, address=DEFAULT_ADDRESS):
+        '''Finds the fastest reliable settings for the attached bootloader, saving them to profiles when set.
+
+        Tuning writes trial data at address so the device must be flashed afterwards. Returns the TuningProfile'''
+        transport = self._transport_factory(device)
+        try:
+            layout = self._layout(transport)
+            profile = self.autotuner.tune(transport, layout, address)
+            if self.profiles is not None:
+                self.profiles.set(self._profile_key(transport), profile)
+            return profile
+        finally:
+            transport.close()
+
+    @instrumented
+    def update_plan(self, plan, device=None, progress_callback=None, leave=True):
+        from .plan import PlanFlasher
+        tracker = ProgressTracker(progress_callback)
+        try:
+            plan.validate()
+        except ImageError as e:
+            logger.error("Invalid flash plan: {}".format(e))
+            return UpdateResult(False, phases=tracker.finish(), error=str(e))
+        try:
+            transport = self._transport_factory(device)
+        except (DfuError, IOError, OSError) as e:
+            logger.error("Could not open bootloader: {}".format(e))
+            return UpdateResult(False, phases=tracker.finish(), error=str(e))
+        try:
+            # Without firmware in the plan there is nowhere tuning may write, so only a saved profile is used
+            layout = self._layout(transport) if plan.start is not None else None
+            engine = self._engine(transport, layout, plan.start)
+            PlanFlasher(engine, self.verify, self.verify_sample).flash(plan, tracker.update)
+            if leave:
+                tracker.update(PHASE_MANIFEST)
+                transport.set_alternate(0)
+                engine.leave(plan.start if plan.start is not None else DEFAULT_ADDRESS)
+            return UpdateResult(True, phases=tracker.finish())
+        except (DfuError, IOError, OSError) as e:
+            logger.error("Flash plan failed: {}".format(e))
+            return UpdateResult(False, phases=tracker.finish(), error=str(e))
+        finally:
+            transport.close()
+
+    @instrumented
+    def update(self, firmware_path, device=None, progress_callback=None, address=DEFAULT_ADDRESS):
+        from .differential import DifferentialFlasher
+        from .resumable import ResumableDownloader
+        tracker = ProgressTracker(progress_callback)
+        try:
+            image = load_image(*self._prepare_image(firmware_path, address))
+            image.validate()
+        except (ImageError, IOError, OSError) as e:
+            logger.error("Invalid firmware image {}: {}".format(firmware_path, e))
+            return UpdateResult(False, phases=tracker.finish(), error=str(e))
+        data, address = image.to_bin(), image.start
+        try:
+            transport = self._transport_factory(device)
+        except (DfuError, IOError, OSError) as e:
+            image.close()
+            logger.error("Could not open bootloader: {}".format(e))
+            return UpdateResult(False, phases=tracker.finish(), error=str(e))
+        try:
+            layout = self._layout(transport)
+            engine = self._engine(transport, layout, address)
+            digest = ImageDigest.compute(address, data, layout) if self.verify else None
+            retries = 0
+            if self.differential and layout is not None:
+                flasher = DifferentialFlasher(engine, layout, self.hash_store)
+                serial = device.serial if device is not None else getattr(transport, 'serial', None)
+                result = flasher.flash(address, data, serial, tracker.update)
+                logger.info("Wrote {} sectors, {} unchanged".format(len(result.written), len(result.skipped)))
+            elif self.retry_policy is not None and layout is not None:
+                report = ResumableDownloader(engine, layout, self.retry_policy).download(address, data, tracker.update)
+                retries = report.retries
+                if report.retries:
+                    logger.info("Recovered from {} transient errors, rewrote {} sectors".format(report.retries, len(report.rewritten_sectors)))
             else:
-                return True
+                engine.download(address, data, layout, tracker.update)
+            if digest is not None:
+                verified = FlashVerifier(engine, self.verify_sample).verify(digest, tracker.update)
+                if not verified.success:
+                    ranges = ', '.join('0x{0:08x}+{1}'.format(start, length) for start, length in verified.mismatched_ranges)
+                    logger.error("Flash does not match the image: {}".format(ranges or 'digest differs'))
+                    return UpdateResult(False, phases=tracker.finish(), error="Flash does not match the image", retries=retries)
+            tracker.update(PHASE_MANIFEST)
+            engine.leave(address)
+            return UpdateResult(True, phases=tracker.finish(), retries=retries)
+        except (DfuError, IOError, OSError) as e:
+            logger.error("Firmware download failed: {}".format(e))
+            return UpdateResult(False, phases=tracker.finish(), error=str(e))
+        finally:
+            del data
+            image.close()
+            transport.close()
 
 
 class MacFirmwareUpdater(LinuxFirmwareUpdater):
@@ -129,20 +653,22 @@ class WindowsFirmwareUpdater(FirmwareUpdater):
     def dfu_bin(self):
         return os.path.join(self.dependancy_path, 'DfuSeCommand.exe')
 
-    def update(self, firmware_path):
-        process = Popen([
-            self.dfu_bin,
-            '-c', '-d', '--fn', firmware_path], stdout=PIPE, stderr=PIPE)
-        (out, err) = process.communicate()
-        exit_code = process.wait()
-        if exit_code != 0:
-            if self._logger:
-                self._logger.error("Output: {}".format(out))
-                self._logger.error("Error: {}".format(err))
-                self._logger.error("Exit Code: {}".format(exit_code))
-            return False
-        else:
-            return True
-
+    def _update_command(self, firmware_path, address=None, device=None):
+        if device is not None:
+            raise Exception("DfuSeCommand cannot select between multiple bootloaders")
+        return [self.dfu_bin, '-c', '-d', '--fn', firmware_path]
 
+    def _update_steps(self, firmware_path, device, tracker, leave=False):
+        '''DfuSeCommand is run once, see LinuxFirmwareUpdater._update_steps'''
+        (exit_code, out, err, stalled) = yield (self._update_command(firmware_path, device=device), None)
+        if exit_code != 0 or stalled:
+            logger.error("Output: {}".format(out))
+            logger.error("Error: {}".format(err))
+            logger.error("Exit Code: {}".format(exit_code))
+            yield UpdateResult(False, exit_code, tracker.finish(), out, err)
+        else:
+            yield UpdateResult(True, exit_code, tracker.finish(), out, err)
 
+    @instrumented
+    def update(self, firmware_path, device=None, progress_callback=None):
+        return self._run_steps(self._update_steps(firmware_path, device, ProgressTracker(progress_callback)))
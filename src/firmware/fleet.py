@@ -0,0 +1,110 @@
+import os
+import re
+import time
+import errno
+import tempfile
+import logging
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+logger = logging.getLogger('peachy')
+
+FlashResult = namedtuple('FlashResult', 'device success duration error')
+
+
+class DeviceBusyError(Exception):
+    pass
+
+
+class DeviceLock(object):
+    '''Exclusive lock on a single device shared between processes, backed by a lock file'''
+
+    def __init__(self, device, lock_dir=None, timeout=0, poll_interval=0.05):
+        lock_dir = lock_dir or tempfile.gettempdir()
+        self.path = os.path.join(lock_dir, 'peachy-flash-{}.lock'.format(re.sub(r'[^\w.-]', '_', device.key)))
+        self.device = device
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self._fd = None
+
+    def _try_lock(self):
+        try:
+            if fcntl:
+                fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                msvcrt.locking(self._fd, msvcrt.LK_NBLCK, 1)
+            return True
+        except (IOError, OSError) as e:
+            if e.errno in (errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK):
+                return False
+            raise
+
+    def acquire(self):
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+        deadline = time.time() + self.timeout
+        while not self._try_lock():
+            if time.time() >= deadline:
+                os.close(self._fd)
+                self._fd = None
+                raise DeviceBusyError("Device {} is locked by another process".format(self.device.key))
+            time.sleep(self.poll_interval)
+
+    def release(self):
+        if self._fd is None:
+            return
+        if fcntl:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        else:
+            msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+        os.close(self._fd)
+        self._fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class FleetUpdater(object):
+    '''Flashes every attached bootloader concurrently on a bounded pool of workers'''
+
+    def __init__(self, updater, max_workers=4, lock_dir=None, lock_timeout=0):
+        self._updater = updater
+        self.max_workers = max_workers
+        self.lock_dir = lock_dir
+        self.lock_timeout = lock_timeout
+
+    def list_bootloaders(self):
+        return self._updater.list_bootloaders()
+
+    def _flash(self, firmware_path, device):
+        start = time.time()
+        try:
+            with DeviceLock(device, self.lock_dir, self.lock_timeout):
+                success = bool(self._updater.update(firmware_path, device=device))
+            error = None if success else "Update failed"
+        except Exception as e:
+            logger.error("Flashing {} failed: {}".format(device.key, e))
+            success, error = False, str(e)
+        return FlashResult(device, success, time.time() - start, error)
+
+    def update_all(self, firmware_path, devices=None):
+        '''Flashes devices (default: all attached bootloaders) returning a FlashResult per device'''
+        if devices is None:
+            devices = self.list_bootloaders()
+        if not devices:
+            return []
+        pool = ThreadPool(min(self.max_workers, len(devices)))
+        try:
+            return pool.map(lambda device: self._flash(firmware_path, device), devices, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
@@ -0,0 +1,157 @@
+import os
+import time
+import errno
+import struct
+import select
+import socket
+import logging
+from collections import namedtuple
+
+logger = logging.getLogger('peachy')
+
+HotplugEvent = namedtuple('HotplugEvent', 'action idvendor idproduct port_path')
+
+
+class UeventSource(object):
+    '''Usb hotplug events over a netlink uevent socket.
+
+    Events are udev's when it is running, sent once its rules have run so device permissions are applied by the time
+    a device is announced. Without udev they are the kernel's, which can arrive before the device can be opened.'''
+    NETLINK_KOBJECT_UEVENT = 15
+    KERNEL_GROUP = 1
+    UDEV_GROUP = 2
+    UDEV_CONTROL = '/run/udev/control'
+    # udev's messages start with this and a big endian magic, followed by where in the message the properties are
+    UDEV_PREFIX = b'libudev\0'
+    UDEV_MAGIC = 0xfeedcafe
+
+    def __init__(self, sock=None, group=None):
+        if sock is None:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, self.NETLINK_KOBJECT_UEVENT)
+            sock.bind((0, self.default_group() if group is None else group))
+        # Another reader can take a message select reported, so recv must not wait for the next one
+        sock.setblocking(False)
+        self._socket = sock
+
+    @classmethod
+    def available(cls):
+        return hasattr(socket, 'AF_NETLINK')
+
+    @classmethod
+    def default_group(cls):
+        '''The udev group when udev is running, otherwise the kernel's'''
+        return cls.UDEV_GROUP if os.path.exists(cls.UDEV_CONTROL) else cls.KERNEL_GROUP
+
+    @classmethod
+    def _properties(cls, message):
+        if message.startswith(cls.UDEV_PREFIX):
+            if len(message) < 24 or struct.unpack('>I', message[8:12])[0] != cls.UDEV_MAGIC:
+                return []
+            offset, length = struct.unpack('=II', message[16:24])
+            return message[offset:offset + length].split(b'\0')
+        # The kernel's start with action@devpath
+        return message.split(b'\0')[1:]
+
+    @classmethod
+    def parse(cls, message):
+        fields = cls._properties(message)
+        properties = dict(field.decode('ascii', 'replace').split('=', 1) for field in fields if b'=' in field)
+        if properties.get('SUBSYSTEM') != 'usb' or properties.get('DEVTYPE') != 'usb_device':
+            return None
+        product = properties.get('PRODUCT', '').split('/')
+        if len(product) < 2:
+            return None
+        port_path = os.path.basename(properties.get('DEVPATH', '')) or None
+        return HotplugEvent(properties.get('ACTION'), int(product[0], 16), int(product[1], 16), port_path)
+
+    def events(self, timeout):
+        '''Every event waiting, once one message has arrived within timeout seconds. Messages for interfaces and other
+        devices, and any that cannot be parsed, are skipped so they never hide the events queued behind them'''
+        events = []
+        readable, _, _ = select.select([self._socket], [], [], max(timeout, 0))
+        while readable:
+            try:
+                message = self._socket.recv(65536)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            try:
+                event = self.parse(message)
+            except ValueError as e:
+                logger.debug("Skipping uevent that cannot be parsed: {}".format(e))
+                event = None
+            if event:
+                events.append(event)
+            readable, _, _ = select.select([self._socket], [], [], 0)
+        return events
+
+    def close(self):
+        self._socket.close()
+
+
+class PollingEventSource(object):
+    '''Produces hotplug events by diffing successive device listings.
+
+    scan: returns the currently attached UsbDevices'''
+
+    def __init__(self, scan, interval=0.1, sleep=time.sleep, clock=time.time):
+        self._scan = scan
+        self.interval = interval
+        self._sleep = sleep
+        self._clock = clock
+        self._known = set(scan())
+
+    def _diff(self, current):
+        events = [HotplugEvent('add', d.idvendor, d.idproduct, d.port_path) for d in current - self._known]
+        events += [HotplugEvent('remove', d.idvendor, d.idproduct, d.port_path) for d in self._known - current]
+        self._known = current
+        return events
+
+    def events(self, timeout):
+        deadline = self._clock() + max(timeout, 0)
+        while True:
+            self._sleep(max(min(self.interval, deadline - self._clock()), 0))
+            events = self._diff(set(self._scan()))
+            if events or self._clock() >= deadline:
+                return events
+
+    def close(self):
+        pass
+
+
+class SysfsPollSource(PollingEventSource):
+    '''Diffs the sysfs device directory listing, only reading attributes of new entries'''
+
+    def __init__(self, enumerator, interval=0.05, sleep=time.sleep, clock=time.time):
+        self._enumerator = enumerator
+        self._devices = {}
+        super(SysfsPollSource, self).__init__(self._scan_sysfs, interval, sleep, clock)
+
+    def _scan_sysfs(self):
+        try:
+            names = set(name for name in os.listdir(self._enumerator.root) if ':' not in name)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            names = set()
+        for name in names - set(self._devices):
+            # attributes can still be missing just after the directory appears, so retry next poll
+            device = self._enumerator.read_device(name)
+            if device is not None:
+                self._devices[name] = device
+        for name in set(self._devices) - names:
+            del self._devices[name]
+        return list(self._devices.values())
+
+
+def open_event_source(enumerator=None, scan=None):
+    '''Opens the cheapest available event source: netlink uevents, sysfs polling or polling scan'''
+    if enumerator is not None:
+        if UeventSource.available():
+            try:
+                return UeventSource()
+            except (socket.error, OSError) as e:
+                logger.info("Netlink uevents unavailable, polling sysfs: {}".format(e))
+        return SysfsPollSource(enumerator)
+    return PollingEventSource(scan)
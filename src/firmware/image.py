@@ -0,0 +1,378 @@
+import os
+import sys
+import mmap
+import zlib
+import struct
+import binascii
+import hashlib
+import logging
+import tempfile
+import threading
+
+from .dfu import DEFAULT_ADDRESS
+
+logger = logging.getLogger('peachy')
+
+DEFAULT_FLASH_RANGE = (0x08000000, 0x08100000)
+
+DFU_SUFFIX_LENGTH = 16
+DFU_SUFFIX_SIGNATURE = b'UFD'
+DFUSE_PREFIX_SIGNATURE = b'DfuSe'
+DFUSE_PREFIX_LENGTH = 11
+DFUSE_TARGET_SIGNATURE = b'Target'
+DFUSE_TARGET_PREFIX_LENGTH = 274
+DFUSE_ELEMENT_HEADER_LENGTH = 8
+
+HEX_DATA = 0x00
+HEX_END_OF_FILE = 0x01
+HEX_EXTENDED_SEGMENT_ADDRESS = 0x02
+HEX_START_SEGMENT_ADDRESS = 0x03
+HEX_EXTENDED_LINEAR_ADDRESS = 0x04
+HEX_START_LINEAR_ADDRESS = 0x05
+
+
+class ImageError(Exception):
+    pass
+
+
+def dfu_crc(data):
+    '''The DFU suffix CRC: CRC-32 without the final inversion'''
+    if sys.version_info[0] < 3 and isinstance(data, memoryview):
+        data = data.tobytes()
+    return (zlib.crc32(data) & 0xffffffff) ^ 0xffffffff
+
+
+class Segment(object):
+    '''A contiguous run of image data; data is a memoryview, into the mapped file where possible'''
+
+    def __init__(self, address, data, alt=0):
+        self.address = address
+        self.data = data
+        self.alt = alt
+
+    @property
+    def end(self):
+        return self.address + len(self.data)
+
+    def __repr__(self):
+        return "Segment(0x{0:08x}, {1} bytes, alt={2})".format(self.address, len(self.data), self.alt)
+
+
+class DfuSuffix(object):
+    def __init__(self, bcd_device=0xffff, idproduct=0xffff, idvendor=0xffff, bcd_dfu=0x011a):
+        self.bcd_device = bcd_device
+        self.idproduct = idproduct
+        self.idvendor = idvendor
+        self.bcd_dfu = bcd_dfu
+
+    @classmethod
+    def find(cls, data):
+        '''Returns the suffix at the end of data or None, raising if its CRC is wrong'''
+        data = memoryview(data)
+        if len(data) < DFU_SUFFIX_LENGTH:
+            return None
+        suffix = data[-DFU_SUFFIX_LENGTH:].tobytes()
+        if suffix[8:11] != DFU_SUFFIX_SIGNATURE or bytearray(suffix[11:12])[0] != DFU_SUFFIX_LENGTH:
+            return None
+        bcd_device, idproduct, idvendor, bcd_dfu = struct.unpack('<HHHH', suffix[:8])
+        crc = struct.unpack('<I', suffix[12:])[0]
+        if dfu_crc(data[:-4]) != crc:
+            raise ImageError("DFU suffix CRC mismatch")
+        return cls(bcd_device, idproduct, idvendor, bcd_dfu)
+
+    def pack(self, data):
+        suffix = struct.pack('<HHHH', self.bcd_device, self.idproduct, self.idvendor, self.bcd_dfu) + DFU_SUFFIX_SIGNATURE + struct.pack('<B', DFU_SUFFIX_LENGTH)
+        return suffix + struct.pack('<I', dfu_crc(bytes(data) + suffix))
+
+
+class FirmwareImage(object):
+    def __init__(self, segments, suffix=None, source=None):
+        self.segments = sorted(segments, key=lambda segment: (segment.alt, segment.address))
+        self.suffix = suffix
+        self._source = source
+
+    def close(self):
+        self.segments = []
+        if self._source is not None:
+            self._source.close()
+            self._source = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def start(self):
+        return min(segment.address for segment in self.segments)
+
+    @property
+    def end(self):
+        return max(segment.end for segment in self.segments)
+
+    @property
+    def size(self):
+        return sum(len(segment.data) for segment in self.segments)
+
+    def digest(self):
+        sha = hashlib.sha256()
+        for segment in self.segments:
+            sha.update(struct.pack('<BI', segment.alt, segment.address))
+            sha.update(segment.data)
+        return sha.hexdigest()
+
+    def validate(self, flash_range=DEFAULT_FLASH_RANGE):
+        '''Raises ImageError unless there is alt 0 data and every alt 0 segment lies inside flash_range (start, end)
+        without overlapping'''
+        if not self.segments or not self.size:
+            raise ImageError("Image is empty")
+        if not any(segment.alt == 0 and len(segment.data) for segment in self.segments):
+            raise ImageError("Image has nothing for the main flash, alt setting 0")
+        previous = None
+        for segment in self.segments:
+            if segment.alt != 0:
+                continue
+            if segment.address < flash_range[0] or segment.end > flash_range[1]:
+                raise ImageError("Segment 0x{0:08x}-0x{1:08x} outside of flash 0x{2:08x}-0x{3:08x}".format(segment.address, segment.end, flash_range[0], flash_range[1]))
+            if previous is not None and segment.address < previous.end:
+                raise ImageError("Segments overlap at 0x{0:08x}".format(segment.address))
+            previous = segment
+
+    def to_bin(self, fill=b'\xff'):
+        '''Returns the alt 0 segments as one contiguous block starting at self.start, gaps filled'''
+        segments = [segment for segment in self.segments if segment.alt == 0]
+        if not segments:
+            raise ImageError("Image has nothing for the main flash, alt setting 0")
+        if len(segments) == 1:
+            return segments[0].data
+        start = min(segment.address for segment in segments)
+        result = bytearray(fill * (max(segment.end for segment in segments) - start))
+        for segment in segments:
+            result[segment.address - start:segment.end - start] = segment.data
+        return memoryview(result)
+
+    def to_hex(self, record_size=16):
+        '''Returns the alt 0 segments as Intel HEX text'''
+        lines = []
+        upper = None
+        for segment in self.segments:
+            if segment.alt != 0:
+                continue
+            offset = 0
+            while offset < len(segment.data):
+                address = segment.address + offset
+                if address >> 16 != upper:
+                    upper = address >> 16
+                    lines.append(_hex_record(HEX_EXTENDED_LINEAR_ADDRESS, 0, struct.pack('>H', upper)))
+                length = min(record_size, len(segment.data) - offset, 0x10000 - (address & 0xffff))
+                lines.append(_hex_record(HEX_DATA, address & 0xffff, segment.data[offset:offset + length].tobytes()))
+                offset += length
+        lines.append(_hex_record(HEX_END_OF_FILE, 0, b''))
+        return '\n'.join(lines) + '\n'
+
+    def to_dfuse(self, idvendor=0xffff, idproduct=0xffff, bcd_device=0xffff, target_name=b'ST...'):
+        targets = b''
+        alts = sorted(set(segment.alt for segment in self.segments))
+        for alt in alts:
+            elements = b''
+            segments = [segment for segment in self.segments if segment.alt == alt]
+            for segment in segments:
+                elements += struct.pack('<II', segment.address, len(segment.data)) + segment.data.tobytes()
+            name = target_name[:255].ljust(255, b'\0')
+            targets += DFUSE_TARGET_SIGNATURE + struct.pack('<BI', alt, 1) + name + struct.pack('<II', len(elements), len(segments)) + elements
+        body = DFUSE_PREFIX_SIGNATURE + struct.pack('<BIB', 1, DFUSE_PREFIX_LENGTH + len(targets), len(alts)) + targets
+        return body + DfuSuffix(bcd_device, idproduct, idvendor).pack(body)
+
+
+def _hex_record(record_type, address, data):
+    record = struct.pack('>BHB', len(data), address, record_type) + data
+    checksum = (-sum(bytearray(record))) & 0xff
+    return ':' + binascii.hexlify(record + struct.pack('B', checksum)).decode('ascii').upper()
+
+
+def parse_hex(text):
+    segments = []
+    base = 0
+    current_address, current = None, None
+    for number, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line:
+            continue
+        if not line.startswith(':'):
+            raise ImageError("Line {} is not an Intel HEX record".format(number))
+        try:
+            record = bytearray(binascii.unhexlify(line[1:]))
+        except (TypeError, ValueError, binascii.Error):
+            raise ImageError("Line {} is not valid hex".format(number))
+        if len(record) < 5 or len(record) != record[0] + 5:
+            raise ImageError("Line {} has the wrong length".format(number))
+        if sum(record) & 0xff:
+            raise ImageError("Line {} checksum mismatch".format(number))
+        length, address, record_type = record[0], (record[1] << 8) | record[2], record[3]
+        data = record[4:4 + length]
+        if record_type == HEX_DATA:
+            address += base
+            if current is not None and address == current_address + len(current):
+                current += data
+            else:
+                if current is not None:
+                    segments.append(Segment(current_address, memoryview(current)))
+                current_address, current = address, bytearray(data)
+        elif record_type == HEX_END_OF_FILE:
+            break
+        elif record_type == HEX_EXTENDED_SEGMENT_ADDRESS:
+            base = ((data[0] << 8) | data[1]) << 4
+        elif record_type == HEX_EXTENDED_LINEAR_ADDRESS:
+            base = ((data[0] << 8) | data[1]) << 16
+        elif record_type not in (HEX_START_SEGMENT_ADDRESS, HEX_START_LINEAR_ADDRESS):
+            raise ImageError("Line {} has unknown record type {}".format(number, record_type))
+    if current is not None:
+        segments.append(Segment(current_address, memoryview(current)))
+    return FirmwareImage(segments)
+
+
+def parse_dfuse(data, source=None):
+    data = memoryview(data)
+    suffix = DfuSuffix.find(data)
+    if suffix is None:
+        raise ImageError("DfuSe file has no DFU suffix")
+    body = data[:-DFU_SUFFIX_LENGTH]
+    if body[:5].tobytes() != DFUSE_PREFIX_SIGNATURE:
+        raise ImageError("Missing DfuSe prefix")
+    version, image_size, target_count = struct.unpack('<BIB', body[5:DFUSE_PREFIX_LENGTH].tobytes())
+    if image_size != len(body):
+        raise ImageError("DfuSe image size {} does not match file size {}".format(image_size, len(body)))
+    segments = []
+    offset = DFUSE_PREFIX_LENGTH
+    for _ in range(target_count):
+        header = body[offset:offset + DFUSE_TARGET_PREFIX_LENGTH].tobytes()
+        if len(header) != DFUSE_TARGET_PREFIX_LENGTH or header[:6] != DFUSE_TARGET_SIGNATURE:
+            raise ImageError("Invalid DfuSe target at offset {}".format(offset))
+        alt = bytearray(header[6:7])[0]
+        target_size, element_count = struct.unpack('<II', header[266:274])
+        offset += DFUSE_TARGET_PREFIX_LENGTH
+        target_end = offset + target_size
+        if target_end > len(body):
+            raise ImageError("DfuSe target overruns file")
+        for _ in range(element_count):
+            address, size = struct.unpack('<II', body[offset:offset + DFUSE_ELEMENT_HEADER_LENGTH].tobytes())
+            offset += DFUSE_ELEMENT_HEADER_LENGTH
+            if offset + size > target_end:
+                raise ImageError("DfuSe element at 0x{0:08x} overruns its target".format(address))
+            segments.append(Segment(address, body[offset:offset + size], alt))
+            offset += size
+    return FirmwareImage(segments, suffix, source)
+
+
+class _MappedFile(object):
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self._map = None
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.view = memoryview(self._map)
+        except (ValueError, TypeError):
+            # empty files cannot be mapped and python 2 cannot view an mmap, so fall back to reading
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+            self._file.seek(0)
+            self.view = memoryview(bytearray(self._file.read()))
+
+    def close(self):
+        self.view = None
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                # segments handed out are still viewing the map, it is released with them
+                pass
+        self._file.close()
+
+
+def load_image(path, address=DEFAULT_ADDRESS):
+    '''Loads a .hex, .dfu or raw .bin (optionally with a DFU suffix) image, raw images being placed at address'''
+    extension = os.path.splitext(path)[1].lower()
+    if extension in ('.hex', '.ihex'):
+        with open(path, 'r') as hex_file:
+            return parse_hex(hex_file.read())
+    mapped = _MappedFile(path)
+    try:
+        view = mapped.view
+        if view[:5].tobytes() == DFUSE_PREFIX_SIGNATURE:
+            return parse_dfuse(view, mapped)
+        suffix = DfuSuffix.find(view)
+        if suffix is not None:
+            view = view[:-DFU_SUFFIX_LENGTH]
+        return FirmwareImage([Segment(address, view)], suffix, mapped)
+    except Exception:
+        mapped.close()
+        raise
+
+
+class ImageCache(object):
+    '''Validated images converted to raw binaries, kept on disk by content hash.
+
+    The hash of a file is remembered against its path, size and modification time, so a
+    repeated prepare() of an unchanged build costs a stat.'''
+
+    def __init__(self, cache_dir=None, flash_range=DEFAULT_FLASH_RANGE):
+        self.cache_dir = cache_dir or os.path.join(tempfile.gettempdir(), 'peachy-firmware-cache')
+        self.flash_range = flash_range
+        self._digests = {}
+        self._lock = threading.Lock()
+
+    def _file_digest(self, path):
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+        with self._lock:
+            digest = self._digests.get(key)
+        if digest is None:
+            sha = hashlib.sha256()
+            with open(path, 'rb') as source:
+                for chunk in iter(lambda: source.read(65536), b''):
+                    sha.update(chunk)
+            digest = sha.hexdigest()
+            with self._lock:
+                self._digests[key] = digest
+        return digest
+
+    def _write(self, path, data):
+        '''Writes data to path through a temporary file of its own, so prepares running at once never share one'''
+        handle, temp_path = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+        try:
+            with os.fdopen(handle, 'wb') as temp_file:
+                temp_file.write(data)
+            if os.name == 'nt' and os.path.exists(path):
+                os.remove(path)
+            os.rename(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def prepare(self, path, address=DEFAULT_ADDRESS):
+        '''Returns (binary_path, start_address) for a validated raw binary of the image at path'''
+        digest = self._file_digest(path)
+        name = '{}-{:08x}-{:08x}-{:08x}'.format(digest, address, self.flash_range[0], self.flash_range[1])
+        binary_path = os.path.join(self.cache_dir, name + '.bin')
+        address_path = os.path.join(self.cache_dir, name + '.address')
+        if os.path.isfile(binary_path) and os.path.isfile(address_path):
+            with open(address_path) as address_file:
+                return binary_path, int(address_file.read(), 16)
+        with load_image(path, address) as image:
+            image.validate(self.flash_range)
+            start = image.start
+            data = image.to_bin()
+            if not os.path.isdir(self.cache_dir):
+                try:
+                    os.makedirs(self.cache_dir)
+                except OSError:
+                    if not os.path.isdir(self.cache_dir):
+                        raise
+            self._write(binary_path, data)
+            del data
+        # The address is written last, both whole, so a binary is only used once its address can be read
+        self._write(address_path, '{:08x}'.format(start).encode('ascii'))
+        return binary_path, start
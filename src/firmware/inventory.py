@@ -0,0 +1,130 @@
+import os
+import logging
+import threading
+
+from .devices import DeviceRecord, MODE_BOOTLOADER, parse_dfu_descriptor
+from .hotplug import open_event_source
+
+logger = logging.getLogger('peachy')
+
+# Uevent actions after which a device's attributes are re-read; bind follows add once a driver has claimed it
+UPDATE_ACTIONS = ('add', 'bind', 'change')
+
+
+class DeviceInventory(object):
+    '''An index of attached usb devices kept up to date from hotplug events rather than by rescanning.
+
+    The first lookup reads every device from sysfs. After that a lookup first applies the hotplug events that
+    arrived since the last, reading only the devices that were added, so it costs a non blocking read of the
+    event source. Records are keyed by UsbDevice.key, the port path, which stays the same for as long as a
+    device is plugged into the same port, even across the bootloader and printer re-enumerating.
+
+    modes: {(idvendor, idproduct): mode} naming the devices of interest, others are indexed with mode None
+    event_source: where hotplug events come from, by default the cheapest open_event_source finds for enumerator'''
+
+    def __init__(self, enumerator, modes, event_source=None):
+        self.enumerator = enumerator
+        self.modes = modes
+        self._event_source = event_source
+        self._lock = threading.Lock()
+        # Held while the event source is drained and its events applied, so concurrent lookups neither read the
+        # source at once nor apply its events out of order
+        self._drain_lock = threading.Lock()
+        self._records = None
+        # Devices that were added before their attributes could be read, retried on the next lookup
+        self._pending = set()
+
+    def _read(self, name):
+        device = self.enumerator.read_device(name)
+        if device is None:
+            return None
+        mode = self.modes.get((device.idvendor, device.idproduct))
+        if mode != MODE_BOOTLOADER:
+            return DeviceRecord(device, mode, bcd_device=self.enumerator.read_bcd_device(name))
+        return DeviceRecord(
+            device, mode, parse_dfu_descriptor(self.enumerator.read_descriptors(name)),
+            self.enumerator.read_interface_names(name), self.enumerator.read_bcd_device(name))
+
+    def _add(self, name):
+        record = self._read(name)
+        if record is not None:
+            self._records[name] = record
+            self._pending.discard(name)
+        elif os.path.isdir(os.path.join(self.enumerator.root, name)):
+            self._pending.add(name)
+        else:
+            self._records.pop(name, None)
+            self._pending.discard(name)
+
+    def _remove(self, name):
+        self._records.pop(name, None)
+        self._pending.discard(name)
+
+    def _refresh(self):
+        if self._event_source is None:
+            self._event_source = open_event_source(enumerator=self.enumerator)
+        # The source is open before the scan so nothing attached during it is missed; replaying its events is harmless
+        self._records = {}
+        self._pending = set()
+        for name in self.enumerator.names():
+            # root hubs (usb1) have no port path to key them by
+            if not name.startswith('usb'):
+                self._add(name)
+
+    def apply(self, event):
+        '''Updates the index from one HotplugEvent'''
+        name = event.port_path
+        if name is None or ':' in name or name.startswith('usb'):
+            return
+        with self._lock:
+            if self._records is None:
+                return
+            if event.action in UPDATE_ACTIONS:
+                self._add(name)
+            elif event.action == 'remove':
+                self._remove(name)
+
+    def refresh(self):
+        '''Rereads every device, as the first lookup does'''
+        with self._lock:
+            self._refresh()
+
+    def sync(self):
+        '''Applies the hotplug events that arrived since the last lookup'''
+        with self._lock:
+            if self._records is None:
+                self._refresh()
+                return
+            for name in list(self._pending):
+                self._add(name)
+            source = self._event_source
+        with self._drain_lock:
+            while True:
+                events = source.events(0)
+                if not events:
+                    return
+                for event in events:
+                    self.apply(event)
+
+    def devices(self, *modes):
+        '''DeviceRecords of the attached devices in key order, only those of the given modes when any are given'''
+        self.sync()
+        with self._lock:
+            records = list(self._records.values())
+        return sorted((record for record in records if not modes or record.mode in modes), key=lambda record: record.key)
+
+    def get(self, key):
+        '''The DeviceRecord of the device attached at port path key, None if there is none'''
+        self.sync()
+        with self._lock:
+            return self._records.get(key)
+
+    def find(self, idvendor, idproduct):
+        return [record for record in self.devices() if (record.idvendor, record.idproduct) == (idvendor, idproduct)]
+
+    def close(self):
+        with self._lock:
+            if self._event_source is not None:
+                self._event_source.close()
+                self._event_source = None
+            self._records = None
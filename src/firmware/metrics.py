@@ -0,0 +1,238 @@
+'''Counters, latency histograms and throughput for flashing, exported as Prometheus text and json events.
+
+Updaters record nothing until they are given a FlashMetrics:
+
+    updater.metrics = FlashMetrics(event_stream=open('flash-events.jsonl', 'a'))
+    updater.flash_cycle(path_to_firmware)
+    updater.metrics.prometheus()
+
+Each update and flash cycle writes one json line to event_stream naming the host, updater, device and firmware size,
+so slow stations can be traced to a hub, a host or an image.'''
+import os
+import json
+import time
+import socket
+import functools
+import threading
+
+from .progress import UpdateResult, PHASE_ERASE, PHASE_DOWNLOAD, PHASE_VERIFY, PHASE_MANIFEST, STAGE_BOOTLOADER_ENUMERATION, STAGE_PEACHY_ENUMERATION
+
+ATTEMPTS = 'attempts'
+SUCCESSES = 'successes'
+FAILURES = 'failures'
+RETRIES = 'retries'
+COUNTERS = (
+    (ATTEMPTS, 'Firmware updates started'),
+    (SUCCESSES, 'Firmware updates that succeeded'),
+    (FAILURES, 'Firmware updates that failed'),
+    (RETRIES, 'Transfers retried after transient errors'),
+)
+
+ENUMERATION = 'enumeration'
+ERASE = PHASE_ERASE
+DOWNLOAD = PHASE_DOWNLOAD
+VERIFY = PHASE_VERIFY
+MANIFEST = PHASE_MANIFEST
+REENUMERATION = 'reenumeration'
+
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+THROUGHPUT_BUCKETS = tuple(1024.0 * kilobytes for kilobytes in (4, 8, 16, 32, 64, 128, 256, 512, 1024))
+
+
+def updater_name(updater):
+    '''The label for an updater, LinuxFirmwareUpdater is linux'''
+    return type(updater).__name__.replace('FirmwareUpdater', '').lower() or 'updater'
+
+
+def _text(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+def _firmware(firmware):
+    '''The name and size of a firmware path or FlashPlan for events'''
+    if hasattr(firmware, 'segments'):
+        return repr(firmware), firmware.size
+    try:
+        return firmware, os.path.getsize(firmware)
+    except (IOError, OSError, TypeError):
+        return firmware, None
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+
+    def _lines(self, name, labels):
+        for bound, count in zip(self.buckets, self.counts):
+            yield '{}_bucket{{{},le="{!r}"}} {}'.format(name, labels, bound, count)
+        yield '{}_bucket{{{},le="+Inf"}} {}'.format(name, labels, self.count)
+        yield '{}_sum{{{}}} {!r}'.format(name, labels, self.sum)
+        yield '{}_count{{{}}} {}'.format(name, labels, self.count)
+
+
+class FlashMetrics(object):
+    '''Thread safe counters and histograms labelled by updater, with a json event written per update and cycle.
+
+    event_stream: a file like object for json events, one per line, None to keep only the aggregates
+    host: named in every event, the machine's host name by default'''
+
+    def __init__(self, event_stream=None, host=None, clock=time.time):
+        self.event_stream = event_stream
+        self.host = host or socket.gethostname()
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._latencies = {}
+        self._throughput = {}
+
+    def counter(self, name, updater):
+        with self._lock:
+            return self._counters.get((name, updater_name(updater)), 0)
+
+    def latency(self, operation, updater):
+        '''The Histogram of seconds spent in operation, None before any were recorded'''
+        with self._lock:
+            return self._latencies.get((operation, updater_name(updater)))
+
+    def throughput(self, updater):
+        with self._lock:
+            return self._throughput.get(updater_name(updater))
+
+    def count(self, name, updater, amount=1):
+        key = (name, updater_name(updater))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, operation, updater, seconds):
+        key = (operation, updater_name(updater))
+        with self._lock:
+            if key not in self._latencies:
+                self._latencies[key] = Histogram(LATENCY_BUCKETS)
+            self._latencies[key].observe(seconds)
+
+    def observe_throughput(self, updater, bytes_per_second):
+        key = updater_name(updater)
+        with self._lock:
+            if key not in self._throughput:
+                self._throughput[key] = Histogram(THROUGHPUT_BUCKETS)
+            self._throughput[key].observe(bytes_per_second)
+
+    def event(self, name, **fields):
+        if self.event_stream is None:
+            return
+        fields.update(event=name, time=self._clock(), host=self.host)
+        line = json.dumps(fields, sort_keys=True)
+        with self._lock:
+            self.event_stream.write(line + '\n')
+            self.event_stream.flush()
+
+    def record_update(self, updater, firmware_path, device, result, downloaded=None):
+        '''Records an UpdateResult, downloaded being the bytes sent in the download phase if known'''
+        self.count(SUCCESSES if result else FAILURES, updater)
+        retries = getattr(result, 'retries', 0)
+        if retries:
+            self.count(RETRIES, updater, retries)
+        for phase in (ERASE, DOWNLOAD, VERIFY, MANIFEST):
+            if phase in result.phases:
+                self.observe(phase, updater, result.phases[phase])
+        firmware, firmware_size = _firmware(firmware_path)
+        bytes_per_second = None
+        download_time = result.phases.get(DOWNLOAD)
+        if downloaded and download_time:
+            bytes_per_second = downloaded / download_time
+            self.observe_throughput(updater, bytes_per_second)
+        self.event(
+            'update', updater=updater_name(updater), device=device.key if device is not None else None,
+            firmware=firmware, firmware_size=firmware_size, success=bool(result), phases=dict(result.phases),
+            bytes_per_second=bytes_per_second, retries=retries, error=_text(result.error) or None)
+
+    def record_cycle(self, updater, firmware_path, result):
+        '''Records the re-enumerations of a CycleResult, its update having been recorded already'''
+        for stage in (STAGE_BOOTLOADER_ENUMERATION, STAGE_PEACHY_ENUMERATION):
+            if stage in result.stages:
+                self.observe(REENUMERATION, updater, result.stages[stage])
+        firmware, firmware_size = _firmware(firmware_path)
+        self.event(
+            'cycle', updater=updater_name(updater), device=result.device.key if result.device is not None else None,
+            firmware=firmware, firmware_size=firmware_size, success=bool(result), stages=dict(result.stages),
+            error=result.error or None)
+
+    def prometheus(self):
+        '''Everything recorded in the Prometheus text exposition format'''
+        with self._lock:
+            lines = []
+            for name, description in COUNTERS:
+                metric = 'peachy_flash_{}_total'.format(name)
+                lines += ['# HELP {} {}'.format(metric, description), '# TYPE {} counter'.format(metric)]
+                lines += ['{}{{updater="{}"}} {}'.format(metric, updater, value)
+                          for (counter, updater), value in sorted(self._counters.items()) if counter == name]
+            metric = 'peachy_flash_latency_seconds'
+            lines += ['# HELP {} Seconds spent enumerating, erasing, downloading, verifying, manifesting and re-enumerating'.format(metric),
+                      '# TYPE {} histogram'.format(metric)]
+            for (operation, updater), histogram in sorted(self._latencies.items()):
+                lines += histogram._lines(metric, 'operation="{}",updater="{}"'.format(operation, updater))
+            metric = 'peachy_flash_throughput_bytes_per_second'
+            lines += ['# HELP {} Download throughput of each update'.format(metric), '# TYPE {} histogram'.format(metric)]
+            for updater, histogram in sorted(self._throughput.items()):
+                lines += histogram._lines(metric, 'updater="{}"'.format(updater))
+        return '\n'.join(lines) + '\n'
+
+
+class UpdateRecorder(object):
+    '''Records one update on an updater's metrics, doing nothing when it has none.
+
+    progress_callback notes the bytes downloaded before passing events on to the caller's callback, finish() and
+    fail() record how the update ended'''
+
+    def __init__(self, updater, firmware_path, device=None, progress_callback=None):
+        self.updater = updater
+        self.firmware_path = firmware_path
+        self.device = device
+        self._progress_callback = progress_callback
+        self._downloaded = None
+        if updater.metrics is not None:
+            updater.metrics.count(ATTEMPTS, updater)
+
+    def progress_callback(self, event):
+        if event.phase == DOWNLOAD and event.bytes is not None:
+            self._downloaded = event.bytes
+        if self._progress_callback:
+            self._progress_callback(event)
+
+    def finish(self, result):
+        if self.updater.metrics is not None:
+            self.updater.metrics.record_update(self.updater, self.firmware_path, self.device, result, self._downloaded)
+        return result
+
+    def fail(self, error):
+        if self.updater.metrics is not None:
+            self.updater.metrics.record_update(self.updater, self.firmware_path, self.device, UpdateResult(False, error=str(error)))
+
+
+def instrumented(update):
+    '''Decorates an updater's update to record it on the updater's metrics, calling straight through when it has none'''
+
+    @functools.wraps(update)
+    def wrapper(updater, firmware_path, device=None, progress_callback=None, **options):
+        if updater.metrics is None:
+            return update(updater, firmware_path, device, progress_callback, **options)
+        recorder = UpdateRecorder(updater, firmware_path, device, progress_callback)
+        try:
+            result = update(updater, firmware_path, device, recorder.progress_callback, **options)
+        except Exception as e:
+            recorder.fail(e)
+            raise
+        return recorder.finish(result)
+    return wrapper
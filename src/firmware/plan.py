@@ -0,0 +1,142 @@
+import logging
+from collections import OrderedDict
+
+from .image import ImageError, Segment, FirmwareImage, load_image
+from .dfu import DfuError, MemoryLayout, DEFAULT_ADDRESS
+from .progress import PHASE_ERASE, PHASE_DOWNLOAD
+from .verify import ImageDigest, FlashVerifier
+
+logger = logging.getLogger('peachy')
+
+
+class FlashPlan(object):
+    '''Segments to write in one DFU session, each at its own address and alt setting.
+
+    Firmware, calibration blocks and option bytes can be written together, leaving the bootloader once at the end:
+
+        with FlashPlan() as plan:
+            plan.add_image('firmware.hex')
+            plan.add(0x080e0000, calibration)
+            plan.add(0x1fffc000, option_bytes, alt=1)
+            updater.update_plan(plan)'''
+
+    def __init__(self):
+        self.segments = []
+        self._images = []
+
+    def add(self, address, data, alt=0):
+        self.segments.append(Segment(address, memoryview(data), alt))
+        return self
+
+    def add_image(self, path, address=DEFAULT_ADDRESS, alt=None):
+        '''Adds every segment of a .bin, .hex or .dfu image, raw images placed at address, at alt or the image's own alt settings'''
+        image = load_image(path, address)
+        self._images.append(image)
+        for segment in image.segments:
+            self.segments.append(Segment(segment.address, segment.data, segment.alt if alt is None else alt))
+        return self
+
+    def close(self):
+        self.segments = []
+        for image in self._images:
+            image.close()
+        self._images = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def size(self):
+        return sum(len(segment.data) for segment in self.segments)
+
+    @property
+    def start(self):
+        '''Where the firmware starts: the lowest alt 0 address, None without alt 0 segments'''
+        addresses = [segment.address for segment in self.segments if segment.alt == 0]
+        return min(addresses) if addresses else None
+
+    def by_alt(self):
+        '''OrderedDict of alt setting to its segments in address order, the main flash (alt 0) first'''
+        alts = OrderedDict()
+        for alt in sorted(set(segment.alt for segment in self.segments), key=lambda alt: (alt != 0, alt)):
+            alts[alt] = sorted((segment for segment in self.segments if segment.alt == alt), key=lambda segment: segment.address)
+        return alts
+
+    def validate(self):
+        '''Raises ImageError for an empty plan or segments overlapping within an alt setting'''
+        if not self.segments or not self.size:
+            raise ImageError("Flash plan is empty")
+        for alt, segments in self.by_alt().items():
+            for previous, segment in zip(segments, segments[1:]):
+                if segment.address < previous.end:
+                    raise ImageError("Segments overlap at 0x{0:08x} on alt {1}".format(segment.address, alt))
+
+    def to_image(self):
+        return FirmwareImage(list(self.segments))
+
+    def __repr__(self):
+        return "FlashPlan({})".format(', '.join(repr(segment) for segment in self.segments))
+
+
+class PlanFlasher(object):
+    '''Writes a FlashPlan through one DfuSeEngine. For each alt setting every sector under its segments is erased once,
+    however many segments share it, before the segments are written in address order.
+
+    verify_sample: with verify, check only this many sectors of each segment'''
+
+    def __init__(self, engine, verify=False, verify_sample=None):
+        self.engine = engine
+        self.verify = verify
+        self.verify_sample = verify_sample
+
+    def _layout(self, alt):
+        self.engine.transport.set_alternate(alt)
+        return MemoryLayout.parse(self.engine.transport.interface_name)
+
+    @staticmethod
+    def sectors(layout, segments):
+        '''The distinct sectors under segments in address order, raising DfuError for segments outside the layout'''
+        sectors = []
+        for segment in segments:
+            if segment.address < layout.start or segment.end > layout.end:
+                raise DfuError("Segment 0x{0:08x}-0x{1:08x} outside of {2}".format(segment.address, segment.end, layout.name))
+            for sector in layout.sectors_for(segment.address, len(segment.data)):
+                if sector not in sectors:
+                    sectors.append(sector)
+        return sorted(sectors, key=lambda sector: sector.address)
+
+    def flash(self, plan, progress=None):
+        '''Writes every segment of plan, leaving the interface on the last alt setting written'''
+        alts = plan.by_alt()
+        layouts = dict((alt, self._layout(alt)) for alt in alts)
+        erases = dict((alt, [sector for sector in self.sectors(layouts[alt], segments) if sector.erasable]) for alt, segments in alts.items())
+        erase_total = sum(sector.size for sectors in erases.values() for sector in sectors)
+        erased = 0
+        written = 0
+        for alt, segments in alts.items():
+            self.engine.transport.set_alternate(alt)
+            self.engine.ensure_idle()
+            for sector in erases[alt]:
+                self.engine.erase_page(sector.address)
+                erased += sector.size
+                if progress:
+                    progress(PHASE_ERASE, 100 * erased // erase_total, erased)
+            for segment in segments:
+                if progress:
+                    on_block = lambda phase, percent, done, base=written: progress(PHASE_DOWNLOAD, 100 * (base + done) // plan.size, base + done)
+                else:
+                    on_block = None
+                self.engine.write(segment.address, segment.data, on_block)
+                written += len(segment.data)
+            if self.verify:
+                self._verify(layouts[alt], segments, progress)
+
+    def _verify(self, layout, segments, progress):
+        verifier = FlashVerifier(self.engine, self.verify_sample)
+        for segment in segments:
+            result = verifier.verify(ImageDigest.compute(segment.address, segment.data, layout), progress)
+            if not result.success:
+                raise DfuError("Flash does not match {}".format(segment))
@@ -0,0 +1,136 @@
+'''Finds and checks the flashing tools shipped with the package, once per process.
+
+Each tool must exist and be executable. It is hashed against the builds shipped in dependancies/ and, when it is not
+one of them, asked for its version. The result is kept for the life of the process, so later preflights cost a
+dictionary lookup:
+
+    dependancies = preflight('linux')
+    dependancies['dfu-util'].version       #<---(0, 8)
+    dependancies['dfu-util'].paths         #<---False, this build cannot select devices with -p
+'''
+import os
+import re
+import sys
+import stat
+import hashlib
+import logging
+import threading
+from subprocess import Popen, PIPE
+from collections import namedtuple
+
+logger = logging.getLogger('peachy')
+
+# paths: whether a dfu-util build can select devices by port path with -p, None for other tools
+Dependancy = namedtuple('Dependancy', 'name path version sha256 bundled paths')
+
+PLATFORM_DEPENDANCIES = {
+    'linux': ('dfu-util',),
+    'mac': ('dfu-util', 'check_usb.sh'),
+    'windows': ('DfuSeCommand.exe',),
+}
+
+# sha256 of the builds shipped in dependancies/ and their versions, so they are never run just to ask
+BUNDLED = {
+    'cc1c8361d330a3c8f015ae266651b12410499631938264248cabe7c70b11a4c6': (0, 8),  # linux/dfu-util
+    '7e5b69260d0545e08736b430bb21583f2f6522eef5546c2f51a7426365e473fa': (0, 9),  # mac/dfu-util
+    '9eb708d23af8c60d29dfc547e63cd30f6e14ef1721583101a05ee854f4df162c': None,    # mac/check_usb.sh
+    '3ec598a4a50de39750d4cc4ca8c4518c70d405e9efc55cb4baa0df59bc6a1157': None,    # windows/DfuSeCommand.exe
+}
+
+# Reading flash back with --dfuse-address address:length:leave -U needs dfu-util 0.8
+MINIMUM_VERSIONS = {'dfu-util': (0, 8)}
+VERSION_PATTERN = re.compile(br'dfu-util (\d+)\.(\d+)')
+# Builds against a libusb without libusb_get_port_numbers, such as the bundled linux one, exit with this for -p
+NO_PATHS_MESSAGE = b'USB device paths are not supported by this dfu-util.'
+
+_checked = {}
+_lock = threading.Lock()
+
+
+class DependancyError(Exception):
+    pass
+
+
+def dependancies_path(platform_name):
+    '''Where the tools for platform_name are: the unpack directory of a frozen build, otherwise the package's'''
+    if getattr(sys, 'frozen', False):
+        return sys._MEIPASS
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dependancies', platform_name)
+
+
+def executable(path):
+    '''Returns path once it is an executable file, setting its execute bit if needed'''
+    if not os.path.isfile(path):
+        logger.error("Binary at {} missing.".format(path))
+        raise DependancyError("Binary at {} missing.".format(path))
+    mode = os.stat(path).st_mode
+    if not mode & stat.S_IXUSR:
+        os.chmod(path, mode | stat.S_IEXEC)
+    return path
+
+
+def _dotted(version):
+    return '.'.join(str(part) for part in version)
+
+
+def _sha256(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as binary:
+        for block in iter(lambda: binary.read(64 * 1024), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _supports_paths(path):
+    with open(path, 'rb') as binary:
+        return NO_PATHS_MESSAGE not in binary.read()
+
+
+def _version(path):
+    '''Asks a dfu-util build for its version, None if it cannot say'''
+    try:
+        process = Popen([path, '--version'], stdout=PIPE, stderr=PIPE)
+        (out, err) = process.communicate()
+    except OSError as e:
+        logger.warning("Could not run {}: {}".format(path, e))
+        return None
+    match = VERSION_PATTERN.search(out + err)
+    return tuple(int(part) for part in match.groups()) if match else None
+
+
+def check(path, execute_bit=True):
+    '''Returns the Dependancy at path, raising DependancyError if it is missing or older than this package needs.
+
+    execute_bit: make sure the tool can be run, which Windows tools need no bit for'''
+    name = os.path.basename(path)
+    if execute_bit:
+        executable(path)
+    elif not os.path.isfile(path):
+        raise DependancyError("Binary at {} missing.".format(path))
+    sha256 = _sha256(path)
+    bundled = sha256 in BUNDLED
+    if bundled:
+        version = BUNDLED[sha256]
+    else:
+        logger.warning("{} is not a bundled build, sha256 {}".format(path, sha256))
+        version = _version(path) if name in MINIMUM_VERSIONS else None
+    minimum = MINIMUM_VERSIONS.get(name)
+    if minimum is not None and version is not None and version < minimum:
+        raise DependancyError("{} is version {}, {} or later is needed".format(path, _dotted(version), _dotted(minimum)))
+    paths = _supports_paths(path) if name == 'dfu-util' else None
+    return Dependancy(name, path, version, sha256, bundled, paths)
+
+
+def preflight(platform_name, path=None):
+    '''Checks every tool platform_name needs, in path or where dependancies_path finds them, returning {name: Dependancy}.
+
+    Tools are checked once per process; raises DependancyError if one is missing or too old, checking again next time'''
+    key = (platform_name, path)
+    dependancies = _checked.get(key)
+    if dependancies is not None:
+        return dependancies
+    with _lock:
+        if key not in _checked:
+            tools = path or dependancies_path(platform_name)
+            _checked[key] = dict((name, check(os.path.join(tools, name), platform_name != 'windows')) for name in PLATFORM_DEPENDANCIES[platform_name])
+        return _checked[key]
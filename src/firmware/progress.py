@@ -0,0 +1,193 @@
+import re
+import time
+import threading
+import logging
+from collections import namedtuple, OrderedDict
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+logger = logging.getLogger('peachy')
+
+PHASE_SETUP = 'setup'
+PHASE_COMPARE = 'compare'
+PHASE_ERASE = 'erase'
+PHASE_DOWNLOAD = 'download'
+PHASE_VERIFY = 'verify'
+PHASE_MANIFEST = 'manifest'
+
+STAGE_ENTER_BOOTLOADER = 'enter_bootloader'
+STAGE_BOOTLOADER_ENUMERATION = 'bootloader_enumeration'
+STAGE_FLASH = 'flash'
+STAGE_PEACHY_ENUMERATION = 'peachy_enumeration'
+
+ProgressEvent = namedtuple('ProgressEvent', 'phase percent bytes bytes_per_second')
+
+
+class UpdateResult(object):
+    '''Outcome of an update, truthy when it succeeded.
+
+    phases: OrderedDict of phase name to seconds spent in it
+    retries: transient errors recovered from during the transfer'''
+
+    def __init__(self, success, exit_code=None, phases=None, output='', error='', retries=0):
+        self.success = success
+        self.exit_code = exit_code
+        self.phases = phases if phases is not None else OrderedDict()
+        self.output = output
+        self.error = error
+        self.retries = retries
+
+    @property
+    def duration(self):
+        return sum(self.phases.values())
+
+    def __bool__(self):
+        return self.success
+
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        phases = ', '.join('{}={:.3f}s'.format(phase, seconds) for phase, seconds in self.phases.items())
+        return "UpdateResult(success={}, exit_code={}, {})".format(self.success, self.exit_code, phases)
+
+
+class CycleResult(object):
+    '''Outcome of a flash cycle, truthy when the printer came back after flashing.
+
+    stages: OrderedDict of stage name to seconds spent in it
+    update: the UpdateResult of the flash stage if it was reached'''
+
+    def __init__(self, success, stages, update=None, device=None, error=''):
+        self.success = success
+        self.stages = stages
+        self.update = update
+        self.device = device
+        self.error = error
+
+    @property
+    def duration(self):
+        return sum(self.stages.values())
+
+    def __bool__(self):
+        return self.success
+
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        stages = ', '.join('{}={:.3f}s'.format(stage, seconds) for stage, seconds in self.stages.items())
+        return "CycleResult(success={}, {})".format(self.success, stages)
+
+
+class ProgressTracker(object):
+    '''Times each phase of an update and turns progress reports into ProgressEvents for callback'''
+
+    def __init__(self, callback=None, clock=time.time):
+        self._callback = callback
+        self._clock = clock
+        self._phases = OrderedDict()
+        self._phase = PHASE_SETUP
+        self._phase_started = clock()
+
+    @property
+    def phase(self):
+        return self._phase
+
+    def _enter(self, phase):
+        if phase == self._phase:
+            return
+        now = self._clock()
+        self._phases[self._phase] = self._phases.get(self._phase, 0.0) + now - self._phase_started
+        self._phase = phase
+        self._phase_started = now
+
+    def update(self, phase, percent=None, done_bytes=None):
+        self._enter(phase)
+        elapsed = self._clock() - self._phase_started
+        bytes_per_second = done_bytes / elapsed if done_bytes is not None and elapsed > 0 else None
+        event = ProgressEvent(phase, percent, done_bytes, bytes_per_second)
+        if self._callback:
+            self._callback(event)
+        return event
+
+    def finish(self):
+        self._enter(None)
+        return self._phases
+
+
+class DfuUtilOutputParser(object):
+    '''Turns dfu-util output lines into progress updates on a ProgressTracker'''
+    _PROGRESS = re.compile(r'^\s*(Erase|Download|Upload)\s*\[[= ]*\]\s*(\d+)%\s+(\d+)\s+bytes')
+    _MANIFEST = re.compile(r'^(Transitioning to dfuMANIFEST state|Submitting leave request|Resetting USB)')
+    _PHASES = {'Erase': PHASE_ERASE, 'Download': PHASE_DOWNLOAD, 'Upload': PHASE_DOWNLOAD}
+
+    def __init__(self, tracker):
+        self.tracker = tracker
+
+    def feed(self, line):
+        match = self._PROGRESS.match(line)
+        if match:
+            name, percent, done_bytes = match.groups()
+            return self.tracker.update(self._PHASES[name], int(percent), int(done_bytes))
+        if self._MANIFEST.match(line):
+            return self.tracker.update(PHASE_MANIFEST)
+        return None
+
+
+def iter_output_lines(stream):
+    '''Yields lines from a process stream as they are written, splitting on carriage returns so progress bars stream'''
+    line = bytearray()
+    while True:
+        char = stream.read(1)
+        if not char:
+            break
+        if char in (b'\r', b'\n'):
+            if line:
+                yield line.decode('utf-8', 'replace')
+                line = bytearray()
+        else:
+            line += char
+    if line:
+        yield line.decode('utf-8', 'replace')
+
+
+def _pump(name, stream, queue):
+    try:
+        for line in iter_output_lines(stream):
+            queue.put((name, line))
+    finally:
+        queue.put((name, None))
+
+
+def stream_process(process, on_line, stall_timeout=None):
+    '''Reads a process's stdout and stderr as it runs calling on_line for each stdout line.
+
+    The process is killed if it writes nothing for stall_timeout seconds.
+    Returns (stdout, stderr, stalled)'''
+    queue = Queue()
+    readers = [threading.Thread(target=_pump, args=(name, stream, queue)) for name, stream in (('stdout', process.stdout), ('stderr', process.stderr))]
+    for reader in readers:
+        reader.daemon = True
+        reader.start()
+    output = {'stdout': [], 'stderr': []}
+    open_streams = 2
+    stalled = False
+    while open_streams:
+        try:
+            name, line = queue.get(timeout=stall_timeout)
+        except Empty:
+            logger.error("No output for {} seconds, stopping".format(stall_timeout))
+            stalled = True
+            process.kill()
+            for reader in readers:
+                reader.join(stall_timeout)
+            break
+        if line is None:
+            open_streams -= 1
+            continue
+        output[name].append(line)
+        if name == 'stdout':
+            on_line(line)
+    return '\n'.join(output['stdout']), '\n'.join(output['stderr']), stalled
@@ -0,0 +1,162 @@
+import time
+import logging
+from collections import namedtuple
+
+from .dfu import DfuError, STATUS_ERR_PROG, STATUS_ERR_VERIFY, STATUS_ERR_NOTDONE, STATUS_ERR_UNKNOWN, STATUS_ERR_STALLEDPKT
+from .progress import PHASE_ERASE, PHASE_DOWNLOAD
+
+logger = logging.getLogger('peachy')
+
+# Statuses a retry can recover from; address, target and write protection errors will fail again
+TRANSIENT_STATUSES = (STATUS_ERR_PROG, STATUS_ERR_VERIFY, STATUS_ERR_NOTDONE, STATUS_ERR_UNKNOWN, STATUS_ERR_STALLEDPKT)
+
+ResumeReport = namedtuple('ResumeReport', 'retries resumed_blocks rewritten_sectors')
+
+
+def is_transient(error):
+    if isinstance(error, DfuError):
+        return error.status in TRANSIENT_STATUSES
+    return isinstance(error, (IOError, OSError))
+
+
+class RetryPolicy(object):
+    '''How often and how patiently to retry.
+
+    max_retries: retries allowed over the whole transfer
+    initial_delay, multiplier, max_delay: exponential backoff between retries in seconds'''
+
+    def __init__(self, max_retries=8, initial_delay=0.05, multiplier=2.0, max_delay=2.0):
+        self.max_retries = max_retries
+        self.initial_delay = initial_delay
+        self.multiplier = multiplier
+        self.max_delay = max_delay
+
+    def delay(self, attempt):
+        return min(self.initial_delay * self.multiplier ** attempt, self.max_delay)
+
+
+class ResumableDownloader(object):
+    '''Erases and writes an image sector by sector, tracking the blocks the device acknowledged.
+
+    After a transient failure the device is brought back to idle and the block that failed is read back: if it
+    landed the transfer continues after it, if it is still erased it is sent again, otherwise only its sector is
+    erased and rewritten. Once written the image is read back and any sector that differs is rewritten.'''
+
+    def __init__(self, engine, layout, policy=None, sleep=time.sleep):
+        self.engine = engine
+        self.layout = layout
+        self.policy = policy or RetryPolicy()
+        self._sleep = sleep
+        self._retries = 0
+        self._resumed = 0
+        self._rewritten = []
+
+    def _recover(self, error):
+        if not is_transient(error):
+            raise error
+        while True:
+            if self._retries >= self.policy.max_retries:
+                logger.error("Giving up after {} retries: {}".format(self._retries, error))
+                raise DfuError("Transfer failed after {} retries: {}".format(self._retries, error), getattr(error, 'status', None), getattr(error, 'state', None))
+            delay = self.policy.delay(self._retries)
+            self._retries += 1
+            logger.warning("Transient error, retrying in {:.2f}s: {}".format(delay, error))
+            self._sleep(delay)
+            try:
+                self.engine.ensure_idle()
+                return
+            except (DfuError, IOError, OSError) as e:
+                if not is_transient(e):
+                    raise
+                error = e
+
+    def _attempt(self, operation, *args):
+        while True:
+            try:
+                return operation(*args)
+            except (DfuError, IOError, OSError) as e:
+                self._recover(e)
+
+    def _sectors(self, address, data):
+        for sector in self.layout.sectors_for(address, len(data)):
+            start = max(sector.address, address)
+            end = min(sector.end, address + len(data))
+            yield sector, start, data[start - address:end - address]
+
+    def _erase(self, sector):
+        if sector.erasable:
+            self._attempt(self.engine.erase_page, sector.address)
+
+    def _write_sector(self, sector, start, data, on_written=None):
+        '''Writes data at start, inside sector, resuming after transient errors; on_written gets the bytes acknowledged'''
+        acknowledged = 0
+        while acknowledged < len(data):
+            resume_from = acknowledged
+            written = [0]
+
+            def on_block(phase, percent, done):
+                written[0] = done
+                if on_written:
+                    on_written(resume_from + done)
+            try:
+                self.engine.write(start + resume_from, data[resume_from:], on_block)
+                acknowledged = len(data)
+            except (DfuError, IOError, OSError) as e:
+                self._recover(e)
+                acknowledged = self._resume_point(sector, start, data, resume_from + written[0])
+
+    def _resume_point(self, sector, start, data, acknowledged):
+        block = data[acknowledged:acknowledged + self.engine.transfer_size].tobytes()
+        current = bytes(self._attempt(self.engine.read, start + acknowledged, len(block)))
+        if current == block:
+            logger.info("Block at 0x{0:08x} was written, continuing".format(start + acknowledged))
+            self._resumed += 1
+            return acknowledged + len(block)
+        if current == b'\xff' * len(block):
+            logger.info("Resending block at 0x{0:08x}".format(start + acknowledged))
+            self._resumed += 1
+            return acknowledged
+        logger.warning("Block at 0x{0:08x} partially written, rewriting sector 0x{1:08x}".format(start + acknowledged, sector.address))
+        self._rewritten.append(sector)
+        self._erase(sector)
+        return 0
+
+    def download(self, address, data, progress=None):
+        '''Writes data at address returning a ResumeReport, raising DfuError once the retry budget is spent'''
+        data = memoryview(data)
+        if address < self.layout.start or address + len(data) > self.layout.end:
+            raise DfuError("Range 0x{0:08x}-0x{1:08x} outside of {2}".format(address, address + len(data), self.layout.name))
+        self._attempt(self.engine.ensure_idle)
+        sectors = list(self._sectors(address, data))
+        erased = 0
+        for index, (sector, start, chunk) in enumerate(sectors):
+            self._erase(sector)
+            erased += sector.size
+            if progress:
+                progress(PHASE_ERASE, 100 * (index + 1) // len(sectors), erased)
+
+        done = 0
+        for sector, start, chunk in sectors:
+            if progress:
+                on_written = lambda written, base=done: progress(PHASE_DOWNLOAD, 100 * (base + written) // len(data), base + written)
+            else:
+                on_written = None
+            self._write_sector(sector, start, chunk, on_written)
+            done += len(chunk)
+
+        self._verify(sectors)
+        return ResumeReport(self._retries, self._resumed, self._rewritten)
+
+    def _verify(self, sectors):
+        for sector, start, chunk in sectors:
+            if bytes(self._attempt(self.engine.read, start, len(chunk))) == chunk.tobytes():
+                continue
+            if self._retries >= self.policy.max_retries:
+                raise DfuError("Verification of sector 0x{0:08x} failed".format(sector.address))
+            self._retries += 1
+            logger.warning("Sector 0x{0:08x} did not verify, rewriting it".format(sector.address))
+            self._rewritten.append(sector)
+            self._erase(sector)
+            self._write_sector(sector, start, chunk)
+            if bytes(self._attempt(self.engine.read, start, len(chunk))) != chunk.tobytes():
+                raise DfuError("Verification of sector 0x{0:08x} failed".format(sector.address))
@@ -0,0 +1,404 @@
+'''A long running flash host: jobs are queued, persisted and run on attached bootloaders by one warm updater.
+
+Jobs are submitted over local HTTP or HTTP on a Unix socket:
+
+    POST   /jobs        {"firmware": "/path/to/firmware.bin", "device": "1-1.2"}   device is optional
+    GET    /jobs        every job, oldest first
+    GET    /jobs/<id>   one job
+    DELETE /jobs/<id>   cancels a queued job
+    GET    /devices     attached bootloaders
+    GET    /inventory   attached bootloaders and printers with their ports, serials, DFU descriptors and memory layouts
+    GET    /metrics     counters and histograms in the Prometheus text format, when the updater has metrics
+
+Run it with python -m firmware.service --port 8787 or --socket /run/peachy-flash.sock'''
+import os
+import sys
+import json
+import time
+import uuid
+import logging
+import argparse
+import threading
+from multiprocessing.pool import ThreadPool
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn, UnixStreamServer
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn, UnixStreamServer
+
+from .image import ImageError
+from .metrics import FlashMetrics
+
+logger = logging.getLogger('peachy')
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+FINISHED = (SUCCEEDED, FAILED, CANCELLED)
+
+# Key of the only device when the updater cannot tell bootloaders apart
+ANY_DEVICE = 'any'
+
+
+class FlashJob(object):
+    FIELDS = ('id', 'firmware', 'device', 'state', 'submitted', 'started', 'finished', 'phase', 'percent', 'phases', 'error')
+
+    def __init__(self, firmware, device=None, id=None, state=QUEUED, submitted=None, started=None, finished=None, phase=None, percent=None, phases=None, error=None):
+        self.id = id or uuid.uuid4().hex
+        self.firmware = firmware
+        self.device = device
+        self.state = state
+        self.submitted = submitted or time.time()
+        self.started = started
+        self.finished = finished
+        self.phase = phase
+        self.percent = percent
+        self.phases = phases or {}
+        self.error = error
+
+    def to_dict(self):
+        return dict((field, getattr(self, field)) for field in self.FIELDS)
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(**dict((str(key), value) for key, value in values.items() if key in cls.FIELDS))
+
+    def __repr__(self):
+        return "FlashJob({}, {}, {})".format(self.id, self.firmware, self.state)
+
+
+class JobStore(object):
+    '''Keeps jobs in a json file so the queue and history survive restarts, None keeps them in memory only'''
+
+    def __init__(self, path=None):
+        self.path = path
+
+    def load(self):
+        if not self.path or not os.path.isfile(self.path):
+            return []
+        with open(self.path) as store_file:
+            return [FlashJob.from_dict(values) for values in json.load(store_file)]
+
+    def save(self, jobs):
+        if not self.path:
+            return
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as store_file:
+            json.dump([job.to_dict() for job in jobs], store_file)
+        if os.name == 'nt' and os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(temp_path, self.path)
+
+
+class FlashService(object):
+    '''Runs queued FlashJobs, each on a free attached bootloader, using one updater for the life of the service.
+
+    max_workers: jobs run at once
+    poll_interval: seconds between looking for bootloaders while jobs wait for one
+    settle_time: seconds a device is left alone after a job so it can disconnect before being offered again. A device
+                 flashed successfully is not offered again until a listing has found it gone, so a unit that stays in
+                 DFU mode is never flashed twice
+    max_history: finished jobs kept'''
+
+    def __init__(self, updater, store=None, max_workers=4, poll_interval=0.5, settle_time=2.0, max_history=1000):
+        self.updater = updater
+        self.store = store or JobStore()
+        self.max_workers = max_workers
+        self.poll_interval = poll_interval
+        self.settle_time = settle_time
+        self.max_history = max_history
+        self._jobs = []
+        self._busy = {}
+        # {key: when its update returned} of devices told to leave DFU mode, not offered again until a listing started
+        # after that finds them gone
+        self._leaving = {}
+        self._condition = threading.Condition()
+        self._running = False
+        self._dispatcher = None
+        self._pool = None
+        for job in self.store.load():
+            if job.state == RUNNING:
+                job.state, job.error, job.finished = FAILED, "Interrupted by service restart", time.time()
+            self._jobs.append(job)
+
+    def start(self):
+        with self._condition:
+            self._running = True
+        self._pool = ThreadPool(self.max_workers)
+        self._dispatcher = threading.Thread(target=self._dispatch)
+        self._dispatcher.daemon = True
+        self._dispatcher.start()
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        if self._dispatcher:
+            self._dispatcher.join()
+        if self._pool:
+            self._pool.close()
+            self._pool.join()
+
+    def _save(self):
+        finished = [job for job in self._jobs if job.state in FINISHED]
+        for job in finished[:max(len(finished) - self.max_history, 0)]:
+            self._jobs.remove(job)
+        self.store.save(self._jobs)
+
+    def submit(self, firmware, device=None):
+        '''Queues firmware to be flashed to device (a UsbDevice key) or the first free bootloader, returning the FlashJob.
+
+        Raises ImageError for missing or invalid images, preparing them now so the job starts from a warm cache.'''
+        if not os.path.isfile(firmware):
+            raise ImageError("No firmware at {}".format(firmware))
+        self.updater._prepare_image(firmware)
+        job = FlashJob(os.path.abspath(firmware), device)
+        with self._condition:
+            self._jobs.append(job)
+            self._save()
+            self._condition.notify_all()
+        logger.info("Queued {}".format(job))
+        return job
+
+    def get(self, job_id):
+        with self._condition:
+            for job in self._jobs:
+                if job.id == job_id:
+                    return job
+        return None
+
+    def jobs(self):
+        with self._condition:
+            return list(self._jobs)
+
+    def cancel(self, job_id):
+        '''Cancels a queued job, returning False if it has already started'''
+        with self._condition:
+            job = self.get(job_id)
+            if job is None or job.state != QUEUED:
+                return False
+            job.state, job.finished = CANCELLED, time.time()
+            self._save()
+            return True
+
+    def devices(self):
+        '''The attached bootloaders, None standing for the only one when the updater cannot tell them apart'''
+        try:
+            return self.updater.list_bootloaders()
+        except NotImplementedError:
+            bootloaders, _ = self.updater.list_usb_devices()
+            return [None] if bootloaders == 1 else []
+
+    def _key(self, device):
+        return device.key if device is not None else ANY_DEVICE
+
+    def _queued(self):
+        return [job for job in self._jobs if job.state == QUEUED]
+
+    def _free(self, devices):
+        now = time.time()
+        return [device for device in devices if self._busy.get(self._key(device), 0) <= now and self._key(device) not in self._leaving]
+
+    def _schedule(self, devices, listed=None):
+        '''Starts every queued job that has a free device, returning how many were started.
+
+        listed: when the listing of devices started, None when it failed and says nothing of what has left'''
+        started = 0
+        present = set(self._key(device) for device in devices)
+        for key, returned in list(self._leaving.items()):
+            if listed is not None and listed >= returned and key not in present:
+                del self._leaving[key]
+        free = self._free(devices)
+        for job in self._queued():
+            device = next((d for d in free if job.device in (None, self._key(d))), False)
+            if device is False:
+                continue
+            free.remove(device)
+            job.state, job.started, job.device = RUNNING, time.time(), self._key(device)
+            self._busy[job.device] = float('inf')
+            self._pool.apply_async(self._run, (job, device))
+            started += 1
+        if started:
+            self._save()
+        return started
+
+    def _dispatch(self):
+        while True:
+            with self._condition:
+                while self._running and not self._queued():
+                    self._condition.wait()
+                if not self._running:
+                    return
+            listed = time.time()
+            try:
+                devices = self.devices()
+            except Exception as e:
+                logger.error("Could not list bootloaders: {}".format(e))
+                listed, devices = None, []
+            with self._condition:
+                if not self._schedule(devices, listed):
+                    self._condition.wait(self.poll_interval)
+
+    def _run(self, job, device):
+        def on_progress(event):
+            job.phase, job.percent = event.phase, event.percent
+        try:
+            result = self.updater.update_and_leave(job.firmware, device=device, progress_callback=on_progress)
+            returned = time.time()
+            state, error, phases = (SUCCEEDED if result else FAILED), (None if result else result.error or "Update failed"), dict(result.phases)
+        except Exception as e:
+            logger.error("Job {} failed: {}".format(job.id, e))
+            state, error, phases = FAILED, str(e), {}
+        with self._condition:
+            job.state, job.error, job.phases, job.finished = state, error, phases, time.time()
+            self._busy[job.device] = time.time() + self.settle_time
+            if state == SUCCEEDED:
+                self._leaving[job.device] = returned
+            self._save()
+            self._condition.notify_all()
+        logger.info("Finished {}".format(job))
+
+
+class _ServiceRequestHandler(BaseHTTPRequestHandler):
+
+    def _reply(self, code, body):
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _reply_text(self, code, text):
+        content = text.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _path(self):
+        return [part for part in self.path.split('?')[0].split('/') if part]
+
+    def do_GET(self):
+        service = self.server.service
+        path = self._path()
+        if path == ['jobs']:
+            return self._reply(200, [job.to_dict() for job in service.jobs()])
+        if len(path) == 2 and path[0] == 'jobs':
+            job = service.get(path[1])
+            return self._reply(200, job.to_dict()) if job else self._reply(404, {'error': 'No such job'})
+        if path == ['devices']:
+            try:
+                devices = service.devices()
+            except Exception as e:
+                return self._reply(500, {'error': str(e)})
+            return self._reply(200, [{'key': service._key(device), 'usb_address': device.usb_address if device else None} for device in devices])
+        if path == ['inventory']:
+            try:
+                records = service.updater.list_devices()
+            except Exception as e:
+                return self._reply(500, {'error': str(e)})
+            return self._reply(200, [record.to_dict() for record in records])
+        if path == ['metrics']:
+            metrics = getattr(service.updater, 'metrics', None)
+            return self._reply_text(200, metrics.prometheus()) if metrics is not None else self._reply(404, {'error': 'Metrics are off'})
+        self._reply(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        if self._path() != ['jobs']:
+            return self._reply(404, {'error': 'Not found'})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+            job = self.server.service.submit(request['firmware'], request.get('device'))
+        except (ValueError, KeyError, TypeError) as e:
+            return self._reply(400, {'error': 'Expected {{"firmware": path}}: {}'.format(e)})
+        except (ImageError, IOError, OSError) as e:
+            return self._reply(400, {'error': str(e)})
+        self._reply(201, job.to_dict())
+
+    def do_DELETE(self):
+        path = self._path()
+        if len(path) != 2 or path[0] != 'jobs':
+            return self._reply(404, {'error': 'Not found'})
+        if self.server.service.get(path[1]) is None:
+            return self._reply(404, {'error': 'No such job'})
+        if not self.server.service.cancel(path[1]):
+            return self._reply(409, {'error': 'Job already started'})
+        self._reply(200, self.server.service.get(path[1]).to_dict())
+
+    def address_string(self):
+        return 'local'
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class ServiceHttpServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, service, address=('127.0.0.1', 8787)):
+        HTTPServer.__init__(self, address, _ServiceRequestHandler)
+        self.service = service
+
+
+class ServiceUnixServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, service, path):
+        if os.path.exists(path):
+            os.remove(path)
+        UnixStreamServer.__init__(self, path, _ServiceRequestHandler)
+        self.service = service
+
+    def server_close(self):
+        UnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def make_server(service, address):
+    '''A server for service on a Unix socket when address is a path, otherwise on a (host, port) tuple'''
+    if isinstance(address, tuple):
+        return ServiceHttpServer(service, address)
+    return ServiceUnixServer(service, address)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Peachy Printer firmware flash service')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8787)
+    parser.add_argument('--socket', help='Listen on this Unix socket instead of HTTP')
+    parser.add_argument('--state-dir', default=os.path.join(os.path.expanduser('~'), '.peachy-flash'), help='Where the job queue is kept')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--libusb', action='store_true', help='Flash over libusb rather than dfu-util')
+    parser.add_argument('--metrics', action='store_true', help='Serve /metrics and log a json event per job to events.jsonl in the state dir')
+    args = parser.parse_args(argv)
+
+    from . import get_firmware_updater
+    if not os.path.isdir(args.state_dir):
+        os.makedirs(args.state_dir)
+    updater = get_firmware_updater(use_libusb=args.libusb)
+    if args.metrics:
+        updater.metrics = FlashMetrics(open(os.path.join(args.state_dir, 'events.jsonl'), 'a'))
+    service = FlashService(updater, JobStore(os.path.join(args.state_dir, 'jobs.json')), max_workers=args.workers)
+    server = make_server(service, args.socket or (args.host, args.port))
+    service.start()
+    logger.info("Flash service listening on {}".format(server.server_address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
@@ -0,0 +1,406 @@
+import os
+import time
+import shutil
+import struct
+import tempfile
+
+from .devices import UsbDevice
+from .dfu import (
+    MemoryLayout,
+    DFU_DETACH, DFU_DNLOAD, DFU_UPLOAD, DFU_GETSTATUS, DFU_CLRSTATUS, DFU_GETSTATE, DFU_ABORT,
+    STATE_DFU_IDLE, STATE_DFU_DNLOAD_SYNC, STATE_DFU_DNBUSY, STATE_DFU_DNLOAD_IDLE,
+    STATE_DFU_MANIFEST_SYNC, STATE_DFU_MANIFEST, STATE_DFU_UPLOAD_IDLE, STATE_DFU_ERROR,
+    STATUS_OK, STATUS_ERR_PROG, STATUS_ERR_ADDRESS, STATUS_ERR_STALLEDPKT, STATUS_ERR_TARGET,
+    DFUSE_GET_COMMANDS, DFUSE_SET_ADDRESS, DFUSE_ERASE, DFUSE_READ_UNPROTECT, DFUSE_DATA_BLOCK,
+)
+
+STM32F4_LAYOUT = '@Internal Flash  /0x08000000/04*016Kg,01*064Kg,07*128Kg'
+STM32F4_OPTION_BYTES_LAYOUT = '@Option Bytes  /0x1FFFC000/01*016 e'
+STM32F4_OTP_LAYOUT = '@OTP Memory /0x1FFF7800/01*512 e,01*016 e'
+
+# Failures that can be injected at a block: the request stalls, programming stops halfway, or the block is
+# programmed but its status never arrives
+FAIL_STALL = 'stall'
+FAIL_PROG = 'prog'
+FAIL_LOST_ACK = 'lost_ack'
+
+
+def dfu_descriptors(idvendor=0x0483, idproduct=0xdf11, alt_settings=3, transfer_size=2048, attributes=0x0b, detach_timeout=255, dfu_version=0x011a):
+    '''Raw device and configuration descriptors of a DfuSe bootloader, as sysfs's descriptors file holds them'''
+    device = struct.pack('<BBHBBBBHHHBBBB', 18, 0x01, 0x0200, 0, 0, 0, 64, idvendor, idproduct, 0x2200, 1, 2, 3, 1)
+    interfaces = b''.join(struct.pack('<BBBBBBBBB', 9, 0x04, 0, alt, 0, 0xfe, 0x01, 0x02, 4 + alt) for alt in range(alt_settings))
+    functional = struct.pack('<BBBHHH', 9, 0x21, attributes, detach_timeout, transfer_size, dfu_version)
+    total = 9 + len(interfaces) + len(functional)
+    configuration = struct.pack('<BBHBBBBB', 9, 0x02, total, 1, 1, 0, 0xc0, 50)
+    return device + configuration + interfaces + functional
+
+
+class SimulatedDfuSeDevice(object):
+    '''An in memory STM32 DfuSe bootloader implementing the transport interface used by DfuSeEngine.
+
+    block_latency: seconds spent programming each downloaded block
+    erase_time: seconds spent erasing each sector, mass erase takes this for every sector
+    request_latency, byte_time: seconds each control transfer takes, plus seconds per byte it carries
+    min_poll_interval: seconds the device must be left after reporting busy, polling sooner stalls
+    bcd_device: the bootloader version
+    serial: the bootloader's serial number string'''
+
+    def __init__(self, layout=STM32F4_LAYOUT, max_transfer_size=2048, poll_timeout=0, block_latency=0, erase_time=0, sleep=time.sleep,
+                 request_latency=0, byte_time=0, min_poll_interval=None, bcd_device=0x2200, clock=time.time, serial=None):
+        self.layout = MemoryLayout.parse(layout)
+        self._layout_string = layout
+        self.max_transfer_size = max_transfer_size
+        self.poll_timeout = poll_timeout
+        self.block_latency = block_latency
+        self.erase_time = erase_time
+        self.request_latency = request_latency
+        self.byte_time = byte_time
+        self.min_poll_interval = min_poll_interval
+        self.bcd_device = bcd_device
+        self.serial = serial
+        self._sleep = sleep
+        self._clock = clock
+        self._busy_reported_at = None
+        self.flash = bytearray(b'\xff' * (self.layout.end - self.layout.start))
+        self.state = STATE_DFU_IDLE
+        self.status = STATUS_OK
+        self.address_pointer = self.layout.start
+        self.manifested = False
+        self.connected = True
+        self.erased_pages = []
+        self.requests = []
+        self.failures = {}
+        self._pending = None
+        self._lose_ack = False
+
+    @property
+    def interface_name(self):
+        return self._layout_string
+
+    def fail_at(self, address, failure=FAIL_STALL, times=1):
+        '''Makes the next times data blocks written at address fail with failure'''
+        self.failures[address] = [failure, times]
+
+    def _take_failure(self, address, failure):
+        entry = self.failures.get(address)
+        if entry is None or entry[0] != failure or entry[1] <= 0:
+            return False
+        entry[1] -= 1
+        return True
+
+    def reset(self):
+        '''Starts the bootloader again keeping the contents of flash'''
+        self.state = STATE_DFU_IDLE
+        self.status = STATUS_OK
+        self.manifested = False
+        self.connected = True
+        self._pending = None
+
+    def read_flash(self, address, length):
+        offset = address - self.layout.start
+        return bytes(self.flash[offset:offset + length])
+
+    def set_alternate(self, alt):
+        if alt != 0:
+            raise IOError("Alternate setting {} not supported".format(alt))
+
+    def close(self):
+        pass
+
+    def control_out(self, request, value, data):
+        self._check_connected()
+        data = bytearray(data or b'')
+        self.requests.append((request, value, len(data)))
+        self._busy(self.request_latency + len(data) * self.byte_time)
+        if request == DFU_DNLOAD:
+            self._dnload(value, data)
+        elif request == DFU_CLRSTATUS:
+            self.status = STATUS_OK
+            self.state = STATE_DFU_IDLE
+        elif request == DFU_ABORT:
+            self.state = STATE_DFU_IDLE
+        elif request == DFU_DETACH:
+            pass
+        else:
+            self._stall()
+        return len(data)
+
+    def control_in(self, request, value, length):
+        self._check_connected()
+        self.requests.append((request, value, length))
+        if request == DFU_GETSTATUS and self.state == STATE_DFU_DNBUSY and self._polled_too_soon():
+            self._stall()
+        self._busy(self.request_latency + (length * self.byte_time if request == DFU_UPLOAD else 0))
+        if request == DFU_GETSTATUS:
+            return self._get_status()
+        elif request == DFU_GETSTATE:
+            return bytearray([self.state])
+        elif request == DFU_UPLOAD:
+            return self._upload(value, length)
+        self._stall()
+
+    def _check_connected(self):
+        if not self.connected:
+            raise IOError("No such device (it may have been disconnected)")
+
+    def _stall(self):
+        self.state = STATE_DFU_ERROR
+        self.status = STATUS_ERR_STALLEDPKT
+        raise IOError("Pipe error")
+
+    def _fail(self, status):
+        self.state = STATE_DFU_ERROR
+        self.status = status
+
+    def _dnload(self, block, data):
+        if len(data) > self.max_transfer_size:
+            self._stall()
+        if self.state not in (STATE_DFU_IDLE, STATE_DFU_DNLOAD_IDLE):
+            self._stall()
+        if not data:
+            if self.state != STATE_DFU_DNLOAD_IDLE:
+                self._stall()
+            self.state = STATE_DFU_MANIFEST_SYNC
+            return
+        if block >= DFUSE_DATA_BLOCK and self._take_failure(self.address_pointer + (block - DFUSE_DATA_BLOCK) * len(data), FAIL_STALL):
+            self._stall()
+        self._pending = (block, data)
+        self.state = STATE_DFU_DNLOAD_SYNC
+
+    def _get_status(self):
+        if self.state == STATE_DFU_DNLOAD_SYNC:
+            block, data = self._pending
+            self._pending = None
+            self.state = STATE_DFU_DNBUSY
+            self._execute(block, data)
+            if self._lose_ack:
+                self._lose_ack = False
+                raise IOError("Operation timed out")
+        elif self.state == STATE_DFU_DNBUSY:
+            self.state = STATE_DFU_DNLOAD_IDLE
+        elif self.state == STATE_DFU_MANIFEST_SYNC:
+            self.state = STATE_DFU_MANIFEST
+            self.manifested = True
+        if self.state == STATE_DFU_DNBUSY:
+            self._busy_reported_at = self._clock()
+        status = bytearray([self.status]) + struct.pack('<I', self.poll_timeout)[:3] + bytearray([self.state, 0])
+        if self.manifested:
+            self.connected = False
+        return status
+
+    def _polled_too_soon(self):
+        return self.min_poll_interval is not None and self._clock() - self._busy_reported_at < self.min_poll_interval
+
+    def _busy(self, seconds):
+        if seconds:
+            self._sleep(seconds)
+
+    def _execute(self, block, data):
+        if block == 0:
+            self._command(data)
+        elif block >= DFUSE_DATA_BLOCK:
+            self._busy(self.block_latency)
+            self._program(self.address_pointer + (block - DFUSE_DATA_BLOCK) * len(data), data)
+        else:
+            self._fail(STATUS_ERR_STALLEDPKT)
+
+    def _command(self, data):
+        command = data[0]
+        if command == DFUSE_SET_ADDRESS and len(data) == 5:
+            self.address_pointer = struct.unpack('<I', bytes(data[1:5]))[0]
+        elif command == DFUSE_ERASE and len(data) == 1:
+            self._busy(self.erase_time * len(self.layout.sectors))
+            self.flash[:] = b'\xff' * len(self.flash)
+            self.erased_pages.append(None)
+        elif command == DFUSE_ERASE and len(data) == 5:
+            address = struct.unpack('<I', bytes(data[1:5]))[0]
+            sector = self.layout.sector_at(address)
+            if sector is None or not sector.erasable:
+                self._fail(STATUS_ERR_ADDRESS)
+                return
+            self._busy(self.erase_time)
+            offset = sector.address - self.layout.start
+            self.flash[offset:offset + sector.size] = b'\xff' * sector.size
+            self.erased_pages.append(sector.address)
+        elif command == DFUSE_READ_UNPROTECT and len(data) == 1:
+            pass
+        else:
+            self._fail(STATUS_ERR_TARGET)
+
+    def _program(self, address, data):
+        if address < self.layout.start or address + len(data) > self.layout.end:
+            self._fail(STATUS_ERR_ADDRESS)
+            return
+        offset = address - self.layout.start
+        current = self.flash[offset:offset + len(data)]
+        # Memory that cannot be erased, such as option bytes, is written over in place
+        if self.layout.sector_at(address).erasable and any(byte != 0xff for byte in current):
+            self._fail(STATUS_ERR_PROG)
+            return
+        if self._take_failure(address, FAIL_PROG):
+            half = len(data) // 2
+            self.flash[offset:offset + half] = data[:half]
+            self._fail(STATUS_ERR_PROG)
+            return
+        self._lose_ack = self._take_failure(address, FAIL_LOST_ACK)
+        self.flash[offset:offset + len(data)] = data
+
+    def _upload(self, block, length):
+        if self.state not in (STATE_DFU_IDLE, STATE_DFU_UPLOAD_IDLE):
+            self._stall()
+        if block == 0:
+            self.state = STATE_DFU_UPLOAD_IDLE
+            return bytearray([DFUSE_GET_COMMANDS, DFUSE_SET_ADDRESS, DFUSE_ERASE, DFUSE_READ_UNPROTECT])
+        if block < DFUSE_DATA_BLOCK:
+            self._stall()
+        address = self.address_pointer + (block - DFUSE_DATA_BLOCK) * length
+        if address < self.layout.start or address >= self.layout.end:
+            self._stall()
+        self.state = STATE_DFU_UPLOAD_IDLE
+        offset = address - self.layout.start
+        return bytearray(self.flash[offset:offset + length])
+
+
+class SimulatedMultiAltDevice(object):
+    '''A DfuSe bootloader with an alt setting per memory, each an in memory SimulatedDfuSeDevice, such as the STM32's
+    internal flash, option bytes and OTP. Requests go to the selected alt setting; leaving from any disconnects them all.'''
+
+    def __init__(self, layouts=(STM32F4_LAYOUT, STM32F4_OPTION_BYTES_LAYOUT, STM32F4_OTP_LAYOUT), **device_options):
+        self.alts = [SimulatedDfuSeDevice(layout, **device_options) for layout in layouts]
+        self.alt = 0
+        self.alternate_settings = []
+
+    @property
+    def current(self):
+        return self.alts[self.alt]
+
+    @property
+    def interface_name(self):
+        return self.current.interface_name
+
+    @property
+    def manifested(self):
+        return any(alt.manifested for alt in self.alts)
+
+    @property
+    def erased_pages(self):
+        return [(index, page) for index, alt in enumerate(self.alts) for page in alt.erased_pages]
+
+    def read_flash(self, address, length, alt=0):
+        return self.alts[alt].read_flash(address, length)
+
+    def set_alternate(self, alt):
+        if not 0 <= alt < len(self.alts):
+            raise IOError("Alternate setting {} not supported".format(alt))
+        self.current._check_connected()
+        self.alternate_settings.append(alt)
+        self.alts[alt].state = self.current.state
+        self.alt = alt
+
+    def close(self):
+        pass
+
+    def control_out(self, request, value, data):
+        try:
+            return self.current.control_out(request, value, data)
+        finally:
+            self._share_connection()
+
+    def control_in(self, request, value, length):
+        try:
+            return self.current.control_in(request, value, length)
+        finally:
+            self._share_connection()
+
+    def _share_connection(self):
+        if not self.current.connected:
+            for alt in self.alts:
+                alt.connected = False
+
+
+class SimulatedClock(object):
+    '''Time that only passes when slept, so timings against simulated devices are exact'''
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class SimulatedPrinter(object):
+    '''A printer that changes identity like the real one: enter_bootloader() replaces it with its SimulatedDfuSeDevice
+    bootloader and once that has been flashed and left the printer comes back. Each appearance takes
+    reenumeration_delay seconds.
+
+    scan: the UsbDevices currently attached, for use as a device listing or by PollingEventSource'''
+
+    def __init__(self, bootloader_ids=(0x0483, 0xdf11), peachy_ids=(0x16d0, 0x0af3), port_path='1-1', reenumeration_delay=0, clock=time.time, **device_options):
+        self.bootloader_ids = bootloader_ids
+        self.peachy_ids = peachy_ids
+        self.port_path = port_path
+        self.reenumeration_delay = reenumeration_delay
+        self.bootloader = SimulatedDfuSeDevice(**device_options)
+        self.in_bootloader = False
+        self.bootloader_entries = 0
+        self._clock = clock
+        self._attached_at = clock()
+
+    def _reenumerate(self, in_bootloader):
+        self.in_bootloader = in_bootloader
+        self._attached_at = self._clock() + self.reenumeration_delay
+
+    def enter_bootloader(self):
+        if self.in_bootloader:
+            return
+        self.bootloader_entries += 1
+        self.bootloader.reset()
+        self._reenumerate(True)
+
+    def scan(self):
+        if self.in_bootloader and not self.bootloader.connected:
+            self._reenumerate(False)
+        if self._clock() < self._attached_at:
+            return []
+        ids = self.bootloader_ids if self.in_bootloader else self.peachy_ids
+        return [UsbDevice(ids[0], ids[1], port_path=self.port_path)]
+
+
+class SimulatedSysfs(object):
+    '''A temporary directory laid out like /sys/bus/usb/devices'''
+
+    def __init__(self, root=None):
+        self.root = root or tempfile.mkdtemp()
+
+    def add(self, name, idvendor, idproduct, busnum=1, devnum=2, serial=None, bcd_device=None, descriptors=None):
+        path = os.path.join(self.root, name)
+        os.mkdir(path)
+        attributes = {'idVendor': '{:04x}'.format(idvendor), 'idProduct': '{:04x}'.format(idproduct), 'busnum': str(busnum), 'devnum': str(devnum)}
+        if serial is not None:
+            attributes['serial'] = serial
+        if bcd_device is not None:
+            attributes['bcdDevice'] = '{:04x}'.format(bcd_device)
+        for attribute, value in attributes.items():
+            with open(os.path.join(path, attribute), 'w') as attribute_file:
+                attribute_file.write(value + '\n')
+        if descriptors is not None:
+            with open(os.path.join(path, 'descriptors'), 'wb') as descriptors_file:
+                descriptors_file.write(descriptors)
+
+    def add_interface(self, name, interface_name=None):
+        '''Adds an interface such as 1-1:1.0, listed alongside devices and, with its string, inside its device'''
+        os.mkdir(os.path.join(self.root, name))
+        device_path = os.path.join(self.root, name.split(':')[0])
+        if interface_name is not None and os.path.isdir(device_path):
+            os.mkdir(os.path.join(device_path, name))
+            with open(os.path.join(device_path, name, 'interface'), 'w') as interface_file:
+                interface_file.write(interface_name + '\n')
+
+    def remove(self, name):
+        shutil.rmtree(os.path.join(self.root, name))
+
+    def cleanup(self):
+        shutil.rmtree(self.root)
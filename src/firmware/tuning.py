@@ -0,0 +1,122 @@
+import os
+import json
+import time
+import logging
+from collections import namedtuple
+
+from .dfu import DfuSeEngine, DfuError, DEFAULT_ADDRESS
+
+logger = logging.getLogger('peachy')
+
+DEFAULT_TRANSFER_SIZES = (512, 1024, 2048, 4096)
+# None honours the bwPollTimeout the device reports while busy, numbers poll at that fixed interval in seconds
+DEFAULT_POLL_INTERVALS = (None, 0.001, 0)
+
+TuningProfile = namedtuple('TuningProfile', 'transfer_size poll_interval bytes_per_second')
+Trial = namedtuple('Trial', 'transfer_size poll_interval seconds error')
+
+
+def profile_key(idvendor, idproduct, bcd_device=None):
+    '''Profiles are kept per bootloader: usb address and, when known, its release such as 0483:df11:2200'''
+    key = "{0:04x}:{1:04x}".format(idvendor, idproduct)
+    if bcd_device is None:
+        return key
+    return "{0}:{1:04x}".format(key, bcd_device)
+
+
+class ProfileStore(object):
+    '''Remembers the TuningProfile of each bootloader in a json file'''
+
+    def __init__(self, path):
+        self.path = path
+
+    def _load(self):
+        if not os.path.isfile(self.path):
+            return {}
+        with open(self.path) as store_file:
+            return json.load(store_file)
+
+    def get(self, key):
+        values = self._load().get(key)
+        return TuningProfile(**dict((str(name), value) for name, value in values.items())) if values else None
+
+    def _save(self, profiles):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as store_file:
+            json.dump(profiles, store_file)
+        if os.name == 'nt' and os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(temp_path, self.path)
+
+    def set(self, key, profile):
+        profiles = self._load()
+        profiles[key] = dict(profile._asdict())
+        self._save(profiles)
+
+    def forget(self, key):
+        profiles = self._load()
+        if profiles.pop(key, None) is not None:
+            self._save(profiles)
+
+
+class Autotuner(object):
+    '''Times writing a trial block of flash with every transfer size and poll interval, picking the fastest that
+    wrote and read back correctly every time. Tuning erases the sectors under the trial, so tune before flashing.
+
+    trial_size: bytes written per trial, from the start address
+    repeat: writes per candidate, a candidate failing any of them is unreliable'''
+
+    def __init__(self, transfer_sizes=DEFAULT_TRANSFER_SIZES, poll_intervals=DEFAULT_POLL_INTERVALS, trial_size=16 * 1024, repeat=1, clock=time.time, sleep=time.sleep):
+        self.transfer_sizes = transfer_sizes
+        self.poll_intervals = poll_intervals
+        self.trial_size = trial_size
+        self.repeat = repeat
+        self._clock = clock
+        self._sleep = sleep
+
+    def _trial_data(self):
+        return bytes(bytearray((index * 31 + 7) & 0xff for index in range(self.trial_size)))
+
+    def _trial(self, transport, layout, address, data, transfer_size, poll_interval):
+        engine = DfuSeEngine(transport, transfer_size=transfer_size, poll_interval=poll_interval, sleep=self._sleep)
+        seconds = 0.0
+        try:
+            for _ in range(self.repeat):
+                engine.ensure_idle()
+                engine.erase(address, len(data), layout)
+                started = self._clock()
+                engine.write(address, data)
+                seconds += self._clock() - started
+                if bytes(engine.read(address, len(data))) != data:
+                    raise DfuError("Trial block did not read back")
+        except (DfuError, IOError, OSError) as e:
+            logger.info("Transfer size {} polling {} is unreliable: {}".format(transfer_size, poll_interval, e))
+            # Recovering with defaults raises if the device is gone, ending the tuning
+            DfuSeEngine(transport, sleep=self._sleep).ensure_idle()
+            return Trial(transfer_size, poll_interval, None, str(e))
+        return Trial(transfer_size, poll_interval, seconds, None)
+
+    def trials(self, transport, layout, address=DEFAULT_ADDRESS):
+        '''Returns a Trial per candidate, with the seconds spent writing or the error that made it unreliable'''
+        if layout is None:
+            raise DfuError("Tuning needs the device's memory layout")
+        if address < layout.start or address + self.trial_size > layout.end:
+            raise DfuError("Trial of {} bytes at 0x{:08x} outside of {}".format(self.trial_size, address, layout.name))
+        data = self._trial_data()
+        return [
+            self._trial(transport, layout, address, data, transfer_size, poll_interval)
+            for transfer_size in self.transfer_sizes for poll_interval in self.poll_intervals
+        ]
+
+    def tune(self, transport, layout, address=DEFAULT_ADDRESS):
+        '''Returns the TuningProfile of the fastest reliable candidate, raising DfuError if none were reliable'''
+        reliable = [trial for trial in self.trials(transport, layout, address) if trial.error is None]
+        if not reliable:
+            raise DfuError("No reliable transfer size found")
+        best = min(reliable, key=lambda trial: trial.seconds)
+        bytes_per_second = self.trial_size * self.repeat / best.seconds if best.seconds > 0 else None
+        logger.info("Tuned to transfer size {} polling {}".format(best.transfer_size, best.poll_interval))
+        return TuningProfile(best.transfer_size, best.poll_interval, bytes_per_second)
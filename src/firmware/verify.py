@@ -0,0 +1,132 @@
+import sys
+import zlib
+import random
+import hashlib
+import logging
+from collections import namedtuple
+
+from .progress import PHASE_VERIFY
+
+logger = logging.getLogger('peachy')
+
+CHUNK_SIZE = 64 * 1024
+# Size of the ranges sampled when the memory layout, and so the sectors, are unknown
+SAMPLE_BLOCK_SIZE = 16 * 1024
+
+VerifyResult = namedtuple('VerifyResult', 'success checked_bytes mismatched_ranges')
+
+
+def _bytes(data):
+    # python 2's zlib cannot read a memoryview or bytearray
+    if sys.version_info[0] < 3 and isinstance(data, (memoryview, bytearray)):
+        return bytes(data) if isinstance(data, bytearray) else data.tobytes()
+    return data
+
+
+def crc32(data, crc=0):
+    return zlib.crc32(_bytes(data), crc) & 0xffffffff
+
+
+class ImageDigest(object):
+    '''CRC32 and SHA-256 of the bytes flashed at address, with the CRC32 of each range of it for sampled checks.
+
+    ranges: (start, length, crc32) for the part of the image in each sector, or in each SAMPLE_BLOCK_SIZE block without a layout'''
+
+    def __init__(self, address, length, crc32, sha256, ranges):
+        self.address = address
+        self.length = length
+        self.crc32 = crc32
+        self.sha256 = sha256
+        self.ranges = ranges
+
+    @staticmethod
+    def _ranges(address, length, layout):
+        end = address + length
+        if layout is None:
+            bounds = range(address, end, SAMPLE_BLOCK_SIZE)
+        else:
+            bounds = [max(sector.address, address) for sector in layout.sectors_for(address, length)]
+        bounds = list(bounds) + [end]
+        return [(start, stop - start) for start, stop in zip(bounds, bounds[1:])]
+
+    @classmethod
+    def compute(cls, address, data, layout=None):
+        data = memoryview(data)
+        sha = hashlib.sha256()
+        total = 0
+        ranges = []
+        for start, length in cls._ranges(address, len(data), layout):
+            range_crc = 0
+            for offset in range(start - address, start - address + length, CHUNK_SIZE):
+                chunk = data[offset:min(offset + CHUNK_SIZE, start - address + length)]
+                sha.update(_bytes(chunk))
+                total = crc32(chunk, total)
+                range_crc = crc32(chunk, range_crc)
+            ranges.append((start, length, range_crc))
+        return cls(address, len(data), total, sha.hexdigest(), ranges)
+
+    def matches(self, chunks):
+        '''True when chunks, read back from the whole of the flashed range, have this digest'''
+        sha = hashlib.sha256()
+        total = 0
+        length = 0
+        for chunk in chunks:
+            sha.update(_bytes(chunk))
+            total = crc32(chunk, total)
+            length += len(chunk)
+        return (length, total, sha.hexdigest()) == (self.length, self.crc32, self.sha256)
+
+    def __repr__(self):
+        return "ImageDigest(0x{0:08x}, {1}, crc32=0x{2:08x})".format(self.address, self.length, self.crc32)
+
+
+class FlashVerifier(object):
+    '''Reads flash back over DFU upload, updating the CRC32 and SHA-256 as each block arrives so nothing is buffered.
+
+    sample: check only this many ranges of the image picked at random, None checks all of it'''
+
+    def __init__(self, engine, sample=None, rng=None):
+        self.engine = engine
+        self.sample = sample
+        self._rng = rng or random.Random()
+
+    def _check(self, ranges, address, length, progress, checked=0, total=None):
+        '''Streams address to address + length, returning the ranges whose CRC32 differs and the SHA-256 of it all'''
+        sha = hashlib.sha256()
+        mismatched = []
+        index, position, range_crc = 0, address, 0
+        for chunk in self.engine.read_chunks(address, length):
+            sha.update(_bytes(chunk))
+            offset = 0
+            while offset < len(chunk):
+                start, range_length, expected = ranges[index]
+                take = min(start + range_length - position, len(chunk) - offset)
+                range_crc = crc32(chunk[offset:offset + take], range_crc)
+                offset += take
+                position += take
+                if position == start + range_length:
+                    if range_crc != expected:
+                        mismatched.append((start, range_length))
+                    index, range_crc = index + 1, 0
+            checked += len(chunk)
+            if progress:
+                progress(PHASE_VERIFY, 100 * checked // (total or length), checked)
+        if position < address + length:
+            logger.error("Read back stopped at 0x{0:08x}".format(position))
+            mismatched += [(start, range_length) for start, range_length, _ in ranges[index:]]
+        return mismatched, sha.hexdigest()
+
+    def verify(self, digest, progress=None):
+        '''Checks the flash against an ImageDigest, returning a VerifyResult naming each (start, length) range that differs'''
+        if self.sample is None or self.sample >= len(digest.ranges):
+            mismatched, sha256 = self._check(digest.ranges, digest.address, digest.length, progress)
+            success = not mismatched and sha256 == digest.sha256
+            return VerifyResult(success, digest.length, mismatched)
+        ranges = sorted(self._rng.sample(digest.ranges, self.sample))
+        total = sum(length for _, length, _ in ranges)
+        checked = 0
+        mismatched = []
+        for flash_range in ranges:
+            mismatched += self._check([flash_range], flash_range[0], flash_range[1], progress, checked, total)[0]
+            checked += flash_range[1]
+        return VerifyResult(not mismatched, checked, mismatched)
@@ -11,6 +11,7 @@ setup(
     author="Peachy Printer",
     author_email="software+peachyprintertools@peachyprinter.com",
     install_requires=[],
+    extras_require={'libusb': ['pyusb>=1.0']},
     packages=['firmware', ],
     py_modules=['VERSION'],
     include_package_data=True
@@ -0,0 +1,309 @@
+import sys
+import os
+import time
+import tempfile
+import unittest
+from mock import patch, MagicMock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'src'))
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+from firmware.firmware import LinuxFirmwareUpdater, LibUsbFirmwareUpdater
+from firmware.metrics import FlashMetrics
+from firmware.progress import PHASE_DOWNLOAD, PHASE_MANIFEST, PHASE_VERIFY
+from firmware.simulator import SimulatedDfuSeDevice
+from firmware.devices import UsbDevice
+
+if asyncio is not None:
+    from firmware.aio import AsyncFirmwareUpdater
+
+LSUSB_OUTPUT = b'Bus 001 Device 005: ID 0483:df11 STMicroelectronics STM Device in DFU Mode\n'
+DFU_UTIL_LIST_OUTPUT = b'Found DFU: [0483:df11] ver=2200, devnum=5, cfg=1, intf=0, alt=0, name="@Internal Flash  /0x08000000/04*016Kg", serial="3276365A3435"\n'
+DFU_UTIL_TRANSCRIPT = (
+    b'Downloading to address = 0x08000000, size = 4096\n'
+    b'Download\t[============             ]  50%         2048 bytes'
+    b'\rDownload\t[=========================] 100%         4096 bytes\n'
+    b'Download done.\n'
+    b'Transitioning to dfuMANIFEST state\n'
+)
+
+
+class FakeProcess(object):
+    '''Stands in for an asyncio.subprocess.Process'''
+
+    def __init__(self, loop, stdout=b'', stderr=b'', returncode=0, finished=True):
+        self.pid = 1234
+        self.returncode = None
+        self._loop = loop
+        self._output = (stdout, stderr)
+        self._exited = loop.create_future()
+        self.stdout = asyncio.StreamReader(loop=loop)
+        self.stderr = asyncio.StreamReader(loop=loop)
+        self.stdout.feed_data(stdout)
+        self.stderr.feed_data(stderr)
+        self.terminate = MagicMock(side_effect=self._exit)
+        self.kill = MagicMock(side_effect=self._exit)
+        if finished:
+            self.stdout.feed_eof()
+            self.stderr.feed_eof()
+            self._exit(returncode)
+
+    def _exit(self, returncode=-15):
+        if self.returncode is None:
+            self.returncode = returncode
+            self._exited.set_result(returncode)
+            self.stdout.feed_eof()
+            self.stderr.feed_eof()
+
+    def wait(self):
+        return self._exited
+
+    def communicate(self):
+        future = self._loop.create_future()
+        future.set_result(self._output)
+        return future
+
+
+class SlowTransport(object):
+    '''A simulated device taking a little time over every request'''
+
+    def __init__(self, device, delay=0.005):
+        self.device = device
+        self.delay = delay
+        self.closed = False
+
+    def __getattr__(self, name):
+        return getattr(self.device, name)
+
+    def control_out(self, request, value, data):
+        time.sleep(self.delay)
+        return self.device.control_out(request, value, data)
+
+    def close(self):
+        self.closed = True
+
+
+@unittest.skipIf(asyncio is None, "asyncio requires Python 3")
+class AsyncTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def completed(self, value):
+        future = self.loop.create_future()
+        future.set_result(value)
+        return future
+
+    def complete(self, awaitable):
+        return self.loop.run_until_complete(awaitable)
+
+
+class FakeBinaryLinuxFirmwareUpdater(LinuxFirmwareUpdater):
+    dfu_bin = 'dfu-util'
+
+
+@patch('firmware.aio.asyncio.create_subprocess_exec', new_callable=MagicMock)
+class TestAsyncFirmwareUpdaterSubprocess(AsyncTestCase):
+
+    def updater(self):
+        return AsyncFirmwareUpdater(FakeBinaryLinuxFirmwareUpdater('somepath', 0x0483, 0xdf11, 0x16d0, 0x0af3), loop=self.loop)
+
+    def test_list_usb_devices_should_count_lsusb_output(self, mock_exec):
+        mock_exec.return_value = self.completed(FakeProcess(self.loop, stdout=LSUSB_OUTPUT))
+
+        self.assertEquals((1, 0), self.complete(self.updater().list_usb_devices()))
+        mock_exec.assert_called_with('lsusb', stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+
+    def test_check_ready_should_be_true_for_one_bootloader(self, mock_exec):
+        mock_exec.return_value = self.completed(FakeProcess(self.loop, stdout=LSUSB_OUTPUT))
+
+        self.assertTrue(self.complete(self.updater().check_ready()))
+
+    def test_list_bootloaders_should_parse_dfu_util(self, mock_exec):
+        mock_exec.return_value = self.completed(FakeProcess(self.loop, stdout=DFU_UTIL_LIST_OUTPUT))
+
+        devices = self.complete(self.updater().list_bootloaders())
+
+        self.assertEquals(['3276365A3435'], [device.serial for device in devices])
+
+    def test_list_usb_devices_should_raise_when_command_fails(self, mock_exec):
+        mock_exec.return_value = self.completed(FakeProcess(self.loop, returncode=1))
+
+        with self.assertRaises(Exception):
+            self.complete(self.updater().list_usb_devices())
+
+    def test_update_should_fail_for_a_device_dfu_util_cannot_select(self, mock_exec):
+        result = self.complete(self.updater().update('firmware.bin', device=UsbDevice(0x0483, 0xdf11, port_path='1-2')))
+
+        self.assertFalse(result)
+        self.assertTrue('cannot select it by path' in result.error)
+        self.assertFalse(mock_exec.called)
+
+    def test_update_should_stream_progress_and_return_result(self, mock_exec):
+        mock_exec.return_value = self.completed(FakeProcess(self.loop, stdout=DFU_UTIL_TRANSCRIPT))
+        events = []
+
+        result = self.complete(self.updater().update('firmware.bin', device=UsbDevice(0x0483, 0xdf11, port_path='1-2', serial='3276365A3435'), progress_callback=events.append))
+
+        self.assertTrue(result)
+        self.assertEquals([(PHASE_DOWNLOAD, 50), (PHASE_DOWNLOAD, 100), (PHASE_MANIFEST, None)], [(e.phase, e.percent) for e in events])
+        args = mock_exec.call_args[0]
+        self.assertEquals(['-S', '3276365A3435'], list(args[-2:]))
+
+    def test_update_should_fail_with_exit_code(self, mock_exec):
+        mock_exec.return_value = self.completed(FakeProcess(self.loop, stderr=b'No DFU capable USB device available\n', returncode=74))
+
+        result = self.complete(self.updater().update('firmware.bin'))
+
+        self.assertFalse(result)
+        self.assertEquals(74, result.exit_code)
+        self.assertEquals('No DFU capable USB device available', result.error)
+
+    def test_start_update_should_iterate_progress_events(self, mock_exec):
+        mock_exec.return_value = self.completed(FakeProcess(self.loop, stdout=DFU_UTIL_TRANSCRIPT))
+        progress = self.updater().start_update('firmware.bin')
+
+        events = []
+        while True:
+            try:
+                events.append(self.complete(progress.__anext__()))
+            except StopAsyncIteration:
+                break
+
+        self.assertEquals(3, len(events))
+        self.assertTrue(self.complete(progress))
+
+    def test_cancel_should_terminate_dfu_util(self, mock_exec):
+        process = FakeProcess(self.loop, stdout=b'Download\t[====     ]  10%         512 bytes\r', finished=False)
+        mock_exec.return_value = self.completed(process)
+        progress = self.updater().start_update('firmware.bin')
+        self.complete(progress.__anext__())
+
+        progress.cancel()
+
+        with self.assertRaises(asyncio.CancelledError):
+            self.complete(progress)
+        process.terminate.assert_called_with()
+
+    def test_timeout_should_terminate_dfu_util(self, mock_exec):
+        process = FakeProcess(self.loop, finished=False)
+        mock_exec.return_value = self.completed(process)
+
+        with self.assertRaises(asyncio.TimeoutError):
+            self.complete(self.updater().update('firmware.bin', timeout=0.01))
+        process.terminate.assert_called_with()
+
+    def write_firmware(self, data):
+        handle, path = tempfile.mkstemp(suffix='.bin')
+        os.write(handle, data)
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def dfu_util_reading(self, flash):
+        def start(*command, **kwargs):
+            if '-U' in command:
+                with open(command[command.index('-U') + 1], 'wb') as upload:
+                    upload.write(flash)
+            return self.completed(FakeProcess(self.loop, stdout=DFU_UTIL_TRANSCRIPT))
+        return start
+
+    def test_update_should_read_back_and_leave_when_verifying(self, mock_exec):
+        firmware = b'\x5a' * 4096
+        mock_exec.side_effect = self.dfu_util_reading(firmware)
+        updater = self.updater()
+        updater.updater.verify = True
+
+        result = self.complete(updater.update(self.write_firmware(firmware), leave=True))
+
+        self.assertTrue(result)
+        self.assertTrue(PHASE_VERIFY in result.phases)
+        download, upload = [call[0] for call in mock_exec.call_args_list]
+        self.assertEquals('0x08000000', download[download.index('--dfuse-address') + 1])
+        self.assertEquals('0x08000000:4096:leave', upload[upload.index('--dfuse-address') + 1])
+
+    def test_update_should_fail_when_read_back_differs(self, mock_exec):
+        mock_exec.side_effect = self.dfu_util_reading(b'\x00' * 4096)
+        updater = self.updater()
+        updater.updater.verify = True
+
+        result = self.complete(updater.update(self.write_firmware(b'\x5a' * 4096)))
+
+        self.assertFalse(result)
+        self.assertEquals("Flash does not match the image", result.error)
+
+    def test_update_should_stop_stalled_dfu_util(self, mock_exec):
+        process = FakeProcess(self.loop, stdout=b'Download\t[====     ]  10%         512 bytes\r', finished=False)
+        mock_exec.return_value = self.completed(process)
+        updater = self.updater()
+        updater.updater.stall_timeout = 0.01
+
+        result = self.complete(updater.update('firmware.bin'))
+
+        self.assertFalse(result)
+        process.terminate.assert_called_with()
+
+    def test_update_should_record_metrics(self, mock_exec):
+        mock_exec.return_value = self.completed(FakeProcess(self.loop, stdout=DFU_UTIL_TRANSCRIPT))
+        updater = self.updater()
+        updater.updater.metrics = FlashMetrics()
+
+        self.complete(updater.update('firmware.bin'))
+
+        self.assertTrue('peachy_flash_successes_total{updater="fakebinarylinux"} 1' in updater.updater.metrics.prometheus())
+
+    def test_many_updates_should_run_concurrently_on_one_loop(self, mock_exec):
+        mock_exec.side_effect = lambda *args, **kwargs: self.completed(FakeProcess(self.loop, stdout=DFU_UTIL_TRANSCRIPT))
+        updater = self.updater()
+
+        results = self.complete(asyncio.gather(*[updater.update('firmware.bin', device=UsbDevice(0x0483, 0xdf11, port_path='1-{}'.format(i), serial='SN{}'.format(i))) for i in range(20)]))
+
+        self.assertEquals(20, len([result for result in results if result]))
+
+
+class TestAsyncFirmwareUpdaterLibUsb(AsyncTestCase):
+
+    def write_firmware(self, size):
+        import tempfile
+        handle, path = tempfile.mkstemp(suffix='.bin')
+        os.write(handle, b'\x01' * size)
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_update_should_flash_simulated_device(self):
+        device = SimulatedDfuSeDevice()
+        updater = AsyncFirmwareUpdater(LibUsbFirmwareUpdater(None, 0x0483, 0xdf11, 0x16d0, 0x0af3, transport_factory=lambda d: device), loop=self.loop)
+        events = []
+
+        result = self.complete(updater.update(self.write_firmware(5000), progress_callback=events.append))
+
+        self.assertTrue(result)
+        self.assertTrue(device.manifested)
+        self.assertEquals(PHASE_MANIFEST, events[-1].phase)
+
+    def test_cancel_should_stop_transfer_and_close_device(self):
+        transport = SlowTransport(SimulatedDfuSeDevice())
+        updater = AsyncFirmwareUpdater(LibUsbFirmwareUpdater(None, 0x0483, 0xdf11, 0x16d0, 0x0af3, transport_factory=lambda d: transport), loop=self.loop)
+        progress = updater.start_update(self.write_firmware(64 * 1024))
+        self.complete(progress.__anext__())
+
+        progress.cancel()
+
+        with self.assertRaises(asyncio.CancelledError):
+            self.complete(progress)
+        self.assertTrue(transport.closed)
+        self.assertFalse(transport.device.manifested)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+import sys
+import os
+import struct
+import unittest
+from mock import patch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'src'))
+
+from firmware.devices import UsbDevice, SysfsUsbEnumerator, DfuDescriptor, MODE_BOOTLOADER, MODE_PEACHY, parse_dfu_descriptor
+from firmware.firmware import LinuxFirmwareUpdater
+from firmware.simulator import SimulatedSysfs, STM32F4_LAYOUT, dfu_descriptors
+
+
+class TestSysfsUsbEnumerator(unittest.TestCase):
+
+    def setUp(self):
+        self.sysfs = SimulatedSysfs()
+        self.sysfs.add('usb1', 0x1d6b, 0x0002, devnum=1)
+        self.sysfs.add('1-1.2', 0x0483, 0xdf11, devnum=5, serial='3276365F3331')
+        self.sysfs.add_interface('1-1.2:1.0')
+        self.sysfs.add('2-3', 0x16d0, 0x0af3, busnum=2, devnum=7)
+        self.now = 100.0
+
+    def tearDown(self):
+        self.sysfs.cleanup()
+
+    def clock(self):
+        return self.now
+
+    def test_devices_should_list_device_records(self):
+        enumerator = SysfsUsbEnumerator(self.sysfs.root)
+
+        devices = enumerator.devices()
+
+        self.assertEquals(3, len(devices))
+        self.assertIn(UsbDevice(0x0483, 0xdf11, bus=1, port_path='1-1.2', serial='3276365F3331', devnum=5), devices)
+        self.assertIn(UsbDevice(0x16d0, 0x0af3, bus=2, port_path='2-3', serial=None, devnum=7), devices)
+
+    def test_root_hubs_should_have_no_port_path(self):
+        enumerator = SysfsUsbEnumerator(self.sysfs.root)
+
+        hub = enumerator.find(0x1d6b, 0x0002)[0]
+
+        self.assertEquals(None, hub.port_path)
+
+    def test_find_should_filter_by_vid_pid(self):
+        enumerator = SysfsUsbEnumerator(self.sysfs.root)
+
+        self.assertEquals(['1-1.2'], [device.port_path for device in enumerator.find(0x0483, 0xdf11)])
+
+    def test_devices_should_rescan_without_cache(self):
+        enumerator = SysfsUsbEnumerator(self.sysfs.root)
+        enumerator.devices()
+
+        self.sysfs.remove('2-3')
+
+        self.assertEquals([], enumerator.find(0x16d0, 0x0af3))
+
+    def test_devices_should_be_cached_within_ttl(self):
+        enumerator = SysfsUsbEnumerator(self.sysfs.root, cache_ttl=0.5, clock=self.clock)
+        enumerator.devices()
+        self.sysfs.remove('2-3')
+
+        self.now += 0.4
+        self.assertEquals(1, len(enumerator.find(0x16d0, 0x0af3)))
+
+        self.now += 0.1
+        self.assertEquals(0, len(enumerator.find(0x16d0, 0x0af3)))
+
+    def test_invalidate_should_force_rescan(self):
+        enumerator = SysfsUsbEnumerator(self.sysfs.root, cache_ttl=10, clock=self.clock)
+        enumerator.devices()
+        self.sysfs.remove('2-3')
+
+        enumerator.invalidate()
+
+        self.assertEquals(0, len(enumerator.find(0x16d0, 0x0af3)))
+
+    def test_missing_root_should_list_nothing(self):
+        enumerator = SysfsUsbEnumerator(os.path.join(self.sysfs.root, 'missing'))
+
+        self.assertEquals([], enumerator.devices())
+
+    def test_should_read_interface_names_and_descriptors(self):
+        self.sysfs.add('1-3', 0x0483, 0xdf11, bcd_device=0x2200, descriptors=dfu_descriptors())
+        self.sysfs.add_interface('1-3:1.0', STM32F4_LAYOUT)
+        enumerator = SysfsUsbEnumerator(self.sysfs.root)
+
+        self.assertEquals([STM32F4_LAYOUT], enumerator.read_interface_names('1-3'))
+        self.assertEquals(dfu_descriptors(), enumerator.read_descriptors('1-3'))
+        self.assertEquals(0x2200, enumerator.read_bcd_device('1-3'))
+        self.assertEquals(None, enumerator.read_descriptors('2-3'))
+
+
+class TestParseDfuDescriptor(unittest.TestCase):
+
+    def test_should_find_functional_descriptor_after_dfu_interface(self):
+        self.assertEquals(DfuDescriptor(0x0b, 255, 1024, 0x011a), parse_dfu_descriptor(dfu_descriptors(transfer_size=1024)))
+
+    def test_should_ignore_hid_descriptors(self):
+        hid_interface = struct.pack('<BBBBBBBBB', 9, 0x04, 0, 0, 1, 0x03, 0x00, 0x00, 0)
+        hid = struct.pack('<BBHBBBH', 9, 0x21, 0x0111, 0, 1, 0x22, 52)
+
+        self.assertEquals(None, parse_dfu_descriptor(hid_interface + hid))
+
+    def test_should_return_none_for_missing_or_truncated_descriptors(self):
+        self.assertEquals(None, parse_dfu_descriptor(None))
+        self.assertEquals(None, parse_dfu_descriptor(dfu_descriptors()[:-4]))
+
+
+@patch('firmware.firmware.Popen')
+class TestLinuxFirmwareUpdaterWithSysfs(unittest.TestCase):
+
+    def setUp(self):
+        self.sysfs = SimulatedSysfs()
+        self.enumerator = SysfsUsbEnumerator(self.sysfs.root)
+        self.updater = LinuxFirmwareUpdater('somepath', 0x0483, 0xdf11, 0x16d0, 0x0af3, usb_enumerator=self.enumerator)
+
+    def tearDown(self):
+        self.sysfs.cleanup()
+
+    def test_check_ready_should_return_true_if_1_bootloader(self, mock_Popen):
+        self.sysfs.add('1-1', 0x0483, 0xdf11)
+
+        self.assertTrue(self.updater.check_ready())
+        self.assertFalse(mock_Popen.called)
+
+    def test_check_ready_should_return_false_if_only_peachy(self, mock_Popen):
+        self.sysfs.add('1-1', 0x16d0, 0x0af3)
+
+        self.assertFalse(self.updater.check_ready())
+
+    def test_check_ready_should_raise_exception_if_multipule_bootloaders(self, mock_Popen):
+        self.sysfs.add('1-1', 0x0483, 0xdf11)
+        self.sysfs.add('1-2', 0x0483, 0xdf11)
+
+        with self.assertRaises(Exception):
+            self.updater.check_ready()
+
+    def test_list_bootloaders_should_return_devices_with_paths(self, mock_Popen):
+        self.sysfs.add('1-1', 0x0483, 0xdf11, serial='ABC')
+
+        self.assertEquals([('1-1', 'ABC')], [(d.port_path, d.serial) for d in self.updater.list_bootloaders()])
+        self.assertFalse(mock_Popen.called)
+
+    def test_list_devices_should_name_modes_of_bootloaders_and_printers_only(self, mock_Popen):
+        self.sysfs.add('1-1', 0x0483, 0xdf11)
+        self.sysfs.add('1-2', 0x16d0, 0x0af3)
+        self.sysfs.add('1-3', 0x046d, 0xc52b)
+
+        self.assertEquals([('1-1', MODE_BOOTLOADER), ('1-2', MODE_PEACHY)], [(r.key, r.mode) for r in self.updater.list_devices()])
+
+
+if __name__ == '__main__':
+    unittest.main()
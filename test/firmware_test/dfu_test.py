@@ -0,0 +1,190 @@
+import sys
+import os
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'src'))
+
+from firmware.dfu import DfuSeEngine, DfuError, MemoryLayout, MemorySector, DFU_DNLOAD, STATE_DFU_ERROR
+from firmware.simulator import SimulatedDfuSeDevice
+from firmware.firmware import LibUsbFirmwareUpdater
+
+
+class TestMemoryLayout(unittest.TestCase):
+
+    def test_parse_should_expand_sectors(self):
+        layout = MemoryLayout.parse('@Internal Flash  /0x08000000/04*016Kg,01*064Kg,07*128Kg')
+
+        self.assertEquals('Internal Flash', layout.name)
+        self.assertEquals(12, len(layout.sectors))
+        self.assertEquals(MemorySector(0x08000000, 16 * 1024, 7), layout.sectors[0])
+        self.assertEquals(MemorySector(0x08010000, 64 * 1024, 7), layout.sectors[4])
+        self.assertEquals(0x08100000, layout.end)
+
+    def test_parse_should_handle_multiple_regions_and_attributes(self):
+        layout = MemoryLayout.parse('@Option Bytes  /0x1FFFC000/01*016 e/0x1FFEC000/01*016 e')
+
+        self.assertEquals(2, len(layout.sectors))
+        self.assertEquals(0x1FFEC000, layout.sectors[1].address)
+        self.assertEquals(16, layout.sectors[0].size)
+        self.assertFalse(layout.sectors[0].erasable)
+        self.assertTrue(layout.sectors[0].writable)
+
+    def test_parse_should_raise_for_invalid_layout(self):
+        with self.assertRaises(DfuError):
+            MemoryLayout.parse('Internal Flash')
+
+    def test_sectors_for_should_return_overlapping_sectors(self):
+        layout = MemoryLayout.parse('@Internal Flash  /0x08000000/04*016Kg,01*064Kg,07*128Kg')
+
+        sectors = layout.sectors_for(0x08000000, 40 * 1024)
+
+        self.assertEquals([0x08000000, 0x08004000, 0x08008000], [s.address for s in sectors])
+
+
+class TestDfuSeEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.device = SimulatedDfuSeDevice()
+        self.layout = MemoryLayout.parse(self.device.interface_name)
+        self.sleeps = []
+        self.engine = DfuSeEngine(self.device, transfer_size=1024, sleep=self.sleeps.append)
+
+    def test_download_should_write_image_to_flash(self):
+        data = bytearray(range(256)) * 37
+
+        self.engine.download(0x08000000, data, self.layout)
+
+        self.assertEquals(bytes(data), self.device.read_flash(0x08000000, len(data)))
+
+    def test_download_should_only_erase_sectors_covering_image(self):
+        self.engine.download(0x08000000, b'\x01' * (20 * 1024), self.layout)
+
+        self.assertEquals([0x08000000, 0x08004000], self.device.erased_pages)
+
+    def test_download_should_mass_erase_without_layout(self):
+        self.engine.download(0x08000000, b'\x01' * 100, None)
+
+        self.assertEquals([None], self.device.erased_pages)
+
+    def test_download_should_respect_transfer_size(self):
+        self.engine.download(0x08000000, b'\x01' * 4096, self.layout)
+
+        data_blocks = [r for r in self.device.requests if r[0] == DFU_DNLOAD and r[1] >= 2]
+        self.assertEquals([1024] * 4, [r[2] for r in data_blocks])
+
+    def test_download_should_write_partial_final_block_to_correct_address(self):
+        data = bytearray(b'\x01' * 2048 + b'\x02' * 100)
+
+        self.engine.download(0x08000000, data, self.layout)
+
+        self.assertEquals(bytes(data), self.device.read_flash(0x08000000, len(data)))
+
+    def test_download_should_set_address_per_block_when_not_sequential(self):
+        engine = DfuSeEngine(self.device, transfer_size=1024, sequential_blocks=False)
+        data = bytearray(range(256)) * 12
+
+        engine.download(0x08000000, data, self.layout)
+
+        data_blocks = [r for r in self.device.requests if r[0] == DFU_DNLOAD and r[1] >= 2]
+        self.assertEquals([2, 2, 2], [r[1] for r in data_blocks])
+        self.assertEquals(bytes(data), self.device.read_flash(0x08000000, len(data)))
+
+    def test_download_should_raise_when_range_outside_flash(self):
+        with self.assertRaises(DfuError):
+            self.engine.download(0x080FFF00, b'\x01' * 1024, self.layout)
+
+    def test_write_should_raise_when_device_reports_error(self):
+        self.engine.write(0x08000000, b'\x00' * 16)
+
+        with self.assertRaises(DfuError) as context:
+            self.engine.write(0x08000000, b'\x01' * 16)
+
+        self.assertEquals(STATE_DFU_ERROR, context.exception.state)
+
+    def test_ensure_idle_should_clear_error_state(self):
+        self.device.state = STATE_DFU_ERROR
+        self.device.status = 0x06
+
+        self.engine.ensure_idle()
+
+        self.assertEquals(2, self.device.state)
+
+    def test_read_should_return_flash_contents(self):
+        data = bytearray(range(256)) * 9
+        self.engine.download(0x08000000, data, self.layout)
+
+        self.assertEquals(data, self.engine.read(0x08000000, len(data)))
+
+    def test_leave_should_manifest_device(self):
+        self.engine.download(0x08000000, b'\x01' * 100, self.layout)
+
+        self.engine.leave(0x08000000)
+
+        self.assertTrue(self.device.manifested)
+
+    def test_poll_interval_should_override_device_poll_timeout(self):
+        self.device.poll_timeout = 50
+        engine = DfuSeEngine(self.device, transfer_size=1024, poll_interval=0.001, sleep=self.sleeps.append)
+
+        engine.set_address(0x08000000)
+
+        self.assertEquals([0.001], self.sleeps)
+
+    def test_poll_should_honour_device_poll_timeout_by_default(self):
+        self.device.poll_timeout = 50
+
+        self.engine.set_address(0x08000000)
+
+        self.assertEquals([0.05], self.sleeps)
+
+
+class TestLibUsbFirmwareUpdater(unittest.TestCase):
+    BOOTLOADER_IDVENDOR = 0x0483
+    BOOTLOADER_IDPRODUCT = 0xdf11
+    PEACHY_IDVENDOR = 0x16d0
+    PEACHY_IDPRODUCT = 0x0af3
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.firmware_path = os.path.join(self.temp_dir, 'firmware.bin')
+        self.firmware = bytearray(range(256)) * 100
+        with open(self.firmware_path, 'wb') as firmware_file:
+            firmware_file.write(self.firmware)
+        self.device = SimulatedDfuSeDevice()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def get_updater(self, transport_factory):
+        return LibUsbFirmwareUpdater(None, self.BOOTLOADER_IDVENDOR, self.BOOTLOADER_IDPRODUCT, self.PEACHY_IDVENDOR, self.PEACHY_IDPRODUCT, transfer_size=2048, transport_factory=transport_factory)
+
+    def test_update_should_return_true_if_update_successfull(self):
+        updater = self.get_updater(lambda device: self.device)
+
+        result = updater.update(self.firmware_path)
+
+        self.assertTrue(result)
+        self.assertEquals(bytes(self.firmware), self.device.read_flash(0x08000000, len(self.firmware)))
+        self.assertTrue(self.device.manifested)
+
+    def test_update_should_return_false_if_update_not_successfull(self):
+        self.device.layout.sectors[0].attributes = 0x5
+        updater = self.get_updater(lambda device: self.device)
+
+        result = updater.update(self.firmware_path)
+
+        self.assertFalse(result)
+        self.assertFalse(self.device.manifested)
+
+    def test_update_should_return_false_if_device_cannot_be_opened(self):
+        def fail(device):
+            raise DfuError("No device found")
+        updater = self.get_updater(fail)
+
+        self.assertFalse(updater.update(self.firmware_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+import sys
+import os
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'src'))
+
+from firmware.devices import UsbDevice
+from firmware.dfu import DfuSeEngine, MemoryLayout, DFU_UPLOAD
+from firmware.differential import DifferentialFlasher, ImageHashStore
+from firmware.simulator import SimulatedDfuSeDevice
+from firmware.firmware import LibUsbFirmwareUpdater
+from firmware.progress import PHASE_COMPARE
+
+
+class TestDifferentialFlasher(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.device = SimulatedDfuSeDevice()
+        self.layout = MemoryLayout.parse(self.device.interface_name)
+        self.engine = DfuSeEngine(self.device)
+        self.image = bytearray(os.urandom(40 * 1024))
+        self.engine.download(0x08000000, self.image, self.layout)
+        self.device.erased_pages = []
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_flash_should_skip_everything_when_image_unchanged(self):
+        result = DifferentialFlasher(self.engine, self.layout).flash(0x08000000, self.image)
+
+        self.assertEquals([], result.written)
+        self.assertEquals(3, len(result.skipped))
+        self.assertEquals([], self.device.erased_pages)
+
+    def test_flash_should_only_rewrite_changed_sectors(self):
+        image = bytearray(self.image)
+        image[0x4100] ^= 0xff
+
+        result = DifferentialFlasher(self.engine, self.layout).flash(0x08000000, image)
+
+        self.assertEquals([0x08004000], [sector.address for sector in result.written])
+        self.assertEquals([0x08004000], self.device.erased_pages)
+        self.assertEquals(bytes(image), self.device.read_flash(0x08000000, len(image)))
+
+    def test_flash_should_write_partially_covered_last_sector(self):
+        image = bytearray(self.image[:36 * 1024])
+        image[-1] ^= 0xff
+
+        DifferentialFlasher(self.engine, self.layout).flash(0x08000000, image)
+
+        self.assertEquals([0x08008000], self.device.erased_pages)
+        self.assertEquals(bytes(image), self.device.read_flash(0x08000000, len(image)))
+
+    def test_flash_should_report_compare_progress(self):
+        events = []
+
+        DifferentialFlasher(self.engine, self.layout).flash(0x08000000, self.image, progress=lambda *args: events.append(args))
+
+        self.assertEquals((PHASE_COMPARE, 100, len(self.image)), events[-1])
+
+    def test_flash_should_only_read_back_the_first_sector_when_hash_store_matches(self):
+        store = ImageHashStore(os.path.join(self.temp_dir, 'hashes.json'))
+        flasher = DifferentialFlasher(self.engine, self.layout, store)
+        flasher.flash(0x08000000, self.image, device_key='3276365A3435')
+        self.device.requests = []
+
+        result = flasher.flash(0x08000000, self.image, device_key='3276365A3435')
+
+        self.assertEquals([], result.written)
+        self.assertEquals(16 * 1024, sum(r[2] for r in self.device.requests if r[0] == DFU_UPLOAD))
+
+    def test_flash_should_rewrite_a_different_unit_flashed_under_the_same_key(self):
+        store = ImageHashStore(os.path.join(self.temp_dir, 'hashes.json'))
+        image = bytearray(self.image)
+        image[0x10] ^= 0xff
+        store.set('3276365A3435', hashlib.sha256(image).hexdigest())
+
+        result = DifferentialFlasher(self.engine, self.layout, store).flash(0x08000000, image, device_key='3276365A3435')
+
+        self.assertEquals([0x08000000], [sector.address for sector in result.written])
+        self.assertEquals(bytes(image), self.device.read_flash(0x08000000, len(image)))
+
+    def test_flash_should_read_back_when_hash_store_differs(self):
+        store = ImageHashStore(os.path.join(self.temp_dir, 'hashes.json'))
+        store.set('1-1.2', 'somethingelse')
+        image = bytearray(self.image)
+        image[0] ^= 0xff
+
+        result = DifferentialFlasher(self.engine, self.layout, store).flash(0x08000000, image, device_key='1-1.2')
+
+        self.assertEquals([0x08000000], [sector.address for sector in result.written])
+        self.assertNotEquals('somethingelse', store.get('1-1.2'))
+
+
+class TestImageHashStore(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.store = ImageHashStore(os.path.join(self.temp_dir, 'hashes.json'))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_get_should_return_none_for_unknown_device(self):
+        self.assertEquals(None, self.store.get('1-1'))
+
+    def test_set_should_persist(self):
+        self.store.set('1-1', 'abc')
+
+        self.assertEquals('abc', ImageHashStore(self.store.path).get('1-1'))
+
+    def test_forget_should_remove(self):
+        self.store.set('1-1', 'abc')
+
+        self.store.forget('1-1')
+
+        self.assertEquals(None, self.store.get('1-1'))
+
+
+class TestLibUsbFirmwareUpdaterDifferential(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.firmware_path = os.path.join(self.temp_dir, 'firmware.bin')
+        self.firmware = bytearray(os.urandom(20 * 1024))
+        with open(self.firmware_path, 'wb') as firmware_file:
+            firmware_file.write(self.firmware)
+        self.device = SimulatedDfuSeDevice()
+        DfuSeEngine(self.device).download(0x08000000, self.firmware, MemoryLayout.parse(self.device.interface_name))
+        self.device.erased_pages = []
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_update_should_not_erase_when_differential_and_unchanged(self):
+        updater = LibUsbFirmwareUpdater(None, 0x0483, 0xdf11, 0x16d0, 0x0af3, transport_factory=lambda d: self.device)
+        updater.differential = True
+
+        result = updater.update(self.firmware_path)
+
+        self.assertTrue(result)
+        self.assertEquals([], self.device.erased_pages)
+        self.assertTrue(self.device.manifested)
+        self.assertIn(PHASE_COMPARE, result.phases)
+
+    def updater(self, device, store):
+        updater = LibUsbFirmwareUpdater(None, 0x0483, 0xdf11, 0x16d0, 0x0af3, transport_factory=lambda d: device)
+        updater.differential = True
+        updater.hash_store = store
+        return updater
+
+    def test_update_should_remember_images_by_bootloader_serial(self):
+        store = ImageHashStore(os.path.join(self.temp_dir, 'hashes.json'))
+        digest = hashlib.sha256(self.firmware).hexdigest()
+
+        self.assertTrue(self.updater(self.device, store).update(self.firmware_path, device=UsbDevice(0x0483, 0xdf11, port_path='1-1.2', serial='3276365A3435')))
+        self.assertTrue(self.updater(SimulatedDfuSeDevice(serial='3276365A3436'), store).update(self.firmware_path))
+
+        self.assertEquals([digest, digest, None], [store.get('3276365A3435'), store.get('3276365A3436'), store.get('1-1.2')])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,14 +1,22 @@
 import sys
 import os
+import shutil
+import tempfile
 from mock import patch, MagicMock
 import unittest
+from io import BytesIO
 from subprocess import PIPE
 
 # sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'src'))
 
 import firmware
-from firmware.firmware import FirmwareUpdater, MacFirmwareUpdater, LinuxFirmwareUpdater, WindowsFirmwareUpdater
+from firmware.firmware import FirmwareUpdater, MacFirmwareUpdater, LinuxFirmwareUpdater, WindowsFirmwareUpdater, LibUsbFirmwareUpdater
+from firmware.devices import UsbDevice, SysfsUsbEnumerator
+from firmware.hotplug import PollingEventSource, SysfsPollSource
+from firmware.progress import STAGE_ENTER_BOOTLOADER, STAGE_BOOTLOADER_ENUMERATION, STAGE_FLASH, STAGE_PEACHY_ENUMERATION
+from firmware.preflight import check, dependancies_path
+from firmware.simulator import SimulatedPrinter, SimulatedSysfs
 
 
 @patch('firmware.sys')
@@ -39,6 +47,12 @@ class TestFirmwareInit(unittest.TestCase):
         with self.assertRaises(Exception):
             firmware.get_firmware_updater()
 
+    def test_updater_should_carry_the_checked_dependancies(self, mock_sys):
+        mock_sys.platform = 'linux'
+        result = firmware.get_firmware_updater()
+        self.assertEquals((0, 8), result.dependancies['dfu-util'].version)
+        self.assertEquals(result.dependancies['dfu-util'].path, result.dfu_bin)
+
 
 @patch('firmware.firmware.Popen')
 @patch('firmware.os.path.isfile')
@@ -56,7 +70,8 @@ class TestLinuxFirmwareUpdater(unittest.TestCase):
 
     def test_update_should_return_true_if_update_successfull(self, mock_chmod, mock_stat, mock_isfile, mock_Popen):
         mock_isfile.return_value = True
-        mock_Popen.return_value.communicate.return_value = ('err', 'out')
+        mock_Popen.return_value.stdout = BytesIO(b'out')
+        mock_Popen.return_value.stderr = BytesIO(b'err')
         mock_Popen.return_value.wait.return_value = 0
         usb_addess = '{}:{}'.format('0483', 'df11')
         expected_command = [os.path.join(self.bin_path, 'dfu-util'), '-a', '0', '--dfuse-address', '0x08000000', '-D', self.firmware_path, '-d', usb_addess]
@@ -70,7 +85,8 @@ class TestLinuxFirmwareUpdater(unittest.TestCase):
 
     def test_update_should_return_false_if_update_not_successfull(self, mock_chmod, mock_stat, mock_isfile, mock_Popen):
         mock_isfile.return_value = True
-        mock_Popen.return_value.communicate.return_value = ('err', 'out')
+        mock_Popen.return_value.stdout = BytesIO(b'out')
+        mock_Popen.return_value.stderr = BytesIO(b'err')
         mock_Popen.return_value.wait.return_value = 34
         usb_addess = '{}:{}'.format('0483', 'df11')
         expected_command = [os.path.join(self.bin_path, 'dfu-util'), '-a', '0', '--dfuse-address', '0x08000000', '-D', self.firmware_path, '-d', usb_addess]
@@ -82,6 +98,159 @@ class TestLinuxFirmwareUpdater(unittest.TestCase):
         mock_Popen.assert_called_with(expected_command, stdout=PIPE, stderr=PIPE)
         mock_Popen.return_value.wait.assert_called_with()
 
+    def test_update_should_select_device_by_serial_before_path(self, mock_chmod, mock_stat, mock_isfile, mock_Popen):
+        mock_isfile.return_value = True
+        mock_Popen.return_value.stdout = BytesIO(b'out')
+        mock_Popen.return_value.stderr = BytesIO(b'err')
+        mock_Popen.return_value.wait.return_value = 0
+        device = UsbDevice(self.BOOTLOADER_IDVENDOR, self.BOOTLOADER_IDPRODUCT, port_path='1-1.2', serial='ABC')
+        expected_command = [os.path.join(self.bin_path, 'dfu-util'), '-a', '0', '--dfuse-address', '0x08000000', '-D', self.firmware_path, '-d', '0483:df11', '-S', 'ABC']
+
+        l_fw_up = LinuxFirmwareUpdater(self.bin_path, self.BOOTLOADER_IDVENDOR, self.BOOTLOADER_IDPRODUCT, self.PEACHY_IDVENDOR, self.PEACHY_IDPRODUCT)
+        l_fw_up.port_paths = True
+        l_fw_up.update(self.firmware_path, device=device)
+
+        mock_Popen.assert_called_with(expected_command, stdout=PIPE, stderr=PIPE)
+
+    def test_update_should_select_device_by_path_only_when_dfu_util_supports_paths(self, mock_chmod, mock_stat, mock_isfile, mock_Popen):
+        mock_isfile.return_value = True
+        mock_Popen.return_value.stdout = BytesIO(b'out')
+        mock_Popen.return_value.stderr = BytesIO(b'err')
+        mock_Popen.return_value.wait.return_value = 0
+        device = UsbDevice(self.BOOTLOADER_IDVENDOR, self.BOOTLOADER_IDPRODUCT, port_path='1-1.2')
+        expected_command = [os.path.join(self.bin_path, 'dfu-util'), '-a', '0', '--dfuse-address', '0x08000000', '-D', self.firmware_path, '-d', '0483:df11', '-p', '1-1.2']
+
+        l_fw_up = LinuxFirmwareUpdater(self.bin_path, self.BOOTLOADER_IDVENDOR, self.BOOTLOADER_IDPRODUCT, self.PEACHY_IDVENDOR, self.PEACHY_IDPRODUCT)
+        result = l_fw_up.update(self.firmware_path, device=device)
+        self.assertFalse(result)
+        self.assertEquals("Device {} has no serial, and this dfu-util cannot select it by path".format(device), result.error)
+        self.assertFalse(mock_Popen.called)
+        l_fw_up.port_paths = True
+        l_fw_up.update(self.firmware_path, device=device)
+
+        mock_Popen.assert_called_with(expected_command, stdout=PIPE, stderr=PIPE)
+
+    def test_update_should_select_sysfs_enumerated_devices_by_serial(self, mock_chmod, mock_stat, mock_isfile, mock_Popen):
+        mock_isfile.return_value = True
+        mock_Popen.return_value.stdout = BytesIO(b'out')
+        mock_Popen.return_value.stderr = BytesIO(b'err')
+        mock_Popen.return_value.wait.return_value = 0
+        sysfs = SimulatedSysfs()
+        self.addCleanup(sysfs.cleanup)
+        sysfs.add('1-1.2', self.BOOTLOADER_IDVENDOR, self.BOOTLOADER_IDPRODUCT, serial='3276365A3435')
+        expected_command = [os.path.join(self.bin_path, 'dfu-util'), '-a', '0', '--dfuse-address', '0x08000000', '-D', self.firmware_path, '-d', '0483:df11', '-S', '3276365A3435']
+
+        l_fw_up = LinuxFirmwareUpdater(self.bin_path, self.BOOTLOADER_IDVENDOR, self.BOOTLOADER_IDPRODUCT, self.PEACHY_IDVENDOR, self.PEACHY_IDPRODUCT, usb_enumerator=SysfsUsbEnumerator(sysfs.root))
+        l_fw_up.port_paths = check(os.path.join(dependancies_path('linux'), 'dfu-util')).paths
+        [device] = l_fw_up.list_bootloaders()
+        l_fw_up.update(self.firmware_path, device=device)
+
+        self.assertFalse(l_fw_up.port_paths)
+        mock_Popen.assert_called_with(expected_command, stdout=PIPE, stderr=PIPE)
+
+    def test_update_should_select_a_waited_for_bootloader_by_serial(self, mock_chmod, mock_stat, mock_isfile, mock_Popen):
+        mock_isfile.return_value = True
+        mock_Popen.return_value.stdout = BytesIO(b'out')
+        mock_Popen.return_value.stderr = BytesIO(b'err')
+        mock_Popen.return_value.wait.return_value = 0
+        sysfs = SimulatedSysfs()
+        self.addCleanup(sysfs.cleanup)
+        expected_command = [os.path.join(self.bin_path, 'dfu-util'), '-a', '0', '--dfuse-address', '0x08000000', '-D', self.firmware_path, '-d', '0483:df11', '-S', '3276365A3435']
+
+        l_fw_up = LinuxFirmwareUpdater(self.bin_path, self.BOOTLOADER_IDVENDOR, self.BOOTLOADER_IDPRODUCT, self.PEACHY_IDVENDOR, self.PEACHY_IDPRODUCT, usb_enumerator=SysfsUsbEnumerator(sysfs.root))
+
+        class ArrivingSource(SysfsPollSource):
+            arrived = False
+
+            def events(self, timeout):
+                if not self.arrived:
+                    sysfs.add('1-1.2', 0x0483, 0xdf11, serial='3276365A3435')
+                    self.arrived = True
+                return super(ArrivingSource, self).events(timeout)
+        l_fw_up.event_source_factory = lambda: ArrivingSource(l_fw_up.usb_enumerator, interval=0.01)
+        result = l_fw_up.update(self.firmware_path, device=l_fw_up.wait_for_bootloader(5))
+
+        self.assertTrue(result)
+        mock_Popen.assert_called_with(expected_command, stdout=PIPE, stderr=PIPE)
+
+    def test_update_should_leave_dfu_mode_when_asked(self, mock_chmod, mock_stat, mock_isfile, mock_Popen):
+        mock_isfile.return_value = True
+        mock_Popen.return_value.stdout = BytesIO(b'out')
+        mock_Popen.return_value.stderr = BytesIO(b'err')
+        mock_Popen.return_value.wait.return_value = 0
+        expected_command = [os.path.join(self.bin_path, 'dfu-util'), '-a', '0', '--dfuse-address', '0x08000000:leave', '-D', self.firmware_path, '-d', '0483:df11']
+
+        l_fw_up = LinuxFirmwareUpdater(self.bin_path, self.BOOTLOADER_IDVENDOR, self.BOOTLOADER_IDPRODUCT, self.PEACHY_IDVENDOR, self.PEACHY_IDPRODUCT)
+        l_fw_up.update(self.firmware_path, leave=True)
+
+        mock_Popen.assert_called_with(expected_command, stdout=PIPE, stderr=PIPE)
+
+    def test_update_and_leave_should_leave_dfu_mode(self, mock_chmod, mock_stat, mock_isfile, mock_Popen):
+        mock_isfile.return_value = True
+        mock_Popen.return_value.stdout = BytesIO(b'out')
+        mock_Popen.return_value.stderr = BytesIO(b'err')
+        mock_Popen.return_value.wait.return_value = 0
+        device = UsbDevice(self.BOOTLOADER_IDVENDOR, self.BOOTLOADER_IDPRODUCT, serial='ABC')
+        expected_command = [os.path.join(self.bin_path, 'dfu-util'), '-a', '0', '--dfuse-address', '0x08000000:leave', '-D', self.firmware_path, '-d', '0483:df11', '-S', 'ABC']
+
+        l_fw_up = LinuxFirmwareUpdater(self.bin_path, self.BOOTLOADER_IDVENDOR, self.BOOTLOADER_IDPRODUCT, self.PEACHY_IDVENDOR, self.PEACHY_IDPRODUCT)
+        l_fw_up.update_and_leave(self.firmware_path, device=device)
+
+        mock_Popen.assert_called_with(expected_command, stdout=PIPE, stderr=PIPE)
+
+    def test_update_should_pass_transfer_size_when_set(self, mock_chmod, mock_stat, mock_isfile, mock_Popen):
+        mock_isfile.return_value = True
+        mock_Popen.return_value.stdout = BytesIO(b'out')
+        mock_Popen.return_value.stderr = BytesIO(b'err')
+        mock_Popen.return_value.wait.return_value = 0
+        expected_command = [os.path.join(self.bin_path, 'dfu-util'), '-a', '0', '--dfuse-address', '0x08000000', '-D', self.firmware_path, '-d', '0483:df11', '-t', '2048']
+
+        l_fw_up = LinuxFirmwareUpdater(self.bin_path, self.BOOTLOADER_IDVENDOR, self.BOOTLOADER_IDPRODUCT, self.PEACHY_IDVENDOR, self.PEACHY_IDPRODUCT)
+        l_fw_up.transfer_size = 2048
+        l_fw_up.update(self.firmware_path)
+
+        mock_Popen.assert_called_with(expected_command, stdout=PIPE, stderr=PIPE)
+
+    def test_update_should_select_device_by_serial_without_path(self, mock_chmod, mock_stat, mock_isfile, mock_Popen):
+        mock_isfile.return_value = True
+        mock_Popen.return_value.stdout = BytesIO(b'out')
+        mock_Popen.return_value.stderr = BytesIO(b'err')
+        mock_Popen.return_value.wait.return_value = 0
+        device = UsbDevice(self.BOOTLOADER_IDVENDOR, self.BOOTLOADER_IDPRODUCT, serial='ABC')
+        expected_command = [os.path.join(self.bin_path, 'dfu-util'), '-a', '0', '--dfuse-address', '0x08000000', '-D', self.firmware_path, '-d', '0483:df11', '-S', 'ABC']
+
+        l_fw_up = LinuxFirmwareUpdater(self.bin_path, self.BOOTLOADER_IDVENDOR, self.BOOTLOADER_IDPRODUCT, self.PEACHY_IDVENDOR, self.PEACHY_IDPRODUCT)
+        l_fw_up.update(self.firmware_path, device=device)
+
+        mock_Popen.assert_called_with(expected_command, stdout=PIPE, stderr=PIPE)
+
+    def test_dfu_bin_should_be_checked_once(self, mock_chmod, mock_stat, mock_isfile, mock_Popen):
+        mock_isfile.return_value = True
+
+        l_fw_up = LinuxFirmwareUpdater(self.bin_path, self.BOOTLOADER_IDVENDOR, self.BOOTLOADER_IDPRODUCT, self.PEACHY_IDVENDOR, self.PEACHY_IDPRODUCT)
+
+        self.assertEquals(l_fw_up.dfu_bin, l_fw_up.dfu_bin)
+        self.assertEquals(1, mock_isfile.call_count)
+
+    def test_dfu_bin_should_raise_when_missing(self, mock_chmod, mock_stat, mock_isfile, mock_Popen):
+        mock_isfile.return_value = False
+
+        l_fw_up = LinuxFirmwareUpdater(self.bin_path, self.BOOTLOADER_IDVENDOR, self.BOOTLOADER_IDPRODUCT, self.PEACHY_IDVENDOR, self.PEACHY_IDPRODUCT)
+
+        with self.assertRaises(Exception):
+            l_fw_up.dfu_bin
+
+    def test_list_bootloaders_should_parse_dfu_util_list(self, mock_chmod, mock_stat, mock_isfile, mock_Popen):
+        mock_isfile.return_value = True
+        mock_Popen.return_value.communicate.return_value = (b'Found DFU: [0483:df11] ver=2200, devnum=5, cfg=1, intf=0, alt=0, name="@Internal Flash", serial="ABC"\n', b'')
+        mock_Popen.return_value.wait.return_value = 0
+
+        l_fw_up = LinuxFirmwareUpdater(self.bin_path, self.BOOTLOADER_IDVENDOR, self.BOOTLOADER_IDPRODUCT, self.PEACHY_IDVENDOR, self.PEACHY_IDPRODUCT)
+        result = l_fw_up.list_bootloaders()
+
+        self.assertEquals(['ABC'], [device.serial for device in result])
+        mock_Popen.assert_called_with([os.path.join(self.bin_path, 'dfu-util'), '-l', '-d', '0483:df11'], stdout=PIPE, stderr=PIPE)
+
     def test_check_ready_should_return_true_if_1_bootloader(self, mock_chmod, mock_stat, mock_isfile, mock_Popen):
 
         mock_Popen.return_value.communicate.return_value = ('{:04x}:{:04x}'.format(self.BOOTLOADER_IDVENDOR, self.BOOTLOADER_IDPRODUCT), '')
@@ -249,5 +418,68 @@ class TestWindowsFirmwareUpdater(unittest.TestCase):
 
         mock_Popen.assert_called_with('''wmic.exe path WIN32_PnPEntity where "DeviceID like 'USB\\\\VID_%'" get HardwareID''', stdout=PIPE, stderr=PIPE)
 
+
+class TestFlashCycle(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.firmware_path = os.path.join(self.temp_dir, 'firmware.bin')
+        with open(self.firmware_path, 'wb') as firmware_file:
+            firmware_file.write(b'\x01' * 5000)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def updater(self, printer):
+        updater = LibUsbFirmwareUpdater(None, 0x0483, 0xdf11, 0x16d0, 0x0af3, transport_factory=lambda device: printer.bootloader)
+        updater.event_source_factory = lambda: PollingEventSource(printer.scan, interval=0.001)
+        updater._scan_devices = printer.scan
+        return updater
+
+    def test_flash_cycle_should_enter_bootloader_flash_and_wait_for_peachy(self):
+        printer = SimulatedPrinter(reenumeration_delay=0.01)
+
+        result = self.updater(printer).flash_cycle(self.firmware_path, enter_bootloader=printer.enter_bootloader, timeout=5)
+
+        self.assertTrue(result)
+        self.assertEquals([STAGE_ENTER_BOOTLOADER, STAGE_BOOTLOADER_ENUMERATION, STAGE_FLASH, STAGE_PEACHY_ENUMERATION], list(result.stages.keys()))
+        self.assertTrue(result.stages[STAGE_BOOTLOADER_ENUMERATION] >= 0.01)
+        self.assertTrue(result.update)
+        self.assertEquals((0x16d0, 0x0af3), (result.device.idvendor, result.device.idproduct))
+        self.assertEquals(b'\x01' * 5000, printer.bootloader.read_flash(0x08000000, 5000))
+        self.assertFalse(printer.in_bootloader)
+
+    def test_flash_cycle_should_not_enter_bootloader_when_already_there(self):
+        printer = SimulatedPrinter()
+        printer.enter_bootloader()
+        enter_bootloader = MagicMock()
+
+        result = self.updater(printer).flash_cycle(self.firmware_path, enter_bootloader=enter_bootloader, timeout=5)
+
+        self.assertTrue(result)
+        self.assertFalse(enter_bootloader.called)
+        self.assertEquals(1, printer.bootloader_entries)
+
+    def test_flash_cycle_should_fail_when_bootloader_does_not_appear(self):
+        printer = SimulatedPrinter()
+
+        result = self.updater(printer).flash_cycle(self.firmware_path, enter_bootloader=lambda: None, timeout=0.05)
+
+        self.assertFalse(result)
+        self.assertEquals('Bootloader did not appear', result.error)
+        self.assertEquals([STAGE_ENTER_BOOTLOADER, STAGE_BOOTLOADER_ENUMERATION], list(result.stages.keys()))
+        self.assertEquals(None, result.update)
+
+    def test_flash_cycle_should_fail_when_peachy_does_not_return(self):
+        printer = SimulatedPrinter(reenumeration_delay=10)
+        printer.enter_bootloader()
+        printer._attached_at = 0
+
+        result = self.updater(printer).flash_cycle(self.firmware_path, timeout=0.1)
+
+        self.assertFalse(result)
+        self.assertTrue(result.update)
+        self.assertEquals('Peachy did not return after flashing', result.error)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,151 @@
+import sys
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'src'))
+
+from firmware.devices import UsbDevice, parse_dfu_util_list
+from firmware.fleet import FleetUpdater, DeviceLock, DeviceBusyError
+
+DFU_UTIL_LIST = '''dfu-util 0.8
+
+Copyright 2005-2009 Weston Schmidt, Harald Welte and OpenMoko Inc.
+
+Found DFU: [0483:df11] ver=2200, devnum=5, cfg=1, intf=0, alt=1, name="@Option Bytes  /0x1FFFC000/01*016 e", serial="3276365F3331"
+Found DFU: [0483:df11] ver=2200, devnum=5, cfg=1, intf=0, alt=0, name="@Internal Flash  /0x08000000/04*016Kg,01*064Kg,07*128Kg", serial="3276365F3331"
+Found DFU: [0483:df11] ver=2200, devnum=7, cfg=1, intf=0, path="2-1.3", alt=0, name="@Internal Flash  /0x08000000/04*016Kg,01*064Kg,07*128Kg", serial="UNKNOWN"
+Found DFU: [1234:5678] ver=0100, devnum=9, cfg=1, intf=0, alt=0, name="Other", serial="ABC"
+'''
+
+
+class FakeUpdater(object):
+    def __init__(self, duration=0.0, failing=()):
+        self.duration = duration
+        self.failing = failing
+        self.active = 0
+        self.max_active = 0
+        self.flashed = []
+        self._lock = threading.Lock()
+
+    def list_bootloaders(self):
+        return [UsbDevice(0x0483, 0xdf11, serial='SERIAL{}'.format(i)) for i in range(4)]
+
+    def update(self, firmware_path, device=None):
+        with self._lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(self.duration)
+        with self._lock:
+            self.active -= 1
+            self.flashed.append(device)
+        if device.serial in self.failing:
+            raise Exception("Boom")
+        return True
+
+
+class TestParseDfuUtilList(unittest.TestCase):
+
+    def test_should_return_one_device_per_attached_bootloader(self):
+        devices = parse_dfu_util_list(DFU_UTIL_LIST, 0x0483, 0xdf11)
+
+        self.assertEquals(2, len(devices))
+        self.assertEquals('3276365F3331', devices[0].serial)
+        self.assertEquals(5, devices[0].devnum)
+        self.assertEquals(None, devices[0].port_path)
+
+    def test_should_parse_path_and_ignore_unknown_serial(self):
+        device = parse_dfu_util_list(DFU_UTIL_LIST, 0x0483, 0xdf11)[1]
+
+        self.assertEquals('2-1.3', device.port_path)
+        self.assertEquals(2, device.bus)
+        self.assertEquals(None, device.serial)
+
+    def test_should_return_nothing_for_no_devices(self):
+        self.assertEquals([], parse_dfu_util_list('dfu-util 0.8\n', 0x0483, 0xdf11))
+
+
+class TestDeviceLock(unittest.TestCase):
+
+    def setUp(self):
+        self.lock_dir = tempfile.mkdtemp()
+        self.device = UsbDevice(0x0483, 0xdf11, port_path='1-1.2')
+
+    def tearDown(self):
+        shutil.rmtree(self.lock_dir)
+
+    def test_second_lock_on_same_device_should_raise(self):
+        with DeviceLock(self.device, self.lock_dir):
+            with self.assertRaises(DeviceBusyError):
+                DeviceLock(self.device, self.lock_dir).acquire()
+
+    def test_locks_on_different_devices_should_not_collide(self):
+        other = UsbDevice(0x0483, 0xdf11, port_path='1-1.3')
+        with DeviceLock(self.device, self.lock_dir):
+            with DeviceLock(other, self.lock_dir):
+                pass
+
+    def test_lock_should_be_reusable_after_release(self):
+        with DeviceLock(self.device, self.lock_dir):
+            pass
+        with DeviceLock(self.device, self.lock_dir):
+            pass
+
+
+class TestFleetUpdater(unittest.TestCase):
+
+    def setUp(self):
+        self.lock_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.lock_dir)
+
+    def test_update_all_should_flash_every_bootloader(self):
+        updater = FakeUpdater()
+        fleet = FleetUpdater(updater, max_workers=4, lock_dir=self.lock_dir)
+
+        results = fleet.update_all('firmware.bin')
+
+        self.assertEquals(4, len(results))
+        self.assertTrue(all(result.success for result in results))
+        self.assertEquals(set(updater.list_bootloaders()), set(updater.flashed))
+
+    def test_update_all_should_flash_concurrently_up_to_max_workers(self):
+        updater = FakeUpdater(duration=0.05)
+        fleet = FleetUpdater(updater, max_workers=2, lock_dir=self.lock_dir)
+
+        fleet.update_all('firmware.bin')
+
+        self.assertEquals(2, updater.max_active)
+
+    def test_update_all_should_report_failures_per_device(self):
+        updater = FakeUpdater(failing=('SERIAL1',))
+        fleet = FleetUpdater(updater, lock_dir=self.lock_dir)
+
+        results = fleet.update_all('firmware.bin')
+
+        self.assertEquals([True, False, True, True], [result.success for result in results])
+        self.assertEquals('Boom', results[1].error)
+
+    def test_update_all_should_skip_devices_locked_elsewhere(self):
+        updater = FakeUpdater()
+        fleet = FleetUpdater(updater, lock_dir=self.lock_dir)
+        device = updater.list_bootloaders()[0]
+
+        with DeviceLock(device, self.lock_dir):
+            results = fleet.update_all('firmware.bin')
+
+        self.assertFalse(results[0].success)
+        self.assertNotIn(device, updater.flashed)
+
+    def test_update_all_should_return_empty_list_without_devices(self):
+        fleet = FleetUpdater(FakeUpdater(), lock_dir=self.lock_dir)
+
+        self.assertEquals([], fleet.update_all('firmware.bin', devices=[]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,242 @@
+import sys
+import os
+import socket
+import struct
+import threading
+import unittest
+from mock import patch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'src'))
+
+from firmware.devices import UsbDevice, SysfsUsbEnumerator
+from firmware.hotplug import HotplugEvent, UeventSource, PollingEventSource, SysfsPollSource
+from firmware.firmware import FirmwareUpdater, LinuxFirmwareUpdater
+from firmware.simulator import SimulatedSysfs
+
+UEVENT_ADD = (b'add@/devices/pci0000:00/0000:00:14.0/usb1/1-1/1-1.2\0ACTION=add\0DEVPATH=/devices/pci0000:00/0000:00:14.0/usb1/1-1/1-1.2\0'
+              b'SUBSYSTEM=usb\0DEVTYPE=usb_device\0PRODUCT=483/df11/2200\0TYPE=0/0/0\0BUSNUM=001\0DEVNUM=005\0SEQNUM=4242\0')
+UEVENT_INTERFACE = (b'add@/devices/pci0000:00/0000:00:14.0/usb1/1-1/1-1.2/1-1.2:1.0\0ACTION=add\0DEVPATH=/devices/pci0000:00/0000:00:14.0/usb1/1-1/1-1.2/1-1.2:1.0\0'
+                    b'SUBSYSTEM=usb\0DEVTYPE=usb_interface\0PRODUCT=483/df11/2200\0')
+
+
+
+def udev_message(kernel_message):
+    '''kernel_message as udev resends it, its properties after a libudev header'''
+    properties = b'\0'.join(kernel_message.split(b'\0')[1:])
+    header = b'libudev\0' + struct.pack('>I', 0xfeedcafe) + struct.pack('=IIIIIII', 40, 40, len(properties), 0, 0, 0, 0)
+    return header + properties
+
+
+class FakeEventSource(object):
+    def __init__(self, events):
+        self._events = list(events)
+        self.closed = False
+        self.timeouts = []
+
+    def events(self, timeout):
+        self.timeouts.append(timeout)
+        if self._events:
+            return [self._events.pop(0)]
+        return []
+
+    def close(self):
+        self.closed = True
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class TestUeventSource(unittest.TestCase):
+
+    def test_parse_should_return_usb_device_events(self):
+        self.assertEquals(HotplugEvent('add', 0x0483, 0xdf11, '1-1.2'), UeventSource.parse(UEVENT_ADD))
+
+    def test_parse_should_ignore_interface_events(self):
+        self.assertEquals(None, UeventSource.parse(UEVENT_INTERFACE))
+
+    def test_parse_should_read_udev_messages(self):
+        self.assertEquals(HotplugEvent('add', 0x0483, 0xdf11, '1-1.2'), UeventSource.parse(udev_message(UEVENT_ADD)))
+        self.assertEquals(None, UeventSource.parse(udev_message(UEVENT_INTERFACE)))
+
+    def test_parse_should_ignore_udev_messages_with_the_wrong_magic(self):
+        message = bytearray(udev_message(UEVENT_ADD))
+        message[8] ^= 0xff
+
+        self.assertEquals(None, UeventSource.parse(bytes(message)))
+
+    @patch('firmware.hotplug.os.path.exists')
+    def test_should_listen_for_udev_events_when_udev_is_running(self, mock_exists):
+        mock_exists.return_value = True
+        self.assertEquals(UeventSource.UDEV_GROUP, UeventSource.default_group())
+        mock_exists.assert_called_with('/run/udev/control')
+
+        mock_exists.return_value = False
+        self.assertEquals(UeventSource.KERNEL_GROUP, UeventSource.default_group())
+
+    def test_events_should_read_from_socket(self):
+        reader, writer = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        source = UeventSource(reader)
+        writer.send(UEVENT_ADD)
+
+        events = source.events(1.0)
+
+        self.assertEquals([HotplugEvent('add', 0x0483, 0xdf11, '1-1.2')], events)
+        source.close()
+        writer.close()
+
+    def test_events_should_skip_interface_and_unparseable_messages_before_device_events(self):
+        reader, writer = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        source = UeventSource(reader)
+        writer.send(UEVENT_INTERFACE)
+        writer.send(UEVENT_ADD.replace(b'PRODUCT=483/df11', b'PRODUCT=zz/df11'))
+        writer.send(UEVENT_ADD)
+
+        events = source.events(0)
+
+        self.assertEquals([HotplugEvent('add', 0x0483, 0xdf11, '1-1.2')], events)
+        source.close()
+        writer.close()
+
+    def test_events_should_return_when_another_reader_took_the_message_select_reported(self):
+        reader, writer = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        source = UeventSource(reader)
+        results = []
+        with patch('firmware.hotplug.select.select', side_effect=[([reader], [], []), ([], [], [])]):
+            drainer = threading.Thread(target=lambda: results.append(source.events(0)))
+            drainer.daemon = True
+            drainer.start()
+            drainer.join(1.0)
+
+        self.assertEquals([[]], results)
+        source.close()
+        writer.close()
+
+    def test_events_should_return_empty_on_timeout(self):
+        reader, writer = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        source = UeventSource(reader)
+
+        self.assertEquals([], source.events(0.01))
+        source.close()
+        writer.close()
+
+
+class TestPollingEventSource(unittest.TestCase):
+
+    def test_events_should_report_added_and_removed_devices(self):
+        clock = FakeClock()
+        peachy = UsbDevice(0x16d0, 0x0af3, port_path='1-1')
+        bootloader = UsbDevice(0x0483, 0xdf11, port_path='1-1')
+        scans = [[peachy], [bootloader]]
+        source = PollingEventSource(lambda: scans.pop(0), interval=0.1, sleep=clock.sleep, clock=clock)
+
+        events = source.events(1.0)
+
+        self.assertEquals(set([HotplugEvent('add', 0x0483, 0xdf11, '1-1'), HotplugEvent('remove', 0x16d0, 0x0af3, '1-1')]), set(events))
+
+    def test_events_should_return_empty_after_timeout(self):
+        clock = FakeClock()
+        source = PollingEventSource(lambda: [], interval=0.1, sleep=clock.sleep, clock=clock)
+
+        self.assertEquals([], source.events(0.35))
+        self.assertAlmostEqual(0.35, clock.now)
+
+
+class TestSysfsPollSource(unittest.TestCase):
+
+    def setUp(self):
+        self.sysfs = SimulatedSysfs()
+        self.clock = FakeClock()
+        self.source = SysfsPollSource(SysfsUsbEnumerator(self.sysfs.root), interval=0.05, sleep=self.clock.sleep, clock=self.clock)
+
+    def tearDown(self):
+        self.sysfs.cleanup()
+
+    def test_events_should_report_new_sysfs_devices(self):
+        self.sysfs.add('1-1.2', 0x0483, 0xdf11)
+
+        self.assertEquals([HotplugEvent('add', 0x0483, 0xdf11, '1-1.2')], self.source.events(1.0))
+
+    def test_events_should_report_removed_sysfs_devices(self):
+        self.sysfs.add('1-1.2', 0x0483, 0xdf11)
+        self.source.events(1.0)
+        self.sysfs.remove('1-1.2')
+
+        self.assertEquals([HotplugEvent('remove', 0x0483, 0xdf11, '1-1.2')], self.source.events(1.0))
+
+    def test_events_should_retry_devices_without_attributes_yet(self):
+        self.sysfs.add_interface('1-1.3')
+        self.assertEquals([], self.source.events(0.1))
+
+        self.sysfs.remove('1-1.3')
+        self.sysfs.add('1-1.3', 0x0483, 0xdf11)
+
+        self.assertEquals([HotplugEvent('add', 0x0483, 0xdf11, '1-1.3')], self.source.events(1.0))
+
+
+class TestWaitForDevice(unittest.TestCase):
+
+    def setUp(self):
+        self.sysfs = SimulatedSysfs()
+        self.updater = LinuxFirmwareUpdater('somepath', 0x0483, 0xdf11, 0x16d0, 0x0af3, usb_enumerator=SysfsUsbEnumerator(self.sysfs.root))
+
+    def tearDown(self):
+        self.sysfs.cleanup()
+
+    def test_wait_for_bootloader_should_return_when_bootloader_added(self):
+        source = FakeEventSource([HotplugEvent('add', 0x16d0, 0x0af3, '1-1'), HotplugEvent('add', 0x0483, 0xdf11, '1-2')])
+        self.updater.event_source_factory = lambda: source
+
+        device = self.updater.wait_for_bootloader(5)
+
+        self.assertEquals('1-2', device.port_path)
+        self.assertTrue(source.closed)
+
+    def test_wait_for_peachy_should_return_when_peachy_added(self):
+        source = FakeEventSource([HotplugEvent('remove', 0x0483, 0xdf11, '1-2'), HotplugEvent('add', 0x16d0, 0x0af3, '1-2')])
+        self.updater.event_source_factory = lambda: source
+
+        device = self.updater.wait_for_peachy(5)
+
+        self.assertEquals((0x16d0, 0x0af3, '1-2'), (device.idvendor, device.idproduct, device.port_path))
+
+    def test_wait_for_bootloader_should_return_immediately_if_already_attached(self):
+        self.sysfs.add('1-2', 0x0483, 0xdf11, serial='ABC')
+        source = FakeEventSource([])
+        self.updater.event_source_factory = lambda: source
+
+        device = self.updater.wait_for_bootloader(5)
+
+        self.assertEquals('ABC', device.serial)
+        self.assertEquals([], source.timeouts)
+
+    def test_wait_for_bootloader_should_return_none_on_timeout(self):
+        source = FakeEventSource([])
+        self.updater.event_source_factory = lambda: source
+
+        self.assertEquals(None, self.updater.wait_for_bootloader(0.01))
+        self.assertTrue(source.closed)
+
+    def test_wait_for_bootloader_should_fall_back_to_polling_list_usb_devices(self):
+        class CountingUpdater(FirmwareUpdater):
+            counts = [(0, 1), (0, 1), (1, 0)]
+
+            def list_usb_devices(self):
+                return self.counts.pop(0) if len(self.counts) > 1 else self.counts[0]
+
+        updater = CountingUpdater('somepath', 0x0483, 0xdf11, 0x16d0, 0x0af3)
+
+        device = updater.wait_for_bootloader(5)
+
+        self.assertEquals((0x0483, 0xdf11), (device.idvendor, device.idproduct))
+
+
+if __name__ == '__main__':
+    unittest.main()
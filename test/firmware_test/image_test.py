@@ -0,0 +1,306 @@
+import sys
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from io import BytesIO
+from mock import patch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'src'))
+
+from firmware.image import (
+    ImageError, ImageCache, FirmwareImage, Segment, DfuSuffix, dfu_crc, parse_hex, parse_dfuse, load_image,
+)
+from firmware.firmware import LinuxFirmwareUpdater, LibUsbFirmwareUpdater
+from firmware.simulator import SimulatedDfuSeDevice
+
+HEX_IMAGE = (
+    ':020000040800F2\n'
+    ':0400000001020304F2\n'
+    ':0400040005060708DE\n'
+    ':00000001FF\n'
+)
+
+
+class ImageTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write(self, name, content):
+        path = os.path.join(self.temp_dir, name)
+        with open(path, 'wb') as image_file:
+            image_file.write(content)
+        return path
+
+
+class TestParseHex(unittest.TestCase):
+
+    def test_should_join_consecutive_records_at_extended_address(self):
+        image = parse_hex(HEX_IMAGE)
+
+        self.assertEquals(1, len(image.segments))
+        self.assertEquals(0x08000000, image.start)
+        self.assertEquals(b'\x01\x02\x03\x04\x05\x06\x07\x08', image.to_bin().tobytes())
+
+    def test_should_raise_on_checksum_mismatch(self):
+        with self.assertRaises(ImageError):
+            parse_hex(':0400000001020304F3\n')
+
+    def test_should_raise_on_bad_hex(self):
+        with self.assertRaises(ImageError):
+            parse_hex(':04000000010203ZZF2\n')
+
+    def test_should_raise_on_wrong_length(self):
+        with self.assertRaises(ImageError):
+            parse_hex(':0500000001020304F1\n')
+
+    def test_should_round_trip_through_to_hex(self):
+        image = FirmwareImage([Segment(0x0800fff8, memoryview(bytearray(range(32))))])
+
+        again = parse_hex(image.to_hex())
+
+        self.assertEquals(image.digest(), again.digest())
+
+
+class TestDfuSe(unittest.TestCase):
+
+    def test_should_round_trip_segments_and_alternates(self):
+        image = FirmwareImage([
+            Segment(0x08000000, memoryview(bytearray(b'\x01' * 10))),
+            Segment(0x08004000, memoryview(bytearray(b'\x02' * 6))),
+            Segment(0x1fff7800, memoryview(bytearray(b'\x03' * 4)), alt=1),
+        ])
+
+        again = parse_dfuse(image.to_dfuse(0x0483, 0xdf11))
+
+        self.assertEquals([(0, 0x08000000, 10), (0, 0x08004000, 6), (1, 0x1fff7800, 4)], [(s.alt, s.address, len(s.data)) for s in again.segments])
+        self.assertEquals(0x0483, again.suffix.idvendor)
+        self.assertEquals(image.digest(), again.digest())
+
+    def test_should_raise_on_crc_mismatch(self):
+        data = bytearray(FirmwareImage([Segment(0x08000000, memoryview(bytearray(b'\x01' * 10)))]).to_dfuse())
+        data[20] ^= 0xff
+
+        with self.assertRaises(ImageError):
+            parse_dfuse(data)
+
+    def test_dfu_crc_should_match_dfu_util(self):
+        self.assertEquals(0x340bc6d9, dfu_crc(b'123456789'))
+
+
+class TestFirmwareImageValidate(unittest.TestCase):
+
+    def test_should_raise_when_outside_flash(self):
+        image = FirmwareImage([Segment(0x20000000, memoryview(bytearray(4)))])
+
+        with self.assertRaises(ImageError):
+            image.validate()
+
+    def test_should_raise_when_segments_overlap(self):
+        image = FirmwareImage([Segment(0x08000000, memoryview(bytearray(8))), Segment(0x08000004, memoryview(bytearray(8)))])
+
+        with self.assertRaises(ImageError):
+            image.validate()
+
+    def test_should_raise_when_empty(self):
+        with self.assertRaises(ImageError):
+            FirmwareImage([]).validate()
+
+    def test_should_raise_without_main_flash_data(self):
+        image = FirmwareImage([Segment(0x1fffc000, memoryview(bytearray(16)), 1)])
+
+        with self.assertRaises(ImageError):
+            image.validate()
+        with self.assertRaises(ImageError):
+            image.to_bin()
+
+    def test_to_bin_should_fill_gaps(self):
+        image = FirmwareImage([Segment(0x08000000, memoryview(bytearray(b'\x01\x01'))), Segment(0x08000004, memoryview(bytearray(b'\x02')))])
+
+        self.assertEquals(b'\x01\x01\xff\xff\x02', image.to_bin().tobytes())
+
+
+class TestLoadImage(ImageTestCase):
+
+    def test_should_place_raw_binary_at_address(self):
+        path = self.write('firmware.bin', b'\x01\x02\x03')
+
+        with load_image(path, 0x08004000) as image:
+            self.assertEquals(0x08004000, image.start)
+            self.assertEquals(b'\x01\x02\x03', image.to_bin().tobytes())
+            self.assertEquals(None, image.suffix)
+
+    def test_should_strip_dfu_suffix_from_binary(self):
+        body = b'\x01\x02\x03'
+        path = self.write('firmware.bin', body + DfuSuffix(idvendor=0x0483).pack(body))
+
+        with load_image(path) as image:
+            self.assertEquals(body, image.to_bin().tobytes())
+            self.assertEquals(0x0483, image.suffix.idvendor)
+
+    def test_should_load_dfuse_and_hex_by_content_and_extension(self):
+        expected = parse_hex(HEX_IMAGE)
+        dfu_path = self.write('firmware.dfu', expected.to_dfuse())
+        hex_path = self.write('firmware.hex', HEX_IMAGE.encode('ascii'))
+
+        with load_image(dfu_path) as dfu_image:
+            self.assertEquals(expected.digest(), dfu_image.digest())
+        self.assertEquals(expected.digest(), load_image(hex_path).digest())
+
+    def test_should_load_empty_file(self):
+        path = self.write('firmware.bin', b'')
+
+        with load_image(path) as image:
+            with self.assertRaises(ImageError):
+                image.validate()
+
+
+class TestImageCache(ImageTestCase):
+
+    def test_should_convert_hex_to_binary(self):
+        cache = ImageCache(os.path.join(self.temp_dir, 'cache'))
+        path = self.write('firmware.hex', HEX_IMAGE.encode('ascii'))
+
+        binary_path, start = cache.prepare(path)
+
+        self.assertEquals(0x08000000, start)
+        with open(binary_path, 'rb') as binary_file:
+            self.assertEquals(b'\x01\x02\x03\x04\x05\x06\x07\x08', binary_file.read())
+
+    def test_should_not_reconvert_or_rehash_unchanged_image(self):
+        cache = ImageCache(os.path.join(self.temp_dir, 'cache'))
+        path = self.write('firmware.hex', HEX_IMAGE.encode('ascii'))
+        first = cache.prepare(path)
+
+        with patch('firmware.image.load_image') as mock_load_image:
+            with patch('firmware.image.hashlib.sha256') as mock_sha256:
+                second = cache.prepare(path)
+
+        self.assertEquals(first, second)
+        self.assertFalse(mock_load_image.called)
+        self.assertFalse(mock_sha256.called)
+
+    def test_should_share_conversion_between_identical_files(self):
+        cache = ImageCache(os.path.join(self.temp_dir, 'cache'))
+        first = cache.prepare(self.write('a.hex', HEX_IMAGE.encode('ascii')))
+
+        with patch('firmware.image.load_image') as mock_load_image:
+            second = cache.prepare(self.write('b.hex', HEX_IMAGE.encode('ascii')))
+
+        self.assertEquals(first, second)
+        self.assertFalse(mock_load_image.called)
+
+    def test_should_prepare_the_same_image_from_two_threads_at_once(self):
+        cache_dir = os.path.join(self.temp_dir, 'cache')
+        path = self.write('firmware.bin', os.urandom(64 * 1024))
+        rename = os.rename
+        both_written = threading.Event()
+        renames = []
+        results, errors = [], []
+
+        def rename_once_both_written(source, destination):
+            # Holds the first rename back until the other thread has written its binary too
+            renames.append(source)
+            if len(renames) >= 2:
+                both_written.set()
+            both_written.wait(2)
+            rename(source, destination)
+
+        def prepare():
+            try:
+                results.append(ImageCache(cache_dir).prepare(path))
+            except Exception as e:
+                errors.append(e)
+        with patch('firmware.image.os.rename', side_effect=rename_once_both_written):
+            threads = [threading.Thread(target=prepare) for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEquals([], errors)
+        self.assertEquals(1, len(set(results)))
+        with open(results[0][0], 'rb') as binary_file:
+            with open(path, 'rb') as source:
+                self.assertEquals(source.read(), binary_file.read())
+        self.assertEquals([], [name for name in os.listdir(cache_dir) if name.endswith('.tmp')])
+
+    def test_should_raise_for_invalid_image(self):
+        cache = ImageCache(os.path.join(self.temp_dir, 'cache'))
+        path = self.write('firmware.hex', b':020000042000DA\n:0400000001020304F2\n:00000001FF\n')
+
+        with self.assertRaises(ImageError):
+            cache.prepare(path)
+
+
+@patch('firmware.firmware.Popen')
+class TestLinuxFirmwareUpdaterImages(ImageTestCase):
+
+    def updater(self):
+        self.write('dfu-util', b'')
+        updater = LinuxFirmwareUpdater(self.temp_dir, 0x0483, 0xdf11, 0x16d0, 0x0af3)
+        updater.image_cache = ImageCache(os.path.join(self.temp_dir, 'cache'))
+        return updater
+
+    def test_update_should_flash_converted_binary_at_image_start(self, mock_Popen):
+        mock_Popen.return_value.stdout = BytesIO(b'')
+        mock_Popen.return_value.stderr = BytesIO(b'')
+        mock_Popen.return_value.wait.return_value = 0
+        path = self.write('firmware.hex', b':020000040800F2\n:0440000001020304B2\n:00000001FF\n')
+
+        self.assertTrue(self.updater().update(path))
+
+        args = mock_Popen.call_args[0][0]
+        self.assertEquals('0x08004000', args[args.index('--dfuse-address') + 1])
+        self.assertTrue(args[args.index('-D') + 1].endswith('.bin'))
+
+    def test_update_should_fail_before_running_dfu_util_for_invalid_image(self, mock_Popen):
+        path = self.write('firmware.hex', b':0400000001020304F3\n')
+
+        result = self.updater().update(path)
+
+        self.assertFalse(result)
+        self.assertFalse(mock_Popen.called)
+
+    def test_update_should_fail_for_dfuse_image_with_only_option_bytes(self, mock_Popen):
+        image = FirmwareImage([Segment(0x1fffc000, memoryview(bytearray(b'\xaa\x55\xff\x00')), 1)])
+        path = self.write('option-bytes.dfu', image.to_dfuse())
+
+        result = self.updater().update(path)
+
+        self.assertFalse(result)
+        self.assertTrue('alt setting 0' in result.error)
+        self.assertFalse(mock_Popen.called)
+
+
+class TestLibUsbFirmwareUpdaterImages(ImageTestCase):
+
+    def test_update_should_flash_dfuse_image(self):
+        device = SimulatedDfuSeDevice()
+        image = FirmwareImage([Segment(0x08004000, memoryview(bytearray(b'\x01\x02\x03\x04')))])
+        path = self.write('firmware.dfu', image.to_dfuse())
+        updater = LibUsbFirmwareUpdater(None, 0x0483, 0xdf11, 0x16d0, 0x0af3, transport_factory=lambda d: device)
+
+        self.assertTrue(updater.update(path))
+
+        self.assertEquals(b'\x01\x02\x03\x04', device.read_flash(0x08004000, 4))
+        self.assertEquals([0x08004000], device.erased_pages)
+
+    def test_update_should_not_open_device_for_invalid_image(self):
+        path = self.write('firmware.hex', b':0400000001020304F2\n:00000001FF\n')
+        opened = []
+        updater = LibUsbFirmwareUpdater(None, 0x0483, 0xdf11, 0x16d0, 0x0af3, transport_factory=opened.append)
+
+        result = updater.update(path)
+
+        self.assertFalse(result)
+        self.assertEquals([], opened)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,227 @@
+import sys
+import os
+import socket
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'src'))
+
+from firmware.devices import SysfsUsbEnumerator, DfuDescriptor, MODE_BOOTLOADER, MODE_PEACHY
+from firmware.firmware import LinuxFirmwareUpdater
+from firmware.hotplug import HotplugEvent, UeventSource
+from firmware.inventory import DeviceInventory
+from firmware.simulator import SimulatedSysfs, STM32F4_LAYOUT, dfu_descriptors
+
+MODES = {(0x0483, 0xdf11): MODE_BOOTLOADER, (0x16d0, 0x0af3): MODE_PEACHY}
+
+
+class QueuedEventSource(object):
+    def __init__(self):
+        self.queued = []
+        self.closed = False
+
+    def events(self, timeout):
+        events, self.queued = self.queued, []
+        return events
+
+    def close(self):
+        self.closed = True
+
+
+class OverlapDetectingEventSource(QueuedEventSource):
+    '''Waits briefly inside events for a second caller, recording the most callers it has seen at once'''
+    def __init__(self):
+        super(OverlapDetectingEventSource, self).__init__()
+        self._lock = threading.Lock()
+        self._entered = threading.Event()
+        self.inside = 0
+        self.most_inside = 0
+
+    def events(self, timeout):
+        with self._lock:
+            self.inside += 1
+            self.most_inside = max(self.most_inside, self.inside)
+        if self.inside > 1:
+            self._entered.set()
+        else:
+            self._entered.wait(0.1)
+        with self._lock:
+            self.inside -= 1
+        return super(OverlapDetectingEventSource, self).events(timeout)
+
+
+class CountingEnumerator(SysfsUsbEnumerator):
+    def __init__(self, root):
+        super(CountingEnumerator, self).__init__(root)
+        self.reads = []
+
+    def read_device(self, name):
+        self.reads.append(name)
+        return super(CountingEnumerator, self).read_device(name)
+
+
+class TestDeviceInventory(unittest.TestCase):
+
+    def setUp(self):
+        self.sysfs = SimulatedSysfs()
+        self.sysfs.add('usb1', 0x1d6b, 0x0002, devnum=1)
+        self.add_bootloader('1-1.2')
+        self.sysfs.add('2-3', 0x16d0, 0x0af3, busnum=2, devnum=7, serial='PEACHY')
+        self.sysfs.add('2-4', 0x046d, 0xc52b, busnum=2, devnum=8)
+        self.enumerator = CountingEnumerator(self.sysfs.root)
+        self.source = QueuedEventSource()
+        self.inventory = DeviceInventory(self.enumerator, MODES, self.source)
+
+    def tearDown(self):
+        self.sysfs.cleanup()
+
+    def add_bootloader(self, name, serial='3276365F3331'):
+        self.sysfs.add(name, 0x0483, 0xdf11, devnum=5, serial=serial, bcd_device=0x2200, descriptors=dfu_descriptors())
+        self.sysfs.add_interface(name + ':1.0', STM32F4_LAYOUT)
+
+    def test_should_describe_bootloaders_with_dfu_details(self):
+        bootloader = self.inventory.get('1-1.2')
+
+        self.assertEquals(MODE_BOOTLOADER, bootloader.mode)
+        self.assertEquals((0x0483, 0xdf11, 1, '3276365F3331'), (bootloader.idvendor, bootloader.idproduct, bootloader.bus, bootloader.serial))
+        self.assertEquals(DfuDescriptor(0x0b, 255, 2048, 0x011a), bootloader.dfu)
+        self.assertEquals(STM32F4_LAYOUT, bootloader.layout)
+        self.assertEquals(0x2200, bootloader.bcd_device)
+
+    def test_devices_should_skip_root_hubs_and_filter_by_mode(self):
+        self.assertEquals(['1-1.2', '2-3', '2-4'], [record.key for record in self.inventory.devices()])
+        self.assertEquals(['2-3'], [record.key for record in self.inventory.devices(MODE_PEACHY)])
+        self.assertEquals(None, self.inventory.get('2-4').mode)
+
+    def test_should_drop_devices_whose_removal_follows_interface_uevents(self):
+        reader, writer = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        inventory = DeviceInventory(self.enumerator, MODES, UeventSource(reader))
+        inventory.devices()
+        self.sysfs.remove('1-1.2:1.0')
+        self.sysfs.remove('1-1.2')
+        devpath = b'/devices/pci0000:00/0000:00:14.0/usb1/1-1/1-1.2'
+        for action, name, devtype in [(b'remove', devpath + b'/1-1.2:1.0', b'usb_interface'),
+                                      (b'unbind', devpath + b'/1-1.2:1.0', b'usb_interface'),
+                                      (b'unbind', devpath, b'usb_device'),
+                                      (b'remove', devpath, b'usb_device')]:
+            writer.send(action + b'@' + name + b'\0ACTION=' + action + b'\0DEVPATH=' + name + b'\0SUBSYSTEM=usb\0DEVTYPE=' +
+                        devtype + b'\0PRODUCT=483/df11/2200\0')
+
+        self.assertEquals(['2-3', '2-4'], [record.key for record in inventory.devices()])
+        inventory.close()
+        writer.close()
+
+    def test_concurrent_lookups_should_drain_the_event_source_one_at_a_time(self):
+        source = OverlapDetectingEventSource()
+        inventory = DeviceInventory(self.enumerator, MODES, source)
+        inventory.devices()
+        lookups = [threading.Thread(target=inventory.devices) for _ in range(2)]
+
+        for lookup in lookups:
+            lookup.start()
+        for lookup in lookups:
+            lookup.join()
+
+        self.assertEquals(1, source.most_inside)
+
+    def test_lookups_should_not_rescan(self):
+        self.inventory.devices()
+        del self.enumerator.reads[:]
+
+        self.inventory.devices()
+        self.inventory.get('2-3')
+        self.inventory.find(0x0483, 0xdf11)
+
+        self.assertEquals([], self.enumerator.reads)
+
+    def test_should_read_only_added_devices(self):
+        self.inventory.devices()
+        del self.enumerator.reads[:]
+        self.add_bootloader('1-1.3', serial='SECOND')
+        self.source.queued.append(HotplugEvent('add', 0x0483, 0xdf11, '1-1.3'))
+
+        bootloaders = self.inventory.devices(MODE_BOOTLOADER)
+
+        self.assertEquals(['1-1.2', '1-1.3'], [record.key for record in bootloaders])
+        self.assertEquals(['1-1.3'], self.enumerator.reads)
+
+    def test_should_drop_removed_devices(self):
+        self.inventory.devices()
+        self.sysfs.remove('2-3')
+        self.source.queued.append(HotplugEvent('remove', 0x16d0, 0x0af3, '2-3'))
+
+        self.assertEquals(None, self.inventory.get('2-3'))
+
+    def test_should_retry_devices_added_before_their_attributes(self):
+        self.inventory.devices()
+        os.mkdir(os.path.join(self.sysfs.root, '1-4'))
+        self.source.queued.append(HotplugEvent('add', 0x16d0, 0x0af3, '1-4'))
+        self.assertEquals(None, self.inventory.get('1-4'))
+        os.rmdir(os.path.join(self.sysfs.root, '1-4'))
+
+        self.sysfs.add('1-4', 0x16d0, 0x0af3)
+
+        self.assertEquals(MODE_PEACHY, self.inventory.get('1-4').mode)
+
+    def test_should_ignore_interface_and_root_hub_events(self):
+        self.inventory.devices()
+        del self.enumerator.reads[:]
+        self.source.queued += [HotplugEvent('add', 0x0483, 0xdf11, '1-1.2:1.0'), HotplugEvent('add', 0x1d6b, 0x0002, 'usb2')]
+
+        self.inventory.devices()
+
+        self.assertEquals([], self.enumerator.reads)
+
+    def test_refresh_should_reread_everything(self):
+        self.inventory.devices()
+        self.sysfs.add('1-5', 0x16d0, 0x0af3)
+
+        self.inventory.refresh()
+
+        self.assertTrue(self.inventory.get('1-5') is not None)
+
+    def test_close_should_close_the_event_source(self):
+        self.inventory.devices()
+
+        self.inventory.close()
+
+        self.assertTrue(self.source.closed)
+
+    def test_records_should_serialise(self):
+        record = self.inventory.get('1-1.2').to_dict()
+
+        self.assertEquals(('1-1.2', '0483:df11', MODE_BOOTLOADER, 2048), (record['key'], record['usb_address'], record['mode'], record['dfu']['transfer_size']))
+        self.assertEquals([STM32F4_LAYOUT], record['layouts'])
+
+
+class TestLinuxFirmwareUpdaterWithInventory(unittest.TestCase):
+
+    def setUp(self):
+        self.sysfs = SimulatedSysfs()
+        self.sysfs.add('1-1', 0x0483, 0xdf11, serial='ABC', descriptors=dfu_descriptors())
+        self.enumerator = CountingEnumerator(self.sysfs.root)
+        self.source = QueuedEventSource()
+        self.updater = LinuxFirmwareUpdater('somepath', 0x0483, 0xdf11, 0x16d0, 0x0af3, usb_enumerator=self.enumerator)
+        self.updater.inventory = DeviceInventory(self.enumerator, self.updater.device_modes, self.source)
+
+    def tearDown(self):
+        self.sysfs.cleanup()
+
+    def test_should_answer_from_the_index(self):
+        self.assertTrue(self.updater.check_ready())
+        self.assertEquals(['ABC'], [device.serial for device in self.updater.list_bootloaders()])
+        self.assertEquals([2048], [record.dfu.transfer_size for record in self.updater.list_devices()])
+        self.assertEquals(['1-1'], self.enumerator.reads)
+
+    def test_should_follow_the_printer_returning(self):
+        self.updater.check_ready()
+        self.sysfs.remove('1-1')
+        self.sysfs.add('1-1', 0x16d0, 0x0af3)
+        self.source.queued += [HotplugEvent('remove', 0x0483, 0xdf11, '1-1'), HotplugEvent('add', 0x16d0, 0x0af3, '1-1')]
+
+        self.assertEquals((0, 1), self.updater.list_usb_devices())
+        self.assertEquals([('1-1', MODE_PEACHY)], [(record.key, record.mode) for record in self.updater.list_devices()])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,170 @@
+import sys
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from io import StringIO
+from mock import patch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'src'))
+
+from firmware.devices import UsbDevice
+from firmware.firmware import LibUsbFirmwareUpdater, LinuxFirmwareUpdater
+from firmware.hotplug import PollingEventSource
+from firmware.metrics import (
+    FlashMetrics, Histogram, updater_name, ATTEMPTS, SUCCESSES, FAILURES, RETRIES, ENUMERATION, ERASE, DOWNLOAD, MANIFEST, REENUMERATION,
+)
+from firmware.resumable import RetryPolicy
+from firmware.simulator import SimulatedDfuSeDevice, SimulatedPrinter, FAIL_STALL
+
+START = 0x08000000
+
+
+class EventStream(StringIO):
+    def write(self, text):
+        return StringIO.write(self, type(u'')(text))
+
+    def events(self):
+        return [json.loads(line) for line in self.getvalue().splitlines()]
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_should_count_observations_in_every_bucket_they_fit(self):
+        histogram = Histogram((1.0, 2.0, 4.0))
+
+        for value in (0.5, 1.5, 3.0, 8.0):
+            histogram.observe(value)
+
+        self.assertEquals([1, 2, 3], histogram.counts)
+        self.assertEquals((4, 13.0), (histogram.count, histogram.sum))
+
+
+class TestFlashMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.firmware_path = os.path.join(self.temp_dir, 'firmware.bin')
+        with open(self.firmware_path, 'wb') as firmware_file:
+            firmware_file.write(b'\x01' * 5000)
+        self.events = EventStream()
+        self.metrics = FlashMetrics(self.events, host='station-1', clock=lambda: 1000.0)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def updater(self, device=None):
+        device = device or SimulatedDfuSeDevice()
+        updater = LibUsbFirmwareUpdater(None, 0x0483, 0xdf11, 0x16d0, 0x0af3, transport_factory=lambda d: device)
+        updater.metrics = self.metrics
+        return updater
+
+    def test_update_should_count_attempt_and_success_and_time_phases(self):
+        updater = self.updater()
+
+        self.assertTrue(updater.update(self.firmware_path, UsbDevice(0x0483, 0xdf11, port_path='1-1.4')))
+
+        self.assertEquals((1, 1, 0), tuple(self.metrics.counter(name, updater) for name in (ATTEMPTS, SUCCESSES, FAILURES)))
+        for phase in (ERASE, DOWNLOAD, MANIFEST):
+            self.assertEquals(1, self.metrics.latency(phase, updater).count)
+        self.assertEquals(1, self.metrics.throughput(updater).count)
+        event, = self.events.events()
+        self.assertEquals(('update', 'station-1', 'libusb', '1-1.4', 5000, True, 0), (
+            event['event'], event['host'], event['updater'], event['device'], event['firmware_size'], event['success'], event['retries']))
+        self.assertTrue(event['bytes_per_second'] > 0)
+        self.assertEquals(set([ERASE, DOWNLOAD, MANIFEST, 'setup']), set(event['phases']))
+
+    def test_update_should_still_report_progress_to_callback(self):
+        events = []
+
+        self.updater().update(self.firmware_path, progress_callback=events.append)
+
+        self.assertEquals(5000, [event for event in events if event.phase == DOWNLOAD][-1].bytes)
+
+    def test_update_should_count_retries(self):
+        device = SimulatedDfuSeDevice()
+        device.fail_at(START + 2048, FAIL_STALL, times=2)
+        updater = self.updater(device)
+        updater.transfer_size = 1024
+        updater.retry_policy = RetryPolicy(initial_delay=0)
+
+        self.assertTrue(updater.update(self.firmware_path))
+
+        self.assertEquals(2, self.metrics.counter(RETRIES, updater))
+        self.assertEquals(2, self.events.events()[0]['retries'])
+
+    def test_update_should_count_failures(self):
+        updater = self.updater()
+
+        self.assertFalse(updater.update(os.path.join(self.temp_dir, 'missing.bin')))
+
+        self.assertEquals((1, 0, 1), tuple(self.metrics.counter(name, updater) for name in (ATTEMPTS, SUCCESSES, FAILURES)))
+        event, = self.events.events()
+        self.assertEquals((False, None), (event['success'], event['firmware_size']))
+        self.assertTrue(event['error'])
+
+    @patch('firmware.firmware.Popen')
+    def test_update_should_count_failure_when_update_raises(self, mock_Popen):
+        open(os.path.join(self.temp_dir, 'dfu-util'), 'w').close()
+        mock_Popen.side_effect = OSError("dfu-util would not start")
+        updater = LinuxFirmwareUpdater(self.temp_dir, 0x0483, 0xdf11, 0x16d0, 0x0af3)
+        updater.metrics = self.metrics
+
+        with self.assertRaises(OSError):
+            updater.update(self.firmware_path)
+
+        self.assertEquals(1, self.metrics.counter(FAILURES, updater))
+        self.assertEquals('dfu-util would not start', self.events.events()[0]['error'])
+
+    def test_check_ready_should_time_enumeration(self):
+        updater = self.updater()
+        updater.list_usb_devices = lambda: (1, 0)
+
+        self.assertTrue(updater.check_ready())
+
+        self.assertEquals(1, self.metrics.latency(ENUMERATION, updater).count)
+
+    def test_flash_cycle_should_time_reenumeration(self):
+        printer = SimulatedPrinter(reenumeration_delay=0.01)
+        updater = self.updater(printer.bootloader)
+        updater._transport_factory = lambda device: printer.bootloader
+        updater.event_source_factory = lambda: PollingEventSource(printer.scan, interval=0.001)
+        updater._scan_devices = printer.scan
+
+        self.assertTrue(updater.flash_cycle(self.firmware_path, enter_bootloader=printer.enter_bootloader, timeout=5))
+
+        self.assertEquals(2, self.metrics.latency(REENUMERATION, updater).count)
+        self.assertEquals(1, self.metrics.latency(ENUMERATION, updater).count)
+        self.assertEquals(['update', 'cycle'], [event['event'] for event in self.events.events()])
+        self.assertEquals(4, len(self.events.events()[1]['stages']))
+
+    def test_should_record_nothing_without_metrics(self):
+        updater = self.updater()
+        updater.metrics = None
+
+        self.assertTrue(updater.update(self.firmware_path))
+
+        self.assertEquals('', self.events.getvalue())
+
+    def test_prometheus_should_export_counters_and_histograms(self):
+        updater = self.updater()
+        updater.update(self.firmware_path)
+        updater.update(os.path.join(self.temp_dir, 'missing.bin'))
+
+        text = self.metrics.prometheus()
+
+        self.assertTrue('# TYPE peachy_flash_attempts_total counter\npeachy_flash_attempts_total{updater="libusb"} 2\n' in text)
+        self.assertTrue('peachy_flash_successes_total{updater="libusb"} 1\n' in text)
+        self.assertTrue('peachy_flash_failures_total{updater="libusb"} 1\n' in text)
+        self.assertTrue('# TYPE peachy_flash_latency_seconds histogram\n' in text)
+        self.assertTrue('peachy_flash_latency_seconds_bucket{operation="download",updater="libusb",le="+Inf"} 1\n' in text)
+        self.assertTrue('peachy_flash_latency_seconds_count{operation="erase",updater="libusb"} 1\n' in text)
+        self.assertTrue('peachy_flash_throughput_bytes_per_second_count{updater="libusb"} 1\n' in text)
+
+    def test_updater_name_should_drop_class_suffix(self):
+        self.assertEquals('linux', updater_name(LinuxFirmwareUpdater(None, 0, 0, 0, 0)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,216 @@
+import sys
+import os
+import shutil
+import tempfile
+import unittest
+from io import BytesIO
+from mock import patch, MagicMock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'src'))
+
+from firmware.devices import UsbDevice
+from firmware.dfu import DfuSeEngine, DfuError, MemoryLayout
+from firmware.firmware import LinuxFirmwareUpdater, LibUsbFirmwareUpdater
+from firmware.image import ImageError, Segment, FirmwareImage, load_image
+from firmware.plan import FlashPlan, PlanFlasher
+from firmware.progress import PHASE_ERASE, PHASE_DOWNLOAD, PHASE_MANIFEST
+from firmware.simulator import SimulatedDfuSeDevice, SimulatedMultiAltDevice
+
+START = 0x08000000
+CALIBRATION = 0x08003000
+OPTION_BYTES = 0x1fffc000
+FIRMWARE = bytes(bytearray((index * 7 + 3) & 0xff for index in range(10 * 1024)))
+CALIBRATION_DATA = b'\x5a' * 256
+OPTION_BYTES_DATA = b'\xaa\x55\xff\x00' * 4
+
+
+class TestFlashPlan(unittest.TestCase):
+
+    def test_by_alt_should_put_main_flash_first_with_segments_in_address_order(self):
+        plan = FlashPlan().add(OPTION_BYTES, OPTION_BYTES_DATA, alt=1).add(CALIBRATION, CALIBRATION_DATA).add(START, FIRMWARE)
+
+        alts = plan.by_alt()
+
+        self.assertEquals([0, 1], list(alts.keys()))
+        self.assertEquals([START, CALIBRATION], [segment.address for segment in alts[0]])
+        self.assertEquals(START, plan.start)
+        self.assertEquals(len(FIRMWARE) + len(CALIBRATION_DATA) + len(OPTION_BYTES_DATA), plan.size)
+
+    def test_start_should_be_none_without_main_flash(self):
+        self.assertEquals(None, FlashPlan().add(OPTION_BYTES, OPTION_BYTES_DATA, alt=1).start)
+
+    def test_validate_should_reject_empty_plans(self):
+        with self.assertRaises(ImageError):
+            FlashPlan().validate()
+
+    def test_validate_should_reject_overlapping_segments_on_the_same_alt_only(self):
+        FlashPlan().add(START, FIRMWARE).add(START, OPTION_BYTES_DATA, alt=1).validate()
+
+        with self.assertRaises(ImageError):
+            FlashPlan().add(START, FIRMWARE).add(START + 100, CALIBRATION_DATA).validate()
+
+    def test_add_image_should_keep_the_alt_settings_of_dfuse_files(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(temp_dir, 'plan.dfu')
+            image = FirmwareImage([Segment(START, memoryview(FIRMWARE)), Segment(OPTION_BYTES, memoryview(OPTION_BYTES_DATA), 1)])
+            with open(path, 'wb') as dfu_file:
+                dfu_file.write(image.to_dfuse())
+
+            with FlashPlan() as plan:
+                plan.add_image(path)
+                self.assertEquals([(START, 0), (OPTION_BYTES, 1)], [(segment.address, segment.alt) for segment in plan.segments])
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+class TestPlanFlasher(unittest.TestCase):
+
+    def setUp(self):
+        self.device = SimulatedMultiAltDevice()
+        self.engine = DfuSeEngine(self.device, transfer_size=2048)
+
+    def test_sectors_should_erase_shared_sectors_once(self):
+        layout = MemoryLayout.parse(SimulatedDfuSeDevice().interface_name)
+        segments = [Segment(START, memoryview(FIRMWARE)), Segment(CALIBRATION, memoryview(CALIBRATION_DATA))]
+
+        self.assertEquals([START], [sector.address for sector in PlanFlasher.sectors(layout, segments)])
+
+    def test_sectors_should_reject_segments_outside_the_layout(self):
+        layout = MemoryLayout.parse(SimulatedDfuSeDevice().interface_name)
+
+        with self.assertRaises(DfuError):
+            PlanFlasher.sectors(layout, [Segment(OPTION_BYTES, memoryview(OPTION_BYTES_DATA))])
+
+    def test_flash_should_write_every_alt_erasing_each_sector_once(self):
+        plan = FlashPlan().add(START, FIRMWARE).add(CALIBRATION, CALIBRATION_DATA).add(OPTION_BYTES, OPTION_BYTES_DATA, alt=1)
+        events = []
+
+        PlanFlasher(self.engine).flash(plan, lambda phase, percent, done: events.append((phase, percent, done)))
+
+        self.assertEquals([(0, START)], self.device.erased_pages)
+        self.assertEquals(FIRMWARE, bytes(self.device.read_flash(START, len(FIRMWARE))))
+        self.assertEquals(CALIBRATION_DATA, bytes(self.device.read_flash(CALIBRATION, len(CALIBRATION_DATA))))
+        self.assertEquals(OPTION_BYTES_DATA, bytes(self.device.read_flash(OPTION_BYTES, len(OPTION_BYTES_DATA), alt=1)))
+        self.assertEquals((PHASE_DOWNLOAD, 100, plan.size), events[-1])
+        self.assertTrue((PHASE_ERASE, 100, 16 * 1024) in events)
+        self.assertFalse(self.device.manifested)
+
+    def test_flash_should_raise_when_verification_fails(self):
+        class Corrupting(SimulatedDfuSeDevice):
+            def _program(self, address, data):
+                super(Corrupting, self)._program(address, data)
+                self.flash[0] ^= 0xff
+        self.device.alts[0] = Corrupting()
+
+        with self.assertRaises(DfuError):
+            PlanFlasher(self.engine, verify=True).flash(FlashPlan().add(START, FIRMWARE))
+
+
+class TestLibUsbFirmwareUpdaterPlans(unittest.TestCase):
+
+    def updater(self, device):
+        updater = LibUsbFirmwareUpdater(None, 0x0483, 0xdf11, 0x16d0, 0x0af3, transport_factory=lambda d: device)
+        updater.verify = True
+        return updater
+
+    def test_update_plan_should_write_firmware_and_option_bytes_and_leave_once(self):
+        device = SimulatedMultiAltDevice()
+        plan = FlashPlan().add(OPTION_BYTES, OPTION_BYTES_DATA, alt=1).add(START, FIRMWARE)
+
+        result = self.updater(device).update_plan(plan)
+
+        self.assertTrue(result)
+        self.assertEquals(PHASE_MANIFEST, list(result.phases.keys())[-1])
+        self.assertTrue(device.manifested)
+        self.assertEquals(0, device.alternate_settings[-1])
+        self.assertEquals(FIRMWARE, bytes(device.read_flash(START, len(FIRMWARE))))
+        self.assertEquals(OPTION_BYTES_DATA, bytes(device.read_flash(OPTION_BYTES, len(OPTION_BYTES_DATA), alt=1)))
+
+    def test_update_plan_should_stay_in_dfu_mode_when_not_leaving(self):
+        device = SimulatedMultiAltDevice()
+
+        result = self.updater(device).update_plan(FlashPlan().add(START, FIRMWARE), leave=False)
+
+        self.assertTrue(result)
+        self.assertFalse(device.manifested)
+        self.assertEquals(FIRMWARE, bytes(device.read_flash(START, len(FIRMWARE))))
+
+    def test_update_plan_should_fail_invalid_plans_without_opening_the_device(self):
+        opened = []
+        updater = LibUsbFirmwareUpdater(None, 0x0483, 0xdf11, 0x16d0, 0x0af3, transport_factory=opened.append)
+
+        self.assertFalse(updater.update_plan(FlashPlan()))
+        self.assertEquals([], opened)
+
+    def test_update_plan_should_fail_without_leaving_for_missing_alt_settings(self):
+        device = SimulatedMultiAltDevice()
+
+        result = self.updater(device).update_plan(FlashPlan().add(START, FIRMWARE).add(0, b'\x00', alt=5))
+
+        self.assertFalse(result)
+        self.assertFalse(device.manifested)
+
+
+@patch('firmware.firmware.Popen')
+class TestLinuxFirmwareUpdaterPlans(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        open(os.path.join(self.temp_dir, 'dfu-util'), 'w').close()
+        self.updater = LinuxFirmwareUpdater(self.temp_dir, 0x0483, 0xdf11, 0x16d0, 0x0af3)
+        self.written = []
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def dfu_util(self, command, stdout, stderr):
+        if '-D' in command:
+            image = load_image(command[command.index('-D') + 1])
+            self.written.append([(segment.address, segment.alt, segment.data.tobytes()) for segment in image.segments])
+            image.close()
+        process = MagicMock()
+        process.stdout, process.stderr = BytesIO(b'out'), BytesIO(b'')
+        process.wait.return_value = 0
+        return process
+
+    def test_update_plan_should_run_dfu_util_once_per_alt_then_leave(self, mock_Popen):
+        mock_Popen.side_effect = self.dfu_util
+        plan = FlashPlan().add(OPTION_BYTES, OPTION_BYTES_DATA, alt=1).add(CALIBRATION, CALIBRATION_DATA).add(START, FIRMWARE)
+
+        result = self.updater.update_plan(plan)
+
+        self.assertTrue(result)
+        commands = [call[0][0] for call in mock_Popen.call_args_list]
+        self.assertEquals([['-a', '0'], ['-a', '1'], ['-a', '0']], [command[1:3] for command in commands])
+        self.assertEquals([[(START, 0, FIRMWARE), (CALIBRATION, 0, CALIBRATION_DATA)], [(OPTION_BYTES, 1, OPTION_BYTES_DATA)]], self.written)
+        self.assertEquals(['--dfuse-address', '0x08000000:4:leave', '-U'], commands[2][3:6])
+        self.assertEquals(['dfu-util'], os.listdir(self.temp_dir))
+
+    def test_update_plan_should_stay_in_dfu_mode_when_not_leaving(self, mock_Popen):
+        mock_Popen.side_effect = self.dfu_util
+
+        self.assertTrue(self.updater.update_plan(FlashPlan().add(START, FIRMWARE), leave=False))
+
+        self.assertEquals(1, mock_Popen.call_count)
+        self.assertFalse('-U' in mock_Popen.call_args[0][0])
+
+    def test_update_plan_should_stop_at_the_first_failure(self, mock_Popen):
+        mock_Popen.return_value.stdout, mock_Popen.return_value.stderr = BytesIO(b'out'), BytesIO(b'err')
+        mock_Popen.return_value.wait.return_value = 74
+
+        result = self.updater.update_plan(FlashPlan().add(START, FIRMWARE).add(OPTION_BYTES, OPTION_BYTES_DATA, alt=1))
+
+        self.assertFalse(result)
+        self.assertEquals(1, mock_Popen.call_count)
+
+
+    def test_update_plan_should_fail_for_a_device_dfu_util_cannot_select(self, mock_Popen):
+        result = self.updater.update_plan(FlashPlan().add(START, FIRMWARE), device=UsbDevice(0x0483, 0xdf11, port_path='1-2'))
+
+        self.assertFalse(result)
+        self.assertTrue('cannot select it by path' in result.error)
+        self.assertFalse(mock_Popen.called)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import sys
+import os
+import stat
+import shutil
+import tempfile
+import unittest
+from mock import patch, MagicMock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'src'))
+
+from firmware.preflight import preflight, check, executable, dependancies_path, DependancyError
+
+
+class TestCheck(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.dfu_util = os.path.join(self.temp_dir, 'dfu-util')
+        with open(self.dfu_util, 'wb') as binary:
+            binary.write(b'not the bundled build')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def dfu_util_reporting(self, version):
+        process = MagicMock()
+        process.communicate.return_value = (version, b'')
+        return process
+
+    @patch('firmware.preflight.Popen')
+    def test_should_know_bundled_builds_without_running_them(self, mock_Popen):
+        dependancy = check(os.path.join(dependancies_path('linux'), 'dfu-util'))
+
+        self.assertTrue(dependancy.bundled)
+        self.assertEquals((0, 8), dependancy.version)
+        self.assertFalse(mock_Popen.called)
+
+    def test_should_find_which_builds_can_select_devices_by_path(self):
+        self.assertFalse(check(os.path.join(dependancies_path('linux'), 'dfu-util')).paths)
+        self.assertTrue(check(os.path.join(dependancies_path('mac'), 'dfu-util')).paths)
+        self.assertEquals(None, check(os.path.join(dependancies_path('mac'), 'check_usb.sh')).paths)
+
+    @patch('firmware.preflight.Popen')
+    def test_should_ask_other_builds_for_their_version(self, mock_Popen):
+        mock_Popen.return_value = self.dfu_util_reporting(b'dfu-util 0.9\n\nCopyright 2005-2009 Weston Schmidt')
+
+        dependancy = check(self.dfu_util)
+
+        self.assertFalse(dependancy.bundled)
+        self.assertEquals((0, 9), dependancy.version)
+        self.assertEquals([self.dfu_util, '--version'], mock_Popen.call_args[0][0])
+
+    @patch('firmware.preflight.Popen')
+    def test_should_reject_builds_that_are_too_old(self, mock_Popen):
+        mock_Popen.return_value = self.dfu_util_reporting(b'dfu-util 0.7\n')
+
+        with self.assertRaises(DependancyError):
+            check(self.dfu_util)
+
+    @patch('firmware.preflight.Popen')
+    def test_should_accept_builds_that_cannot_run_here(self, mock_Popen):
+        mock_Popen.side_effect = OSError("Exec format error")
+
+        self.assertEquals(None, check(self.dfu_util).version)
+
+    def test_should_raise_when_missing(self):
+        with self.assertRaises(DependancyError):
+            check(os.path.join(self.temp_dir, 'DfuSeCommand.exe'))
+
+    @unittest.skipIf(os.name == 'nt', 'Windows has no execute bit')
+    def test_executable_should_set_the_execute_bit(self):
+        os.chmod(self.dfu_util, stat.S_IRUSR | stat.S_IWUSR)
+
+        executable(self.dfu_util)
+
+        self.assertTrue(os.stat(self.dfu_util).st_mode & stat.S_IXUSR)
+
+
+class TestPreflight(unittest.TestCase):
+
+    @patch('firmware.preflight.sys')
+    def test_should_find_frozen_tools_in_the_unpack_directory(self, mock_sys):
+        mock_sys.frozen = True
+        mock_sys._MEIPASS = os.path.join('frozen', 'app')
+
+        self.assertEquals(os.path.join('frozen', 'app'), dependancies_path('linux'))
+
+    def test_should_check_each_tool_once(self):
+        path = dependancies_path('mac')
+        with patch('firmware.preflight.check', side_effect=check) as mock_check:
+            first = preflight('mac', path)
+            second = preflight('mac', path)
+
+        self.assertEquals(2, mock_check.call_count)
+        self.assertTrue(first is second)
+        self.assertEquals((0, 9), first['dfu-util'].version)
+
+    def test_should_check_again_after_a_failure(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            with self.assertRaises(DependancyError):
+                preflight('windows', temp_dir)
+            shutil.copy(os.path.join(dependancies_path('windows'), 'DfuSeCommand.exe'), temp_dir)
+
+            self.assertTrue(preflight('windows', temp_dir)['DfuSeCommand.exe'].bundled)
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
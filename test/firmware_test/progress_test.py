@@ -0,0 +1,229 @@
+import sys
+import os
+import unittest
+from io import BytesIO
+from mock import patch, MagicMock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'src'))
+
+from firmware.progress import (
+    ProgressEvent, ProgressTracker, DfuUtilOutputParser, UpdateResult, iter_output_lines, stream_process,
+    PHASE_SETUP, PHASE_ERASE, PHASE_DOWNLOAD, PHASE_MANIFEST,
+)
+from firmware.firmware import LinuxFirmwareUpdater, LibUsbFirmwareUpdater
+from firmware.simulator import SimulatedDfuSeDevice
+
+# dfu-util 0.8 interleaves erasing with the download
+DFU_UTIL_08_TRANSCRIPT = (
+    b'dfu-util 0.8\n\n'
+    b'Opening DFU capable USB device...\n'
+    b'ID 0483:df11\n'
+    b'Run-time device DFU version 011a\n'
+    b'Claiming USB DFU Interface...\n'
+    b'Setting Alternate Setting #0 ...\n'
+    b'Determining device status: state = dfuIDLE, status = 0\n'
+    b'dfuIDLE, continuing\n'
+    b'DFU mode device DFU version 011a\n'
+    b'Device returned transfer size 2048\n'
+    b'DfuSe interface name: "Internal Flash  "\n'
+    b'Downloading to address = 0x08000000, size = 6144\n'
+    b'Download\t[                         ]   0%            0 bytes'
+    b'\rDownload\t[========                 ]  33%         2048 bytes'
+    b'\rDownload\t[================         ]  66%         4096 bytes'
+    b'\rDownload\t[=========================] 100%         6144 bytes\n'
+    b'Download done.\n'
+    b'File downloaded successfully\n'
+    b'Transitioning to dfuMANIFEST state\n'
+)
+
+# dfu-util 0.9 erases up front with its own progress bar
+DFU_UTIL_09_TRANSCRIPT = (
+    b'dfu-util 0.9\n\n'
+    b'Downloading to address = 0x08000000, size = 4096\n'
+    b'Erase   \t[                         ]   0%            0 bytes'
+    b'\rErase   \t[=========================] 100%         4096 bytes\n'
+    b'Erase    done.\n'
+    b'Download\t[=============            ]  50%         2048 bytes'
+    b'\rDownload\t[=========================] 100%         4096 bytes\n'
+    b'Download done.\n'
+    b'File downloaded successfully\n'
+    b'Submitting leave request...\n'
+)
+
+
+class FakeClock(object):
+    def __init__(self, step=1.0):
+        self.now = 0.0
+        self.step = step
+
+    def __call__(self):
+        self.now += self.step
+        return self.now
+
+
+class TestDfuUtilOutputParser(unittest.TestCase):
+
+    def parse(self, transcript):
+        events = []
+        tracker = ProgressTracker(events.append, clock=FakeClock())
+        parser = DfuUtilOutputParser(tracker)
+        for line in iter_output_lines(BytesIO(transcript)):
+            parser.feed(line)
+        return events, tracker.finish()
+
+    def test_should_report_download_progress_from_dfu_util_08(self):
+        events, _ = self.parse(DFU_UTIL_08_TRANSCRIPT)
+
+        downloads = [(e.percent, e.bytes) for e in events if e.phase == PHASE_DOWNLOAD]
+        self.assertEquals([(0, 0), (33, 2048), (66, 4096), (100, 6144)], downloads)
+        self.assertEquals(PHASE_MANIFEST, events[-1].phase)
+
+    def test_should_report_erase_then_download_from_dfu_util_09(self):
+        events, phases = self.parse(DFU_UTIL_09_TRANSCRIPT)
+
+        self.assertEquals([PHASE_ERASE, PHASE_ERASE, PHASE_DOWNLOAD, PHASE_DOWNLOAD, PHASE_MANIFEST], [e.phase for e in events])
+        self.assertEquals([PHASE_SETUP, PHASE_ERASE, PHASE_DOWNLOAD, PHASE_MANIFEST], list(phases.keys()))
+
+    def test_should_compute_bytes_per_second(self):
+        events, _ = self.parse(DFU_UTIL_08_TRANSCRIPT)
+
+        download = [e for e in events if e.phase == PHASE_DOWNLOAD][-1]
+        self.assertTrue(download.bytes_per_second > 0)
+
+    def test_should_ignore_other_lines(self):
+        tracker = ProgressTracker()
+        parser = DfuUtilOutputParser(tracker)
+
+        self.assertEquals(None, parser.feed('Claiming USB DFU Interface...'))
+
+
+class TestProgressTracker(unittest.TestCase):
+
+    def test_finish_should_return_time_spent_in_each_phase(self):
+        times = iter([0.0, 1.0, 1.0, 4.0, 4.0, 4.5])
+        tracker = ProgressTracker(clock=lambda: next(times))
+
+        tracker.update(PHASE_DOWNLOAD, 0, 0)
+        tracker.update(PHASE_MANIFEST)
+        phases = tracker.finish()
+
+        self.assertEquals([(PHASE_SETUP, 1.0), (PHASE_DOWNLOAD, 3.0), (PHASE_MANIFEST, 0.5)], list(phases.items()))
+
+    def test_update_should_call_back_with_event(self):
+        events = []
+        times = iter([0.0, 0.0, 2.0])
+        tracker = ProgressTracker(events.append, clock=lambda: next(times))
+
+        tracker.update(PHASE_DOWNLOAD, 50, 1000)
+
+        self.assertEquals([ProgressEvent(PHASE_DOWNLOAD, 50, 1000, 500.0)], events)
+
+
+class TestIterOutputLines(unittest.TestCase):
+
+    def test_should_split_on_carriage_returns_and_newlines(self):
+        self.assertEquals(['a', 'b', 'c'], list(iter_output_lines(BytesIO(b'a\rb\r\nc'))))
+
+
+class TestStreamProcess(unittest.TestCase):
+
+    def test_should_return_output_and_call_back_for_stdout(self):
+        process = MagicMock()
+        process.stdout = BytesIO(b'one\ntwo\n')
+        process.stderr = BytesIO(b'problem\n')
+        lines = []
+
+        out, err, stalled = stream_process(process, lines.append)
+
+        self.assertEquals(['one', 'two'], lines)
+        self.assertEquals('one\ntwo', out)
+        self.assertEquals('problem', err)
+        self.assertFalse(stalled)
+
+    def test_should_kill_stalled_process(self):
+        process = MagicMock()
+        read_fd, write_fd = os.pipe()
+        process.stdout = os.fdopen(read_fd, 'rb', 0)
+        process.stderr = BytesIO(b'')
+        process.kill.side_effect = lambda: os.close(write_fd)
+
+        out, err, stalled = stream_process(process, lambda line: None, stall_timeout=0.05)
+
+        self.assertTrue(stalled)
+        process.kill.assert_called_with()
+        process.stdout.close()
+
+
+class TestUpdateResult(unittest.TestCase):
+
+    def test_should_be_truthy_only_when_successfull(self):
+        self.assertTrue(UpdateResult(True))
+        self.assertFalse(UpdateResult(False))
+
+    def test_duration_should_sum_phases(self):
+        result = UpdateResult(True, phases={PHASE_ERASE: 1.5, PHASE_DOWNLOAD: 2.0})
+
+        self.assertEquals(3.5, result.duration)
+
+
+@patch('firmware.firmware.Popen')
+@patch('firmware.os.path.isfile')
+@patch('firmware.os.stat')
+@patch('firmware.os.chmod')
+class TestLinuxFirmwareUpdaterProgress(unittest.TestCase):
+
+    def test_update_should_stream_progress_events(self, mock_chmod, mock_stat, mock_isfile, mock_Popen):
+        mock_isfile.return_value = True
+        mock_Popen.return_value.stdout = BytesIO(DFU_UTIL_08_TRANSCRIPT)
+        mock_Popen.return_value.stderr = BytesIO(b'')
+        mock_Popen.return_value.wait.return_value = 0
+        events = []
+
+        updater = LinuxFirmwareUpdater('somepath', 0x0483, 0xdf11, 0x16d0, 0x0af3)
+        result = updater.update('firmware.bin', progress_callback=events.append)
+
+        self.assertTrue(result)
+        self.assertEquals(0, result.exit_code)
+        self.assertEquals(100, [e for e in events if e.phase == PHASE_DOWNLOAD][-1].percent)
+        self.assertEquals([PHASE_SETUP, PHASE_DOWNLOAD, PHASE_MANIFEST], list(result.phases.keys()))
+
+    def test_update_should_fail_with_output_when_dfu_util_fails(self, mock_chmod, mock_stat, mock_isfile, mock_Popen):
+        mock_isfile.return_value = True
+        mock_Popen.return_value.stdout = BytesIO(b'dfu-util 0.8\n')
+        mock_Popen.return_value.stderr = BytesIO(b'dfu-util: No DFU capable USB device available\n')
+        mock_Popen.return_value.wait.return_value = 74
+
+        updater = LinuxFirmwareUpdater('somepath', 0x0483, 0xdf11, 0x16d0, 0x0af3)
+        result = updater.update('firmware.bin')
+
+        self.assertFalse(result)
+        self.assertEquals(74, result.exit_code)
+        self.assertEquals('dfu-util: No DFU capable USB device available', result.error)
+
+
+class TestLibUsbFirmwareUpdaterProgress(unittest.TestCase):
+
+    def test_update_should_report_erase_download_and_manifest(self):
+        import tempfile
+        import shutil
+        temp_dir = tempfile.mkdtemp()
+        try:
+            firmware_path = os.path.join(temp_dir, 'firmware.bin')
+            with open(firmware_path, 'wb') as firmware_file:
+                firmware_file.write(b'\x01' * 5000)
+            device = SimulatedDfuSeDevice()
+            events = []
+            updater = LibUsbFirmwareUpdater(None, 0x0483, 0xdf11, 0x16d0, 0x0af3, transfer_size=2048, transport_factory=lambda d: device)
+
+            result = updater.update(firmware_path, progress_callback=events.append)
+
+            self.assertTrue(result)
+            self.assertEquals([(PHASE_ERASE, 100, 16384)], [(e.phase, e.percent, e.bytes) for e in events if e.phase == PHASE_ERASE])
+            self.assertEquals([2048, 4096, 5000], [e.bytes for e in events if e.phase == PHASE_DOWNLOAD])
+            self.assertEquals([PHASE_SETUP, PHASE_ERASE, PHASE_DOWNLOAD, PHASE_MANIFEST], list(result.phases.keys()))
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import sys
+import os
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'src'))
+
+from firmware.dfu import DfuSeEngine, DfuError, MemoryLayout, DFU_DNLOAD
+from firmware.firmware import LibUsbFirmwareUpdater
+from firmware.progress import PHASE_DOWNLOAD
+from firmware.resumable import ResumableDownloader, RetryPolicy, is_transient
+from firmware.simulator import SimulatedDfuSeDevice, FAIL_STALL, FAIL_PROG, FAIL_LOST_ACK
+
+START = 0x08000000
+IMAGE = bytearray((index * 7) & 0xff for index in range(40 * 1024))
+
+
+class TestResumableDownloader(unittest.TestCase):
+
+    def setUp(self):
+        self.device = SimulatedDfuSeDevice()
+        self.layout = MemoryLayout.parse(self.device.interface_name)
+        self.slept = []
+
+    def download(self, policy=None, progress=None):
+        engine = DfuSeEngine(self.device, transfer_size=1024)
+        return ResumableDownloader(engine, self.layout, policy or RetryPolicy(), sleep=self.slept.append).download(START, IMAGE, progress)
+
+    def data_blocks_sent(self):
+        return len([r for r in self.device.requests if r[0] == DFU_DNLOAD and r[1] >= 2])
+
+    def test_should_write_image_without_failures(self):
+        report = self.download()
+
+        self.assertEquals(bytes(IMAGE), self.device.read_flash(START, len(IMAGE)))
+        self.assertEquals((0, 0, []), report)
+        self.assertEquals(40, self.data_blocks_sent())
+
+    def test_should_resend_only_the_stalled_block(self):
+        self.device.fail_at(START + 20 * 1024, FAIL_STALL)
+
+        report = self.download()
+
+        self.assertEquals(bytes(IMAGE), self.device.read_flash(START, len(IMAGE)))
+        self.assertEquals(1, report.retries)
+        self.assertEquals([], report.rewritten_sectors)
+        self.assertEquals(41, self.data_blocks_sent())
+
+    def test_should_continue_after_block_whose_status_was_lost(self):
+        self.device.fail_at(START + 5 * 1024, FAIL_LOST_ACK)
+
+        report = self.download()
+
+        self.assertEquals(bytes(IMAGE), self.device.read_flash(START, len(IMAGE)))
+        self.assertEquals((1, 1, []), report)
+        self.assertEquals(40, self.data_blocks_sent())
+
+    def test_should_erase_and_rewrite_only_the_partially_programmed_sector(self):
+        self.device.fail_at(START + 18 * 1024, FAIL_PROG)
+
+        report = self.download()
+
+        self.assertEquals(bytes(IMAGE), self.device.read_flash(START, len(IMAGE)))
+        self.assertEquals([START + 16 * 1024], [sector.address for sector in report.rewritten_sectors])
+        self.assertEquals([START, START + 0x4000, START + 0x8000, START + 0x4000], self.device.erased_pages)
+        self.assertEquals(40 + 3, self.data_blocks_sent())
+
+    def test_should_back_off_between_retries(self):
+        self.device.fail_at(START, FAIL_STALL, times=3)
+
+        self.download(RetryPolicy(initial_delay=0.1, multiplier=2.0, max_delay=0.3))
+
+        self.assertEquals([0.1, 0.2, 0.3], self.slept)
+
+    def test_should_give_up_when_retry_budget_spent(self):
+        self.device.fail_at(START + 1024, FAIL_STALL, times=10)
+
+        with self.assertRaises(DfuError):
+            self.download(RetryPolicy(max_retries=3, initial_delay=0))
+        self.assertEquals(3, len(self.slept))
+
+    def test_should_report_overall_download_progress(self):
+        self.device.fail_at(START + 20 * 1024, FAIL_STALL)
+        events = []
+
+        self.download(progress=lambda phase, percent, done: events.append((phase, percent, done)))
+
+        downloads = [event for event in events if event[0] == PHASE_DOWNLOAD]
+        self.assertEquals((PHASE_DOWNLOAD, 100, len(IMAGE)), downloads[-1])
+        self.assertEquals(sorted(done for _, _, done in downloads), [done for _, _, done in downloads])
+
+    def test_should_not_retry_permanent_errors(self):
+        self.assertFalse(is_transient(DfuError("Bad address", 0x08)))
+        self.assertTrue(is_transient(DfuError("Stalled", 0x0f)))
+        self.assertTrue(is_transient(IOError("Pipe error")))
+
+
+class TestLibUsbFirmwareUpdaterResumable(unittest.TestCase):
+
+    def test_update_should_survive_injected_failures_with_retry_policy(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            firmware_path = os.path.join(temp_dir, 'firmware.bin')
+            with open(firmware_path, 'wb') as firmware_file:
+                firmware_file.write(bytes(IMAGE))
+            device = SimulatedDfuSeDevice()
+            device.fail_at(START + 4096, FAIL_STALL)
+            device.fail_at(START + 20480, FAIL_PROG)
+            updater = LibUsbFirmwareUpdater(None, 0x0483, 0xdf11, 0x16d0, 0x0af3, transport_factory=lambda d: device)
+            updater.retry_policy = RetryPolicy(initial_delay=0)
+
+            result = updater.update(firmware_path)
+
+            self.assertTrue(result)
+            self.assertEquals(bytes(IMAGE), device.read_flash(START, len(IMAGE)))
+            self.assertTrue(device.manifested)
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
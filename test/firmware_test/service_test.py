@@ -0,0 +1,351 @@
+import sys
+import os
+import json
+import time
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+try:
+    from urllib2 import urlopen, Request, HTTPError
+except ImportError:
+    from urllib.request import urlopen, Request
+    from urllib.error import HTTPError
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'src'))
+
+from firmware.devices import UsbDevice
+from firmware.firmware import FirmwareUpdater
+from firmware.image import ImageError
+from firmware.metrics import FlashMetrics
+from firmware.progress import ProgressTracker, UpdateResult, PHASE_DOWNLOAD
+from firmware.service import FlashService, FlashJob, JobStore, make_server, QUEUED, RUNNING, SUCCEEDED, FAILED, CANCELLED
+
+
+class FakeFirmwareUpdater(FirmwareUpdater):
+    def __init__(self, devices=None, failing=()):
+        super(FakeFirmwareUpdater, self).__init__(None, 0x0483, 0xdf11, 0x16d0, 0x0af3)
+        self.devices = devices if devices is not None else [UsbDevice(0x0483, 0xdf11, port_path='1-1')]
+        self.failing = failing
+        self.flashed = []
+        self.active = 0
+        self.max_active = 0
+        self.release = threading.Event()
+        self.release.set()
+        self._lock = threading.Lock()
+        # Whether flashed units leave DFU mode, they are then missing from listings for absence seconds until the next
+        # unit is plugged in
+        self.leaves = True
+        self.absence = 0.05
+        self.left = {}
+
+    def list_bootloaders(self):
+        with self._lock:
+            now = time.time()
+            return [device for device in self.devices if now - self.left.get(device, 0) >= self.absence]
+
+    def _scan_devices(self):
+        return list(self.devices)
+
+    def update(self, firmware_path, device=None, progress_callback=None):
+        with self._lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        tracker = ProgressTracker(progress_callback)
+        tracker.update(PHASE_DOWNLOAD, 50, 1024)
+        self.release.wait(5)
+        with self._lock:
+            self.active -= 1
+            self.flashed.append((firmware_path, device))
+        return UpdateResult(firmware_path not in self.failing, phases=tracker.finish(), error='Boom')
+
+    def update_and_leave(self, firmware_path, device=None, progress_callback=None):
+        result = self.update(firmware_path, device, progress_callback)
+        if result and self.leaves:
+            with self._lock:
+                self.left[device] = time.time()
+        return result
+
+
+class CountingUpdater(FakeFirmwareUpdater):
+    def list_bootloaders(self):
+        raise NotImplementedError()
+
+    def list_usb_devices(self):
+        return (1, 0)
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while not predicate():
+        if time.time() > deadline:
+            raise AssertionError("Timed out waiting")
+        time.sleep(0.005)
+
+
+class ServiceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.firmware = self.write('firmware.bin')
+        self.services = []
+
+    def tearDown(self):
+        for service in self.services:
+            service.updater.release.set()
+            service.stop()
+        shutil.rmtree(self.temp_dir)
+
+    def write(self, name):
+        path = os.path.join(self.temp_dir, name)
+        with open(path, 'wb') as firmware_file:
+            firmware_file.write(b'\x01' * 64)
+        return path
+
+    def service(self, updater=None, store=None, **options):
+        options.setdefault('poll_interval', 0.01)
+        options.setdefault('settle_time', 0)
+        service = FlashService(updater or FakeFirmwareUpdater(), store, **options)
+        service.start()
+        self.services.append(service)
+        return service
+
+    def finished(self, service, job):
+        wait_until(lambda: service.get(job.id).state in (SUCCEEDED, FAILED, CANCELLED))
+        return service.get(job.id)
+
+
+class TestFlashService(ServiceTestCase):
+
+    def test_submit_should_run_job_on_attached_bootloader(self):
+        service = self.service()
+
+        job = self.finished(service, service.submit(self.firmware))
+
+        self.assertEquals(SUCCEEDED, job.state)
+        self.assertEquals('1-1', job.device)
+        self.assertEquals(PHASE_DOWNLOAD, job.phase)
+        self.assertEquals(50, job.percent)
+        self.assertTrue(PHASE_DOWNLOAD in job.phases)
+
+    def test_should_record_failures(self):
+        service = self.service(FakeFirmwareUpdater(failing=(self.firmware,)))
+
+        job = self.finished(service, service.submit(self.firmware))
+
+        self.assertEquals(FAILED, job.state)
+        self.assertEquals('Boom', job.error)
+
+    def test_should_run_one_job_at_a_time_per_device(self):
+        updater = FakeFirmwareUpdater()
+        service = self.service(updater)
+
+        jobs = [service.submit(self.firmware) for _ in range(3)]
+        for job in jobs:
+            self.finished(service, job)
+
+        self.assertEquals(1, updater.max_active)
+
+    def test_should_spread_jobs_over_devices(self):
+        updater = FakeFirmwareUpdater([UsbDevice(0x0483, 0xdf11, port_path='1-{}'.format(i)) for i in range(3)])
+        updater.release.clear()
+        service = self.service(updater)
+
+        jobs = [service.submit(self.firmware) for _ in range(3)]
+        wait_until(lambda: updater.active == 3)
+        updater.release.set()
+
+        self.assertEquals(set(['1-0', '1-1', '1-2']), set(self.finished(service, job).device for job in jobs))
+
+    def test_should_wait_for_requested_device(self):
+        updater = FakeFirmwareUpdater()
+        service = self.service(updater)
+
+        job = service.submit(self.firmware, device='2-1')
+        time.sleep(0.05)
+        self.assertEquals(QUEUED, service.get(job.id).state)
+        updater.devices = updater.devices + [UsbDevice(0x0483, 0xdf11, port_path='2-1')]
+
+        self.assertEquals('2-1', self.finished(service, job).device)
+
+    def test_should_not_reflash_a_unit_until_it_has_left(self):
+        updater = FakeFirmwareUpdater()
+        updater.leaves = False
+        service = self.service(updater)
+
+        first, second = service.submit(self.firmware), service.submit(self.firmware)
+        self.assertEquals(SUCCEEDED, self.finished(service, first).state)
+        time.sleep(0.05)
+        self.assertEquals(QUEUED, service.get(second.id).state)
+        devices, updater.devices = updater.devices, []
+        time.sleep(0.05)
+        updater.devices = devices
+
+        self.assertEquals(SUCCEEDED, self.finished(service, second).state)
+        self.assertEquals(2, len(updater.flashed))
+
+    def test_cancel_should_only_cancel_queued_jobs(self):
+        updater = FakeFirmwareUpdater()
+        updater.release.clear()
+        service = self.service(updater)
+        running = service.submit(self.firmware)
+        queued = service.submit(self.firmware)
+        wait_until(lambda: service.get(running.id).state == RUNNING)
+
+        self.assertFalse(service.cancel(running.id))
+        self.assertTrue(service.cancel(queued.id))
+        updater.release.set()
+
+        self.assertEquals(SUCCEEDED, self.finished(service, running).state)
+        self.assertEquals(CANCELLED, service.get(queued.id).state)
+        self.assertEquals(1, len(updater.flashed))
+
+    def test_submit_should_reject_missing_firmware(self):
+        service = self.service()
+
+        with self.assertRaises(ImageError):
+            service.submit(os.path.join(self.temp_dir, 'missing.bin'))
+
+    def test_should_flash_single_device_when_updater_cannot_list_bootloaders(self):
+        updater = CountingUpdater()
+        service = self.service(updater)
+
+        job = self.finished(service, service.submit(self.firmware))
+
+        self.assertEquals(SUCCEEDED, job.state)
+        self.assertEquals([(self.firmware, None)], updater.flashed)
+
+    def test_should_keep_limited_history(self):
+        service = self.service(max_history=2)
+
+        for _ in range(4):
+            self.finished(service, service.submit(self.firmware))
+
+        self.assertEquals(2, len(service.jobs()))
+
+
+class TestJobStore(ServiceTestCase):
+
+    def test_should_resume_queue_and_fail_interrupted_jobs_after_restart(self):
+        store = JobStore(os.path.join(self.temp_dir, 'jobs.json'))
+        store.save([FlashJob(self.firmware, state=RUNNING, id='interrupted'), FlashJob(self.firmware, id='waiting'), FlashJob(self.firmware, state=SUCCEEDED, id='done')])
+
+        service = self.service(store=store)
+
+        self.assertEquals(FAILED, service.get('interrupted').state)
+        self.assertEquals(SUCCEEDED, self.finished(service, service.get('waiting')).state)
+        self.assertEquals(['interrupted', 'waiting', 'done'], [job.id for job in JobStore(store.path).load()])
+
+    def test_should_keep_nothing_without_path(self):
+        store = JobStore()
+        store.save([FlashJob(self.firmware)])
+
+        self.assertEquals([], store.load())
+
+
+class TestServiceHttp(ServiceTestCase):
+
+    def setUp(self):
+        super(TestServiceHttp, self).setUp()
+        self.updater = FakeFirmwareUpdater()
+        self.flash_service = self.service(self.updater)
+        self.server = make_server(self.flash_service, ('127.0.0.1', 0))
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        super(TestServiceHttp, self).tearDown()
+
+    def request(self, method, path, body=None):
+        data = json.dumps(body).encode('utf-8') if body is not None else None
+        request = Request(self.url + path, data=data)
+        request.get_method = lambda: method
+        try:
+            response = urlopen(request)
+            return response.getcode(), json.loads(response.read().decode('utf-8'))
+        except HTTPError as e:
+            return e.code, json.loads(e.read().decode('utf-8'))
+
+    def test_post_should_queue_job_and_get_should_report_it(self):
+        code, job = self.request('POST', '/jobs', {'firmware': self.firmware})
+
+        self.assertEquals(201, code)
+        self.finished(self.flash_service, self.flash_service.get(job['id']))
+        code, status = self.request('GET', '/jobs/' + job['id'])
+        self.assertEquals((200, SUCCEEDED), (code, status['state']))
+        self.assertEquals([job['id']], [j['id'] for j in self.request('GET', '/jobs')[1]])
+
+    def test_post_should_reject_bad_requests(self):
+        self.assertEquals(400, self.request('POST', '/jobs', {'firmwear': self.firmware})[0])
+        self.assertEquals(400, self.request('POST', '/jobs', {'firmware': os.path.join(self.temp_dir, 'missing.bin')})[0])
+
+    def test_delete_should_cancel_queued_job(self):
+        self.updater.release.clear()
+        running = self.request('POST', '/jobs', {'firmware': self.firmware})[1]
+        queued = self.request('POST', '/jobs', {'firmware': self.firmware})[1]
+        wait_until(lambda: self.flash_service.get(running['id']).state == RUNNING)
+
+        self.assertEquals(409, self.request('DELETE', '/jobs/' + running['id'])[0])
+        self.assertEquals((200, CANCELLED), (lambda r: (r[0], r[1]['state']))(self.request('DELETE', '/jobs/' + queued['id'])))
+        self.assertEquals(404, self.request('DELETE', '/jobs/unknown')[0])
+
+    def test_get_devices_should_list_bootloaders(self):
+        self.assertEquals((200, [{'key': '1-1', 'usb_address': '0483:df11'}]), self.request('GET', '/devices'))
+
+    def test_get_inventory_should_describe_devices(self):
+        status, records = self.request('GET', '/inventory')
+
+        self.assertEquals(200, status)
+        self.assertEquals([('1-1', 'bootloader')], [(record['key'], record['mode']) for record in records])
+
+    def test_get_metrics_should_export_prometheus_text_when_enabled(self):
+        self.assertEquals(404, self.request('GET', '/metrics')[0])
+        self.updater.metrics = FlashMetrics()
+        self.updater.metrics.count('attempts', self.updater)
+
+        response = urlopen(self.url + '/metrics')
+
+        self.assertTrue(response.info()['Content-Type'].startswith('text/plain'))
+        self.assertTrue(b'peachy_flash_attempts_total{updater="fake"} 1' in response.read())
+
+    def test_unknown_path_should_be_not_found(self):
+        self.assertEquals(404, self.request('GET', '/nothing')[0])
+
+
+class TestServiceUnixSocket(ServiceTestCase):
+
+    @unittest.skipUnless(hasattr(socket, 'AF_UNIX'), "Unix sockets unavailable")
+    def test_should_answer_over_unix_socket(self):
+        path = os.path.join(self.temp_dir, 'flash.sock')
+        server = make_server(self.service(), path)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            client.connect(path)
+            client.sendall(b'GET /jobs HTTP/1.0\r\n\r\n')
+            response = b''
+            while True:
+                chunk = client.recv(4096)
+                if not chunk:
+                    break
+                response += chunk
+            client.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        self.assertTrue(response.startswith(b'HTTP/1.0 200'))
+        self.assertEquals([], json.loads(response.split(b'\r\n\r\n', 1)[1].decode('utf-8')))
+        self.assertFalse(os.path.exists(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+import sys
+import os
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'src'))
+
+from firmware.dfu import DfuError, MemoryLayout, DFU_DNLOAD, DFUSE_DATA_BLOCK, STATE_DFU_IDLE
+from firmware.firmware import LibUsbFirmwareUpdater
+from firmware.simulator import SimulatedDfuSeDevice, SimulatedClock
+from firmware.tuning import Autotuner, ProfileStore, TuningProfile, profile_key
+
+START = 0x08000000
+
+
+class TestProfileStore(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.store = ProfileStore(os.path.join(self.temp_dir, 'tuning', 'profiles.json'))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_profile_key_should_include_bootloader_version_when_known(self):
+        self.assertEquals('0483:df11:2200', profile_key(0x0483, 0xdf11, 0x2200))
+        self.assertEquals('0483:df11', profile_key(0x0483, 0xdf11))
+
+    def test_should_keep_profiles_by_key(self):
+        self.assertEquals(None, self.store.get('0483:df11:2200'))
+
+        self.store.set('0483:df11:2200', TuningProfile(2048, 0.001, 51200.0))
+        self.store.set('0483:df11:2100', TuningProfile(1024, None, 20480.0))
+
+        self.assertEquals(TuningProfile(2048, 0.001, 51200.0), ProfileStore(self.store.path).get('0483:df11:2200'))
+        self.store.forget('0483:df11:2100')
+        self.assertEquals(None, self.store.get('0483:df11:2100'))
+
+
+class TestAutotuner(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = SimulatedClock()
+        # Every control transfer costs a millisecond and the device asks for 5ms between polls but copes with half of one
+        self.device = SimulatedDfuSeDevice(
+            max_transfer_size=2048, poll_timeout=5, block_latency=0.002, request_latency=0.001, byte_time=0.000001,
+            min_poll_interval=0.0005, sleep=self.clock.sleep, clock=self.clock.time)
+        self.layout = MemoryLayout.parse(self.device.interface_name)
+        self.tuner = Autotuner(clock=self.clock.time, sleep=self.clock.sleep)
+
+    def test_should_pick_fastest_reliable_settings(self):
+        profile = self.tuner.tune(self.device, self.layout)
+
+        self.assertEquals((2048, 0.001), (profile.transfer_size, profile.poll_interval))
+        self.assertTrue(profile.bytes_per_second > 0)
+        self.assertEquals(STATE_DFU_IDLE, self.device.state)
+
+    def test_larger_transfers_should_shorten_the_download(self):
+        trials = dict(((trial.transfer_size, trial.poll_interval), trial) for trial in self.tuner.trials(self.device, self.layout))
+
+        self.assertTrue(trials[(2048, None)].seconds < trials[(1024, None)].seconds < trials[(512, None)].seconds)
+        self.assertTrue(trials[(2048, None)].seconds < trials[(512, None)].seconds / 2)
+
+    def test_should_mark_settings_the_device_rejects_unreliable(self):
+        trials = self.tuner.trials(self.device, self.layout)
+
+        unreliable = [(trial.transfer_size, trial.poll_interval) for trial in trials if trial.error]
+        self.assertEquals([(512, 0), (1024, 0), (2048, 0), (4096, None), (4096, 0.001), (4096, 0)], unreliable)
+
+    def test_should_raise_when_nothing_is_reliable(self):
+        with self.assertRaises(DfuError):
+            Autotuner(transfer_sizes=(4096,), clock=self.clock.time, sleep=self.clock.sleep).tune(self.device, self.layout)
+
+    def test_should_need_a_layout(self):
+        with self.assertRaises(DfuError):
+            self.tuner.tune(self.device, None)
+
+
+class TestLibUsbFirmwareUpdaterTuning(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.firmware_path = os.path.join(self.temp_dir, 'firmware.bin')
+        with open(self.firmware_path, 'wb') as firmware_file:
+            firmware_file.write(b'\x01' * 10000)
+        self.clock = SimulatedClock()
+        self.device = SimulatedDfuSeDevice(poll_timeout=5, request_latency=0.001, sleep=self.clock.sleep, clock=self.clock.time)
+        self.updater = LibUsbFirmwareUpdater(None, 0x0483, 0xdf11, 0x16d0, 0x0af3, transfer_size=512, transport_factory=lambda device: self.device)
+        self.updater.profiles = ProfileStore(os.path.join(self.temp_dir, 'profiles.json'))
+        self.updater.autotuner = Autotuner(poll_intervals=(None, 0), clock=self.clock.time, sleep=self.clock.sleep)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def block_sizes(self):
+        return set(length for request, value, length in self.device.requests if request == DFU_DNLOAD and value >= DFUSE_DATA_BLOCK)
+
+    def test_update_should_tune_bootloader_without_profile_when_autotuning(self):
+        self.updater.autotune = True
+
+        self.assertTrue(self.updater.update(self.firmware_path))
+
+        self.assertEquals((2048, 0), self.updater.profiles.get('0483:df11:2200')[:2])
+        self.assertEquals(b'\x01' * 10000, self.device.read_flash(START, 10000))
+
+    def test_update_should_use_saved_profile(self):
+        self.updater.profiles.set('0483:df11:2200', TuningProfile(1024, 0, 1.0))
+
+        self.assertTrue(self.updater.update(self.firmware_path))
+
+        self.assertEquals(set([1024, 10000 % 1024]), self.block_sizes())
+
+    def test_update_should_use_transfer_size_without_profile(self):
+        self.assertTrue(self.updater.update(self.firmware_path))
+
+        self.assertEquals(set([512, 10000 % 512]), self.block_sizes())
+        self.assertEquals(None, self.updater.profiles.get('0483:df11:2200'))
+
+    def test_tune_should_save_profile(self):
+        profile = self.updater.tune()
+
+        self.assertEquals(profile, self.updater.profiles.get('0483:df11:2200'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,208 @@
+import sys
+import os
+import zlib
+import shutil
+import hashlib
+import tempfile
+import unittest
+from io import BytesIO
+from mock import patch, MagicMock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'src'))
+
+from firmware.dfu import DfuSeEngine, MemoryLayout, DFU_UPLOAD
+from firmware.firmware import LinuxFirmwareUpdater, LibUsbFirmwareUpdater
+from firmware.progress import PHASE_VERIFY, PHASE_MANIFEST
+from firmware.simulator import SimulatedDfuSeDevice
+from firmware.verify import ImageDigest, FlashVerifier
+
+START = 0x08000000
+IMAGE = bytes(bytearray((index * 13 + 5) & 0xff for index in range(40 * 1024)))
+
+
+class LastRanges(object):
+    def sample(self, population, count):
+        return population[-count:]
+
+
+class CorruptingDevice(SimulatedDfuSeDevice):
+    '''Programs every block, flipping the byte at corrupt_at'''
+
+    def __init__(self, corrupt_at, **options):
+        super(CorruptingDevice, self).__init__(**options)
+        self.corrupt_at = corrupt_at
+
+    def _program(self, address, data):
+        super(CorruptingDevice, self)._program(address, data)
+        if address <= self.corrupt_at < address + len(data):
+            self.flash[self.corrupt_at - self.layout.start] ^= 0xff
+
+
+class TestImageDigest(unittest.TestCase):
+
+    def test_should_digest_whole_image_and_each_sector_of_it(self):
+        layout = MemoryLayout.parse(SimulatedDfuSeDevice().interface_name)
+
+        digest = ImageDigest.compute(START, IMAGE, layout)
+
+        self.assertEquals(zlib.crc32(IMAGE) & 0xffffffff, digest.crc32)
+        self.assertEquals(hashlib.sha256(IMAGE).hexdigest(), digest.sha256)
+        self.assertEquals([(START, 16384), (START + 16384, 16384), (START + 32768, 8192)], [r[:2] for r in digest.ranges])
+        self.assertEquals(zlib.crc32(IMAGE[32768:]) & 0xffffffff, digest.ranges[2][2])
+
+    def test_should_digest_fixed_blocks_without_layout(self):
+        digest = ImageDigest.compute(START + 100, IMAGE[:20000])
+
+        self.assertEquals([(START + 100, 16384), (START + 100 + 16384, 20000 - 16384)], [r[:2] for r in digest.ranges])
+
+    def test_matches_should_compare_streamed_chunks(self):
+        digest = ImageDigest.compute(START, IMAGE)
+
+        self.assertTrue(digest.matches([IMAGE[:1000], IMAGE[1000:]]))
+        self.assertFalse(digest.matches([IMAGE[:-1]]))
+        self.assertFalse(digest.matches([IMAGE[:-1] + b'\x00']))
+
+
+class TestFlashVerifier(unittest.TestCase):
+
+    def setUp(self):
+        self.device = SimulatedDfuSeDevice()
+        self.layout = MemoryLayout.parse(self.device.interface_name)
+        self.device.flash[:len(IMAGE)] = IMAGE
+        self.engine = DfuSeEngine(self.device, transfer_size=2048)
+        self.digest = ImageDigest.compute(START, IMAGE, self.layout)
+
+    def uploads(self):
+        return len([r for r in self.device.requests if r[0] == DFU_UPLOAD])
+
+    def test_should_pass_matching_flash_streaming_it_a_block_at_a_time(self):
+        events = []
+
+        result = FlashVerifier(self.engine).verify(self.digest, lambda *event: events.append(event))
+
+        self.assertEquals((True, len(IMAGE), []), result)
+        self.assertEquals(20, self.uploads())
+        self.assertEquals(20, len(events))
+        self.assertEquals((PHASE_VERIFY, 100, len(IMAGE)), events[-1])
+
+    def test_should_name_sectors_that_differ(self):
+        self.device.flash[20000] ^= 0x01
+
+        result = FlashVerifier(self.engine).verify(self.digest)
+
+        self.assertEquals((False, [(START + 16384, 16384)]), (result.success, result.mismatched_ranges))
+
+    def test_should_fail_when_read_back_is_short(self):
+        self.digest = ImageDigest.compute(self.layout.end - 4096, b'\xff' * 4096, self.layout)
+        self.device.control_in = lambda request, value, length: bytearray() if request == DFU_UPLOAD else SimulatedDfuSeDevice.control_in(self.device, request, value, length)
+
+        self.assertFalse(FlashVerifier(self.engine).verify(self.digest).success)
+
+    def test_sampled_should_read_only_chosen_sectors(self):
+        result = FlashVerifier(self.engine, sample=1, rng=LastRanges()).verify(self.digest)
+
+        self.assertEquals((True, 8192, []), result)
+        self.assertEquals(4, self.uploads())
+
+    def test_sampled_should_find_corruption_in_chosen_sectors_only(self):
+        self.device.flash[33000] ^= 0x01
+
+        self.assertEquals([(START + 32768, 8192)], FlashVerifier(self.engine, sample=1, rng=LastRanges()).verify(self.digest).mismatched_ranges)
+        self.device.flash[33000] ^= 0x01
+        self.device.flash[100] ^= 0x01
+        self.assertTrue(FlashVerifier(self.engine, sample=2, rng=LastRanges()).verify(self.digest).success)
+
+
+class TestLibUsbFirmwareUpdaterVerification(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.firmware_path = os.path.join(self.temp_dir, 'firmware.bin')
+        with open(self.firmware_path, 'wb') as firmware_file:
+            firmware_file.write(IMAGE)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def update(self, device, sample=None):
+        updater = LibUsbFirmwareUpdater(None, 0x0483, 0xdf11, 0x16d0, 0x0af3, transport_factory=lambda d: device)
+        updater.verify = True
+        updater.verify_sample = sample
+        return updater.update(self.firmware_path)
+
+    def test_update_should_verify_before_leaving(self):
+        device = SimulatedDfuSeDevice()
+
+        result = self.update(device)
+
+        self.assertTrue(result)
+        self.assertEquals([PHASE_VERIFY, PHASE_MANIFEST], list(result.phases.keys())[-2:])
+        self.assertTrue(device.manifested)
+
+    def test_update_should_fail_without_leaving_when_flash_differs(self):
+        device = CorruptingDevice(START + 30000)
+
+        result = self.update(device)
+
+        self.assertFalse(result)
+        self.assertEquals("Flash does not match the image", result.error)
+        self.assertFalse(device.manifested)
+
+    def test_sampled_update_should_check_some_sectors(self):
+        device = SimulatedDfuSeDevice()
+
+        self.assertTrue(self.update(device, sample=1))
+
+
+@patch('firmware.firmware.Popen')
+class TestLinuxFirmwareUpdaterVerification(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.firmware_path = os.path.join(self.temp_dir, 'firmware.bin')
+        with open(self.firmware_path, 'wb') as firmware_file:
+            firmware_file.write(IMAGE)
+        open(os.path.join(self.temp_dir, 'dfu-util'), 'w').close()
+        self.updater = LinuxFirmwareUpdater(self.temp_dir, 0x0483, 0xdf11, 0x16d0, 0x0af3)
+        self.updater.verify = True
+        self.dfu_util = os.path.join(self.temp_dir, 'dfu-util')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def dfu_util_reading(self, flash):
+        def start(command, stdout, stderr):
+            process = MagicMock()
+            process.stdout, process.stderr = BytesIO(b'out'), BytesIO(b'')
+            process.communicate.return_value = (b'out', b'')
+            process.wait.return_value = 0
+            if '-U' in command:
+                with open(command[command.index('-U') + 1], 'wb') as upload:
+                    upload.write(flash)
+            return process
+        return start
+
+    def test_update_should_read_back_and_leave_after_writing(self, mock_Popen):
+        mock_Popen.side_effect = self.dfu_util_reading(IMAGE)
+
+        result = self.updater.update(self.firmware_path, leave=True)
+
+        self.assertTrue(result)
+        self.assertTrue(PHASE_VERIFY in result.phases)
+        download, upload = [call[0][0] for call in mock_Popen.call_args_list]
+        self.assertEquals(['--dfuse-address', '0x08000000', '-D', self.firmware_path], download[3:7])
+        self.assertEquals([self.dfu_util, '-a', '0', '--dfuse-address', '0x08000000:40960:leave', '-U'], upload[:6])
+        self.assertEquals(['-d', '0483:df11'], upload[7:])
+
+    def test_update_should_fail_when_read_back_differs(self, mock_Popen):
+        mock_Popen.side_effect = self.dfu_util_reading(IMAGE[:-1] + b'\x00')
+
+        result = self.updater.update(self.firmware_path)
+
+        self.assertFalse(result)
+        self.assertEquals("Flash does not match the image", result.error)
+        self.assertEquals(os.listdir(self.temp_dir), [name for name in os.listdir(self.temp_dir) if name in ('firmware.bin', 'dfu-util')])
+
+
+if __name__ == '__main__':
+    unittest.main()
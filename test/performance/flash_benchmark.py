@@ -0,0 +1,198 @@
+'''End to end flash benchmarks against simulated DfuSe bootloaders.
+
+Runs the libusb updater through the fleet updater against SimulatedDfuSeDevices with per block and per sector
+delays, and enumeration against a simulated sysfs tree. Results can be saved as json and compared against a
+baseline from an earlier release:
+
+    python test/performance/flash_benchmark.py --json results.json
+    python test/performance/flash_benchmark.py --baseline results.json --threshold 10
+'''
+import sys
+import os
+import gc
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+from collections import namedtuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'src'))
+
+from firmware.dfu import DFU_DNLOAD, DFUSE_DATA_BLOCK
+from firmware.devices import UsbDevice, SysfsUsbEnumerator
+from firmware.firmware import LibUsbFirmwareUpdater
+from firmware.fleet import FleetUpdater
+from firmware.simulator import SimulatedDfuSeDevice, SimulatedSysfs
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+    import resource
+
+BOOTLOADER = (0x0483, 0xdf11)
+PEACHY = (0x16d0, 0x0af3)
+
+Measurement = namedtuple('Measurement', 'image_size device_count enumeration_latency time_to_first_byte throughput cycle_time peak_memory')
+Regression = namedtuple('Regression', 'image_size device_count baseline current change')
+
+
+class TimedTransport(object):
+    '''Passes requests through to a simulated device, noting when the first data block is sent'''
+
+    def __init__(self, device, clock=time.time):
+        self.device = device
+        self.first_write_at = None
+        self._clock = clock
+
+    def __getattr__(self, name):
+        return getattr(self.device, name)
+
+    def control_out(self, request, value, data):
+        if self.first_write_at is None and request == DFU_DNLOAD and value >= DFUSE_DATA_BLOCK:
+            self.first_write_at = self._clock()
+        return self.device.control_out(request, value, data)
+
+
+class MemoryMonitor(object):
+    '''Peak bytes allocated while running, from tracemalloc or, without it, the process's peak resident size'''
+
+    def __enter__(self):
+        gc.collect()
+        if tracemalloc:
+            tracemalloc.start()
+        self.peak = None
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if tracemalloc:
+            self.peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        else:
+            self.peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def measure_enumeration(device_count, other_devices=8, repeat=20):
+    '''Mean seconds to find device_count bootloaders amongst other usb devices'''
+    sysfs = SimulatedSysfs()
+    try:
+        for index in range(device_count):
+            sysfs.add('1-{}'.format(index + 1), BOOTLOADER[0], BOOTLOADER[1], devnum=index + 2)
+            sysfs.add_interface('1-{}:1.0'.format(index + 1))
+        for index in range(other_devices):
+            sysfs.add('2-{}'.format(index + 1), 0x046d, 0xc52b, busnum=2, devnum=index + 2)
+        enumerator = SysfsUsbEnumerator(sysfs.root)
+        start = time.time()
+        for _ in range(repeat):
+            found = enumerator.find(*BOOTLOADER)
+        elapsed = (time.time() - start) / repeat
+        assert len(found) == device_count
+        return elapsed
+    finally:
+        sysfs.cleanup()
+
+
+def measure_flash(image_size, device_count, block_latency=0.001, erase_time=0.01, transfer_size=2048):
+    '''Flashes an image_size image to device_count simulated bootloaders at once returning a Measurement'''
+    temp_dir = tempfile.mkdtemp()
+    try:
+        firmware_path = os.path.join(temp_dir, 'firmware.bin')
+        with open(firmware_path, 'wb') as firmware_file:
+            firmware_file.write(os.urandom(image_size))
+        devices = [UsbDevice(BOOTLOADER[0], BOOTLOADER[1], port_path='1-{}'.format(index + 1)) for index in range(device_count)]
+        transports = dict((device.key, TimedTransport(SimulatedDfuSeDevice(block_latency=block_latency, erase_time=erase_time))) for device in devices)
+        updater = LibUsbFirmwareUpdater(None, BOOTLOADER[0], BOOTLOADER[1], PEACHY[0], PEACHY[1], transfer_size=transfer_size, transport_factory=lambda device: transports[device.key])
+        fleet = FleetUpdater(updater, max_workers=device_count, lock_dir=temp_dir)
+
+        with MemoryMonitor() as memory:
+            start = time.time()
+            results = fleet.update_all(firmware_path, devices)
+            cycle_time = time.time() - start
+
+        failed = [result for result in results if not result.success]
+        if failed:
+            raise Exception("Simulated flash failed: {}".format(failed[0].error))
+        time_to_first_byte = max(transport.first_write_at for transport in transports.values()) - start
+        return Measurement(
+            image_size, device_count, measure_enumeration(device_count), time_to_first_byte,
+            image_size * device_count / cycle_time, cycle_time, memory.peak)
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def run(image_sizes, device_counts, repeat=3, **simulation):
+    '''Returns the Measurement with the median cycle time of repeat runs for every image size and device count'''
+    measurements = []
+    for image_size in image_sizes:
+        for device_count in device_counts:
+            runs = sorted((measure_flash(image_size, device_count, **simulation) for _ in range(repeat)), key=lambda m: m.cycle_time)
+            measurements.append(runs[len(runs) // 2])
+    return measurements
+
+
+def compare(baseline, measurements, threshold=10.0):
+    '''Returns a Regression for each measurement whose cycle time is more than threshold percent over the baseline'''
+    previous = dict(((m['image_size'], m['device_count']), m['cycle_time']) for m in baseline['measurements'])
+    regressions = []
+    for measurement in measurements:
+        before = previous.get((measurement.image_size, measurement.device_count))
+        if before:
+            change = 100.0 * (measurement.cycle_time - before) / before
+            if change > threshold:
+                regressions.append(Regression(measurement.image_size, measurement.device_count, before, measurement.cycle_time, change))
+    return regressions
+
+
+def report(measurements, out=sys.stdout):
+    out.write('{:>10} {:>7} {:>12} {:>10} {:>12} {:>10} {:>10}\n'.format('image', 'devices', 'enumerate', 'first byte', 'throughput', 'cycle', 'memory'))
+    for m in measurements:
+        out.write('{:>9}K {:>7} {:>10.3f}ms {:>8.3f}ms {:>8.1f}KB/s {:>9.3f}s {:>8.1f}KB\n'.format(
+            m.image_size // 1024, m.device_count, m.enumeration_latency * 1000, m.time_to_first_byte * 1000,
+            m.throughput / 1024, m.cycle_time, m.peak_memory / 1024.0))
+
+
+def to_json(measurements, label=None):
+    return {
+        'label': label,
+        'python': platform.python_version(),
+        'measurements': [dict(m._asdict()) for m in measurements],
+    }
+
+
+def _numbers(text):
+    return [int(value) for value in text.split(',')]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark flashing simulated DfuSe bootloaders')
+    parser.add_argument('--sizes', type=_numbers, default=[16 * 1024, 256 * 1024, 1024 * 1024], help='Comma separated image sizes in bytes')
+    parser.add_argument('--devices', type=_numbers, default=[1, 4, 16], help='Comma separated device counts')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--block-latency', type=float, default=0.001, help='Seconds the device takes to program a block')
+    parser.add_argument('--erase-time', type=float, default=0.01, help='Seconds the device takes to erase a sector')
+    parser.add_argument('--transfer-size', type=int, default=2048)
+    parser.add_argument('--json', help='Save results to this file')
+    parser.add_argument('--label', help='Name for these results, such as the release')
+    parser.add_argument('--baseline', help='Results file to compare cycle times against')
+    parser.add_argument('--threshold', type=float, default=10.0, help='Percent slower than the baseline to report as a regression')
+    args = parser.parse_args(argv)
+
+    measurements = run(args.sizes, args.devices, args.repeat, block_latency=args.block_latency, erase_time=args.erase_time, transfer_size=args.transfer_size)
+    report(measurements)
+    if args.json:
+        with open(args.json, 'w') as results_file:
+            json.dump(to_json(measurements, args.label), results_file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(json.load(baseline_file), measurements, args.threshold)
+        for regression in regressions:
+            print("Regression: {}K on {} devices took {:.3f}s, was {:.3f}s (+{:.1f}%)".format(
+                regression.image_size // 1024, regression.device_count, regression.current, regression.baseline, regression.change))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,47 @@
+import sys
+import os
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'src'))
+
+from performance.flash_benchmark import Measurement, measure_flash, measure_enumeration, compare, to_json
+from firmware.simulator import SimulatedDfuSeDevice
+
+
+class TestFlashBenchmark(unittest.TestCase):
+
+    def test_measure_flash_should_report_every_metric(self):
+        measurement = measure_flash(4096, 2, block_latency=0, erase_time=0)
+
+        self.assertEquals((4096, 2), (measurement.image_size, measurement.device_count))
+        for value in measurement[2:]:
+            self.assertTrue(value > 0)
+        self.assertTrue(measurement.time_to_first_byte <= measurement.cycle_time)
+
+    def test_measure_enumeration_should_time_finding_devices(self):
+        self.assertTrue(measure_enumeration(3, repeat=2) > 0)
+
+    def test_compare_should_report_slower_cycles_only(self):
+        baseline = to_json([Measurement(1024, 1, 0.001, 0.01, 1000, 1.0, 1000), Measurement(1024, 4, 0.001, 0.01, 1000, 2.0, 1000)])
+        current = [Measurement(1024, 1, 0.001, 0.01, 1000, 1.05, 1000), Measurement(1024, 4, 0.001, 0.01, 1000, 3.0, 1000)]
+
+        regressions = compare(baseline, current, threshold=10)
+
+        self.assertEquals([(1024, 4)], [(r.image_size, r.device_count) for r in regressions])
+        self.assertEquals(50.0, regressions[0].change)
+
+
+class TestSimulatedDeviceTiming(unittest.TestCase):
+
+    def test_should_spend_block_latency_and_erase_time(self):
+        from firmware.dfu import DfuSeEngine, MemoryLayout
+        slept = []
+        device = SimulatedDfuSeDevice(block_latency=0.002, erase_time=0.5, sleep=slept.append)
+
+        DfuSeEngine(device, 2048).download(0x08000000, b'\x00' * 4096, MemoryLayout.parse(device.interface_name))
+
+        self.assertEquals([0.5, 0.002, 0.002], slept)
+
+
+if __name__ == '__main__':
+    unittest.main()
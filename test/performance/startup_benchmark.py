@@ -0,0 +1,111 @@
+'''Startup benchmarks for short lived station tools.
+
+Times, in fresh processes, importing the package, getting the first updater (which runs the dependancy preflight)
+and then how long each later get_firmware_updater() and dfu_bin read take. Point --src at a checkout of an earlier
+release to compare against it:
+
+    python test/performance/startup_benchmark.py
+    python test/performance/startup_benchmark.py --src /tmp/peachy-firmware-flash-1.0/src --json before.json
+    python test/performance/startup_benchmark.py --baseline before.json --threshold 10
+'''
+import sys
+import os
+import json
+import argparse
+import platform
+import subprocess
+from collections import namedtuple
+
+SRC = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'src'))
+
+Startup = namedtuple('Startup', 'import_time first_updater_time updater_call_time dfu_bin_time modules')
+Regression = namedtuple('Regression', 'field baseline current change')
+
+# Runs in a fresh interpreter; earlier releases print while getting an updater so the timings are the last line
+STARTUP_SCRIPT = '''
+import sys, time, json
+sys.path.insert(0, {src!r})
+start = time.time()
+import firmware
+imported = time.time()
+updater = firmware.get_firmware_updater()
+created = time.time()
+for _ in range({calls}):
+    firmware.get_firmware_updater()
+called = time.time()
+for _ in range({calls}):
+    getattr(updater, 'dfu_bin', None)
+read = time.time()
+modules = len([name for name in sys.modules if name == 'firmware' or name.startswith('firmware.')])
+print(json.dumps([imported - start, created - imported, (called - created) / {calls}, (read - called) / {calls}, modules]))
+'''
+
+
+def measure_startup(src=SRC, calls=100, python=sys.executable):
+    '''Starts one interpreter against the package in src, returning its Startup'''
+    output = subprocess.check_output([python, '-c', STARTUP_SCRIPT.format(src=src, calls=calls)])
+    return Startup(*json.loads(output.decode('utf-8').strip().splitlines()[-1]))
+
+
+def run(src=SRC, repeat=10, calls=100, python=sys.executable):
+    '''The median of each Startup field over repeat fresh interpreters'''
+    runs = [measure_startup(src, calls, python) for _ in range(repeat)]
+    return Startup(*[sorted(values)[len(values) // 2] for values in zip(*runs)])
+
+
+def compare(baseline, startup, threshold=10.0):
+    '''Returns a Regression for each time more than threshold percent over the baseline'''
+    previous = baseline['startup']
+    regressions = []
+    for field in ('import_time', 'first_updater_time', 'updater_call_time', 'dfu_bin_time'):
+        before, current = previous.get(field), getattr(startup, field)
+        if before:
+            change = 100.0 * (current - before) / before
+            if change > threshold:
+                regressions.append(Regression(field, before, current, change))
+    return regressions
+
+
+def report(startup, out=sys.stdout):
+    out.write('import firmware          {:>10.2f}ms\n'.format(startup.import_time * 1000))
+    out.write('first updater            {:>10.2f}ms\n'.format(startup.first_updater_time * 1000))
+    out.write('get_firmware_updater()   {:>10.2f}us\n'.format(startup.updater_call_time * 1000000))
+    out.write('dfu_bin                  {:>10.2f}us\n'.format(startup.dfu_bin_time * 1000000))
+    out.write('package modules loaded   {:>10}\n'.format(startup.modules))
+
+
+def to_json(startup, label=None):
+    return {
+        'label': label,
+        'python': platform.python_version(),
+        'startup': dict(startup._asdict()),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark importing the package and getting updaters')
+    parser.add_argument('--src', default=SRC, help='Directory holding the firmware package to time')
+    parser.add_argument('--repeat', type=int, default=10, help='Fresh interpreters to take the median of')
+    parser.add_argument('--calls', type=int, default=100, help='Calls averaged for the per call times')
+    parser.add_argument('--json', help='Save results to this file')
+    parser.add_argument('--label', help='Name for these results, such as the release')
+    parser.add_argument('--baseline', help='Results file to compare against')
+    parser.add_argument('--threshold', type=float, default=10.0, help='Percent slower than the baseline to report as a regression')
+    args = parser.parse_args(argv)
+
+    startup = run(args.src, args.repeat, args.calls)
+    report(startup)
+    if args.json:
+        with open(args.json, 'w') as results_file:
+            json.dump(to_json(startup, args.label), results_file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(json.load(baseline_file), startup, args.threshold)
+        for regression in regressions:
+            print("Regression: {} took {:.6f}s, was {:.6f}s (+{:.1f}%)".format(regression.field, regression.current, regression.baseline, regression.change))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
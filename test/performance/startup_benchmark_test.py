@@ -0,0 +1,31 @@
+import sys
+import os
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'src'))
+
+from performance.startup_benchmark import Startup, measure_startup, compare, to_json
+
+
+class TestStartupBenchmark(unittest.TestCase):
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), 'Times the dfu-util updater')
+    def test_measure_startup_should_time_a_fresh_interpreter(self):
+        startup = measure_startup(calls=2)
+
+        for value in startup[:4]:
+            self.assertTrue(value > 0)
+        self.assertTrue(startup.modules > 0)
+
+    def test_compare_should_report_slower_times_only(self):
+        baseline = to_json(Startup(0.1, 0.05, 0.00002, 0.000001, 10))
+        current = Startup(0.105, 0.1, 0.00001, 0.000001, 10)
+
+        regressions = compare(baseline, current, threshold=10)
+
+        self.assertEquals(['first_updater_time'], [regression.field for regression in regressions])
+        self.assertEquals(100.0, regressions[0].change)
+
+
+if __name__ == '__main__':
+    unittest.main()